@@ -25,12 +25,12 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.model_selection import StratifiedShuffleSplit, ShuffleSplit
 from sklearn.metrics import euclidean_distances
 from sklearn.metrics.pairwise import cosine_distances
-from sklearn.neighbors.classification import KNeighborsClassifier
 from sklearn.utils import check_random_state, check_array
 from sklearn.utils.extmath import row_norms, stable_cumsum
 from sklearn.utils.validation import check_is_fitted
 from hub_toolbox.utils import SynchronizedCounter
 from hub_toolbox.htlogging import ConsoleLogging
+from hub_toolbox.knn_classification import weighted_vote
 try:
     import nmslib
     nms_avail = True
@@ -1352,7 +1352,20 @@ class SuQHR(BaseEstimator, TransformerMixin):
 
 
     def _predict_knn(self, X):
-        """ Predict class labels wiht k-nearest neighbor classifier. """
+        """ Predict class labels with a k-nearest neighbor classifier.
+
+        The `knn__n_neighbors` (default: 5) smallest secondary distances of
+        all test objects in `X` are selected at once, and their labels are
+        combined by :func:`hub_toolbox.knn_classification.weighted_vote`.
+        Columns of `X` are mapped to training objects through `ind_test_`,
+        unless vantage points are fixed.
+
+        NOTE: This replaces the previous scikit-learn KNeighborsClassifier.
+        `knn__weights` accepts 'uniform', 'distance', and 'rank', or a
+        callable of the neighbor distance array that returns weights of
+        the same shape (as in scikit-learn). Ties are broken by the nearest
+        neighbor (scikit-learn uses the smallest class label).
+        """
         try:
             n_neighbors = self.kwargs['knn__n_neighbors']
         except KeyError:
@@ -1361,29 +1374,31 @@ class SuQHR(BaseEstimator, TransformerMixin):
             weights = self.kwargs['knn__weights']
         except KeyError:
             weights = 'uniform'
-        if self.fixed_vantage_pts_:
-            knn = KNeighborsClassifier(n_neighbors=n_neighbors,
-                                       algorithm='brute',
-                                       metric='precomputed',
-                                       weights=weights)
-            knn.fit(X.T, self.y_train_)
-            y_pred = knn.predict(X)
-        else:
-            # W/o fixed vantage points, a new classifier
-            # is required for each test object.
-            if self.y_train_.ndim == 1:
-                y_pred = np.zeros((X.shape[0],), dtype=self.y_train_.dtype)
-            else:
-                y_pred = np.zeros((X.shape[0], self.y_train_.shape[1]),
-                                  dtype=self.y_train_.dtype)
-            knn = KNeighborsClassifier(n_neighbors=self.n_neighbors,
-                                       algorithm='brute',
-                                       metric='precomputed',
-                                       weights=weights)
-            for i, d_test in enumerate(X):
-                d_test = d_test.reshape(-1, 1)
-                knn.fit(d_test, self.y_train_[self.ind_test_[i]])
-                y_pred[i] = knn.predict(d_test.T)
+        n_test, n_cols = X.shape
+        n_neighbors = min(n_neighbors, n_cols)
+        # Top-k selection over the secondary distances of all test objects
+        nn = np.argpartition(X, kth=n_neighbors-1, axis=1)[:, :n_neighbors]
+        rows = np.arange(n_test)[:, np.newaxis]
+        nn_dist = X[rows, nn]
+        order = np.argsort(nn_dist, axis=1)
+        nn = nn[rows, order]
+        nn_dist = nn_dist[rows, order]
+        # Map columns to training objects. W/o fixed vantage points,
+        # each test object has its own set of candidate objects.
+        if not self.fixed_vantage_pts_:
+            nn = self.ind_test_[rows, nn]
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+        y_pred = np.empty((n_test, y_train.shape[1]), dtype=y_train.dtype)
+        for l in range(y_train.shape[1]):
+            classes, y_enc = np.unique(y_train[:, l], return_inverse=True)
+            y_pred_enc = weighted_vote(y_enc[nn], nn_dist,
+                                       n_classes=classes.size,
+                                       weights=weights, metric='distance')
+            y_pred[:, l] = classes[y_pred_enc]
+        if self.y_train_.ndim == 1:
+            y_pred = y_pred.ravel()
         return y_pred
 
     ##########################################################################
@@ -13,15 +13,43 @@ Contact: <roman.feldbauer@ofai.at>
 import ctypes
 from multiprocessing import cpu_count, Pool, RawArray
 import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.metrics.pairwise import euclidean_distances
-from hub_toolbox.distances import cosine_distance as cos
+from sklearn.utils.validation import check_array, check_is_fitted
 from hub_toolbox import io
 from functools import partial
 
 __all__ = ['centering', 'weighted_centering', 'localized_centering', 
-           'dis_sim_global', 'dis_sim_local']
+           'dis_sim_global', 'dis_sim_local', 'Centering',
+           'WeightedCentering']
 
-def centering(X:np.ndarray, metric:str='vector', test_set_mask:np.ndarray=None):
+def _center_kernel(K, out, batch_size=1024):
+    """ Double centering ``H K H`` with ``H = I - 1/n``, in O(n^2).
+
+    Equivalent to subtracting row means and column means, and adding the
+    grand mean. Means are accumulated in a first pass over row blocks of
+    `K`, and the centered blocks are written to `out` (which may be `K`,
+    or a memory map) in a second pass.
+    """
+    n = K.shape[0]
+    row_mean = np.empty(n)
+    col_sum = np.zeros(n)
+    for i in range(0, n, batch_size):
+        block = np.asarray(K[i:i+batch_size], dtype=np.float64)
+        row_mean[i:i+batch_size] = block.mean(axis=1)
+        col_sum += block.sum(axis=0)
+    col_mean = col_sum / n
+    grand_mean = row_mean.mean()
+    for i in range(0, n, batch_size):
+        block = np.asarray(K[i:i+batch_size], dtype=np.float64)
+        block -= col_mean
+        block -= row_mean[i:i+batch_size, np.newaxis]
+        block += grand_mean
+        out[i:i+batch_size] = block
+    return out
+
+def centering(X:np.ndarray, metric:str='vector', test_set_mask:np.ndarray=None,
+              copy:bool=True, out:np.ndarray=None, batch_size:int=1024):
     """
     Perform  centering, i.e. shift the origin to the data centroid.
 
@@ -51,6 +79,16 @@ def centering(X:np.ndarray, metric:str='vector', test_set_mask:np.ndarray=None):
         Hold back data as a test set and perform centering on the remaining 
         data (training set).
 
+    copy : bool, optional (default: True)
+        If False, a floating point Gram matrix `X` is centered in place.
+
+    out : ndarray, optional (default: None)
+        Array (e.g. a memory map) for the centered Gram matrix.
+
+    batch_size : int, optional (default: 1024)
+        Number of rows of the Gram matrix processed at a time. Centering
+        needs no temporary ``n x n`` arrays.
+
     Returns
     ------- 
     X_cent : ndarray
@@ -77,10 +115,18 @@ def centering(X:np.ndarray, metric:str='vector', test_set_mask:np.ndarray=None):
             raise NotImplementedError("Kernel based centering does not "
                                       "support train/test splits so far.")
         io.check_distance_matrix_shape(X)
-        n = X.shape[0]
-        H = np.identity(n) - np.ones((n, n)) / n
         # K = X.T.X must be provided upstream
-        return H.dot(X).dot(H)
+        if out is not None:
+            if out.shape != X.shape:
+                raise ValueError("Output array must have shape {}, but has "
+                                 "{}.".format(X.shape, out.shape))
+        elif not copy and np.issubdtype(X.dtype, np.floating):
+            out = X
+        elif np.issubdtype(X.dtype, np.floating):
+            out = np.empty_like(X)
+        else:
+            out = np.empty(X.shape, dtype=np.float64)
+        return _center_kernel(X, out, batch_size)
     elif metric == 'vector':
         n = X.shape[0]
         if test_set_mask is None:
@@ -111,6 +157,8 @@ def weighted_centering(X:np.ndarray, metric:str='cosine', gamma:float=1.,
         Distance measure used to place more weight on objects that are more 
         likely to become hubs. (Defined for 'cosine' in [1]_, 'euclidean' does 
         not make much sense and might be removed in the future).
+        With 'euclidean', weights derive from the sum of euclidean
+        distances to all training objects.
     
     gamma : float, optional (default: 1.0)
         Controls how much we emphasize the weighting effect
@@ -121,12 +169,17 @@ def weighted_centering(X:np.ndarray, metric:str='cosine', gamma:float=1.,
     
     test_set_mask : ndarray, optional (default: None)
         Hold back data as a test set and perform centering on the remaining 
-        data (training set).
+        data (training set). Weights and weighted mean are calculated from
+        the training set only.
     
     Returns
     ------- 
     X_wcent : ndarray
         Weighted centered vectors.
+
+    See also
+    --------
+    WeightedCentering : fitted weighted mean for out-of-sample centering
         
     References
     ----------
@@ -144,25 +197,105 @@ def weighted_centering(X:np.ndarray, metric:str='cosine', gamma:float=1.,
     else:
         train_set_mask = slice(0, n)
     
-    n_train = X[train_set_mask].shape[0]
-    d = np.zeros(n)
-    
+    wcent = WeightedCentering(metric=metric, gamma=gamma)
+    return wcent.fit(X[train_set_mask]).transform(X)
+
+def _centering_weights(X, metric, gamma, batch_size=1024):
+    """ Weights of weighted centering for the (training) objects `X`.
+
+    For 'cosine', the weight of each object derives from its cosine distance
+    to the data centroid, computed as one normalized matrix-vector product.
+    For 'euclidean', from the sum of its euclidean distances to all objects
+    (computed in blocks of `batch_size` rows).
+    """
+    n = X.shape[0]
     if metric == 'cosine':
-        vectors_sum = X[train_set_mask].sum(axis=0)
-        for i in np.arange(n):
-            d[i] = n_train * cos(np.array([X[i], vectors_sum/n_train]))[0, 1]
+        mean = X.mean(axis=0)
+        norms = np.sqrt(np.einsum('ij,ij->i', X, X)) * np.sqrt(mean.dot(mean))
+        d = n * np.maximum(1. - X.dot(mean) / norms, 0.)
     # Using euclidean distances does not really make sense
     elif metric == 'euclidean':
-        for i in range(n):
-            displ_v = X[train_set_mask] - d[i]
-            d[i] = np.sum(np.sqrt(displ_v * displ_v))
+        d = np.empty(n)
+        for i in range(0, n, batch_size):
+            d[i:i+batch_size] = euclidean_distances(
+                X[i:i+batch_size], X).sum(axis=1)
     else:
         raise ValueError("Weighted centering only supports cosine distances.")
-    d_sum = np.sum(d ** gamma)
-    w = (d ** gamma) / d_sum
-    vectors_mean_weighted = np.sum(w.reshape(n, 1) * X, axis=0)
-    X_wcent = X - vectors_mean_weighted
-    return X_wcent
+    d **= gamma
+    return d / d.sum()
+
+class Centering(BaseEstimator, TransformerMixin):
+    """ Centering with out-of-sample transformation.
+
+    Fits the centroid of the training vectors, so that new (query) vectors
+    are centered in O(m) time each, without recomputing the centroid.
+
+    Attributes
+    ----------
+    mean_ : ndarray, shape (m, )
+        Centroid of the training vectors.
+
+    See also
+    --------
+    centering
+    """
+    def fit(self, X, y=None):
+        """ Fit the centroid of training vectors `X` (``n_train x m``). """
+        X = check_array(X)
+        self.mean_ = X.mean(axis=0)
+        return self
+
+    def transform(self, X):
+        """ Shift the origin of vectors `X` (``n x m``) to the centroid. """
+        check_is_fitted(self, 'mean_')
+        X = check_array(X)
+        return X - self.mean_
+
+class WeightedCentering(Centering):
+    """ Weighted centering with out-of-sample transformation.
+
+    Fits the weighted mean of the training vectors [1]_, so that new (query)
+    vectors are centered in O(m) time each.
+
+    Parameters
+    ----------
+    metric : {'cosine', 'euclidean'}, optional (default: 'cosine')
+        Distance measure used to place more weight on objects that are more
+        likely to become hubs (see :func:`weighted_centering`).
+
+    gamma : float, optional (default: 1.0)
+        Controls how much we emphasize the weighting effect
+
+        - ``gamma=0`` : equivalent to normal centering
+        - ``gamma>0`` : move origin closer to objects with larger similarity
+          to other objects
+
+    Attributes
+    ----------
+    weights_ : ndarray, shape (n_train, )
+        Weights of the training vectors.
+
+    mean_ : ndarray, shape (m, )
+        Weighted mean of the training vectors.
+
+    References
+    ----------
+    .. [1] Suzuki, I., Hara, K., Shimbo, M., Saerens, M., & Fukumizu, K. (2013). 
+           Centering similarity measures to reduce hubs. In Proceedings of the 
+           2013 Conference on Empirical Methods in Natural Language Processing 
+           (pp 613–623). 
+           Retrieved from https://www.aclweb.org/anthology/D/D13/D13-1058.pdf
+    """
+    def __init__(self, metric:str='cosine', gamma:float=1.):
+        self.metric = metric
+        self.gamma = gamma
+
+    def fit(self, X, y=None):
+        """ Fit the weighted mean of training vectors `X` (``n_train x m``). """
+        X = check_array(X)
+        self.weights_ = _centering_weights(X, self.metric, self.gamma)
+        self.mean_ = self.weights_.dot(X)
+        return self
 
 #===============================================================================
 # #=============================================================================
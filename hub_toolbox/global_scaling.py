@@ -18,6 +18,7 @@ from scipy.special import gammainc  # @UnresolvedImport
 from scipy.stats import norm
 from scipy.sparse import lil_matrix, csr_matrix, issparse
 from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
 from multiprocessing.sharedctypes import Array
 from hub_toolbox import io
 from hub_toolbox.htlogging import ConsoleLogging
@@ -86,18 +87,42 @@ def mutual_proximity_empiric(D:np.ndarray, metric:str='distance',
                                                 verbose=verbose,
                                                 n_jobs=n_jobs)
 
+def _mp_empiric_sample_block(block, D, D_sample, sample_col, out, metric,
+                             exclude_value):
+    """ MP empiric of a block of rows against all sample objects.
+
+    Uses one broadcast comparison of shape ``(rows, s, s)``: For row ``i``
+    and sample ``j``, count objects ``l`` with ``D[i, l]`` and
+    ``D[idx[j], l]`` both farther (less similar) than ``D[i, j]``.
+    """
+    pos, rows = block
+    d = np.array(D[rows])
+    own = sample_col[rows]
+    has_own = own >= 0
+    d[np.flatnonzero(has_own), own[has_own]] = exclude_value
+    thresh = d[:, :, np.newaxis]
+    n_pts = d.shape[1]
+    if metric == 'similarity':
+        count = np.sum((d[:, np.newaxis, :] <= thresh) & (D_sample <= thresh),
+                       axis=2)
+        out[pos] = count / n_pts
+    else: # metric == 'distance':
+        count = np.sum((d[:, np.newaxis, :] > thresh) & (D_sample > thresh),
+                       axis=2)
+        out[pos] = 1 - (count / n_pts)
+    return
+
 def _mutual_proximity_empiric_sample(D:np.ndarray, idx:np.ndarray,
     metric:str='distance', test_set_ind:np.ndarray=None,
-    verbose:int=0, n_jobs=None):
+    verbose:int=0, n_jobs=None, max_elements:int=2**24):
     """Transform a distance matrix with Mutual Proximity (empiric distribution).
-    
-    NOTE: this docstring does not yet fully reflect the properties of this
-    proof-of-concept function!
-    
+
     Applies Mutual Proximity (MP) [1]_ on a distance/similarity matrix using
-    the empiric data distribution (EXACT, rather SLOW). The resulting
-    secondary distance/similarity matrix should show lower hubness.
-    
+    the empiric data distribution of ``s`` sample objects (EXACT). Blocks of
+    rows are processed with vectorized comparisons, optionally in parallel
+    threads. The resulting secondary distance/similarity matrix should show
+    lower hubness.
+
     Parameters
     ----------
     D : ndarray
@@ -111,19 +136,31 @@ def _mutual_proximity_empiric_sample(D:np.ndarray, idx:np.ndarray,
     metric : {'distance', 'similarity'}, optional (default: 'distance')
         Define, whether matrix `D` is a distance or similarity matrix.
 
-    test_sed_ind : ndarray, optional (default: None)
+    test_set_ind : ndarray, optional (default: None)
         Define data points to be hold out as part of a test set. Can be:
 
         - None : Rescale all distances
-        - ndarray : Hold out points indexed in this array as test set.
+        - ndarray : Return only rescaled distances of these data points.
 
     verbose : int, optional (default: 0)
         Increasing level of output (progress report).
 
+    n_jobs : int, optional (default: None)
+        Number of threads for parallel computations.
+
+        - `None` or `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    max_elements : int, optional (default: 2**24)
+        Maximum number of elements of the boolean temporary arrays per block,
+        i.e. rows per block are ``max_elements // s**2``.
+
     Returns
     -------
     D_mp : ndarray
-        Secondary distance MP empiric matrix.
+        Secondary distance MP empiric matrix of shape ``n x s`` (or
+        ``test_set_ind.size x s``). Self distances ``D[idx[j], j]`` are set
+        to zero (one for similarities). Float32 input yields float32 output.
 
     References
     ----------
@@ -143,53 +180,49 @@ def _mutual_proximity_empiric_sample(D:np.ndarray, idx:np.ndarray,
     else: # metric == 'distance':
         self_value = 0
         exclude_value = -np.inf
-        if issparse(D):
-            raise ValueError("MP sparse only supports similarity matrices.")
+    if not n_jobs:
+        n_jobs = 1
+    elif n_jobs == -1:
+        n_jobs = cpu_count()
     if test_set_ind is None:
-        n_ind = range(n)
-    #elif not np.all(~test_set_ind):
+        n_ind = np.arange(n)
     else:
-        n_ind = test_set_ind
-        #raise NotImplementedError("MP empiric does not yet support train/"
-        #                          "test splits.")
-        #train_set_ind = np.setdiff1d(np.arange(n), test_set_ind)
+        n_ind = np.asarray(test_set_ind)
 
-    # Start MP
-    D = D.copy()
-    
-    if issparse(D):
-        raise NotImplementedError
-        #return _mutual_proximity_empiric_sparse(D, test_set_ind, verbose, log)
-        
-    # ensure correct self distances (NOT done for sparse matrices!)
-    for j, sample in enumerate(idx):
-        D[sample, j] = exclude_value
+    # Sample objects' distances, with self distances excluded
+    sample_col = np.full(n, -1)
+    sample_col[idx] = np.arange(s)
+    D_sample = np.array(D[idx])
+    np.fill_diagonal(D_sample, exclude_value)
+    dtype = D.dtype if np.issubdtype(D.dtype, np.floating) else np.float64
+    D_mp = np.empty((n_ind.size, s), dtype=dtype)
 
-    D_mp = np.zeros_like(D) * np.nan
-     
     # Calculate MP empiric
-    for i in n_ind: #range(n):
-        if verbose and ((i+1)%1000 == 0 or i == n-2):
-            log.message("MP_empiric: {} of {}.".format(i+1, n-1), flush=True)
-        dI = D[i, :][np.newaxis, :] # broadcasted afterwards
-        dJ = D[idx, :] # fancy indexing, thus copy
-        d = dI.T # D[i, :][:, np.newaxis] # both versions are equal
-        # div by n
-        n_pts = s 
-        # div by n-1, n-2 #n_pts = (np.isfinite(dI) & np.isfinite(dJ)).sum(1)
-        if metric == 'similarity':
-            D_mp[i, :] = np.sum((dI <= d) & (dJ <= d), 1) / n_pts
-        else: # metric == 'distance':
-            D_mp[i, :] = 1 - (np.sum((dI > d) & (dJ > d), 1) / n_pts)
+    batch_size = max(1, max_elements // (s * s))
+    blocks = [(slice(i, i + batch_size), n_ind[i:i + batch_size])
+              for i in range(0, n_ind.size, batch_size)]
+    func = partial(_mp_empiric_sample_block, D=D, D_sample=D_sample,
+                   sample_col=sample_col, out=D_mp, metric=metric,
+                   exclude_value=exclude_value)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            for b, _ in enumerate(pool.imap_unordered(func, blocks)):
+                if verbose and ((b+1)%10 == 0 or b+1 == len(blocks)):
+                    log.message("MP_empiric: block {} of {}."
+                                .format(b+1, len(blocks)), flush=True)
+    else:
+        for b, block in enumerate(blocks):
+            func(block)
+            if verbose and ((b+1)%10 == 0 or b+1 == len(blocks)):
+                log.message("MP_empiric: block {} of {}."
+                            .format(b+1, len(blocks)), flush=True)
 
     # Ensure correct self distances
-    for j, sample in enumerate(idx):
-        D_mp[sample, j] = self_value
-    
-    if test_set_ind is None:
-        return D_mp
-    else:
-        return D_mp[test_set_ind]
+    pos = np.full(n, -1)
+    pos[n_ind] = np.arange(n_ind.size)
+    j = np.flatnonzero(pos[idx] >= 0)
+    D_mp[pos[idx[j]], j] = self_value
+    return D_mp
 
 def _mutual_proximity_empiric_full(D:np.ndarray, metric:str='distance', 
                                   test_set_ind:np.ndarray=None, min_nnz:int=0,
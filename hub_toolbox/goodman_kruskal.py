@@ -10,14 +10,134 @@ Austrian Research Institute for Artificial Intelligence (OFAI)
 Contact: <roman.feldbauer@ofai.at>
 """
 import sys
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix, triu, issparse
+from scipy.stats import norm
+from sklearn.utils.validation import check_random_state
 from hub_toolbox import io
 
-__all__ = ['goodman_kruskal_index', 'sparse_goodman_kruskal_index']
+__all__ = ['goodman_kruskal_index', 'sparse_goodman_kruskal_index',
+           'sampled_goodman_kruskal_index']
+
+def _concordant_discordant(D_self, D_other_sorted):
+    """ Count quadruples with within- vs. between-class values.
+
+    Returns the number of pairs with ``D_self > D_other`` and
+    ``D_self < D_other``, respectively, where ``D_other_sorted`` must be
+    sorted in ascending order. Equal values are not counted. Uses two
+    vectorized binary searches per within-class value, i.e.
+    O(m log n_other) for ``m`` within-class values.
+    """
+    D_self = np.sort(D_self, axis=None)
+    left = np.searchsorted(D_other_sorted, D_self, side='left')
+    right = np.searchsorted(D_other_sorted, D_self, side='right')
+    n_greater = int(left.sum(dtype=np.int64))
+    n_less = int((D_other_sorted.size - right).sum(dtype=np.int64))
+    return n_greater, n_less
+
+def _segment_counts(segment, D_self, D_other_sorted):
+    return _concordant_discordant(D_self[segment[0]:segment[1]],
+                                  D_other_sorted)
+
+def _count_per_class(D_self, offsets, D_other_sorted, n_jobs=1,
+                     max_segment=2**20):
+    """ Sum of concordant/discordant counts over classes.
+
+    Within-class values of class ``c`` are ``D_self[offsets[c]:offsets[c+1]]``.
+    Classes are independent given the sorted between-class values, so they
+    are processed by `n_jobs` threads sharing `D_other_sorted` (numpy
+    releases the GIL for sorting and searching). Large classes are split
+    into segments of at most `max_segment` values.
+    """
+    if not n_jobs:
+        n_jobs = 1
+    elif n_jobs == -1:
+        n_jobs = cpu_count()
+    segments = [(start, min(start + max_segment, stop))
+                for start, stop in zip(offsets[:-1], offsets[1:])
+                for start in range(start, stop, max_segment)]
+    func = partial(_segment_counts, D_self=D_self,
+                   D_other_sorted=D_other_sorted)
+    if n_jobs > 1 and len(segments) > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            counts = pool.map(func, segments)
+    else:
+        counts = [func(segment) for segment in segments]
+    n_greater = sum(c[0] for c in counts)
+    n_less = sum(c[1] for c in counts)
+    return n_greater, n_less
+
+def _label_sorted_blocks(D, inv, order, batch_size):
+    """ Within- and between-class values of `D`, block by block.
+
+    Objects are sorted by label once (`order`). For each block of rows (in
+    label order), only these rows are read from `D` (which may be a memory
+    map), and the values to objects later in label order are split into
+    within-class and between-class values. Each unordered pair is thus
+    visited once. Within-class values are yielded in label order.
+    """
+    n = inv.size
+    inv_sorted = inv[order]
+    class_end = np.cumsum(np.bincount(inv_sorted))[inv_sorted]
+    col = np.arange(n)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        pos = np.arange(start, stop)[:, np.newaxis]
+        block = np.asarray(D[order[start:stop]])[:, order]
+        end = class_end[start:stop, np.newaxis]
+        within = block[(col > pos) & (col < end)]
+        between = block[col >= end]
+        yield within, between
+
+def _gk_histogram(D, inv, order, batch_size, bins):
+    """ Approximate Q_c, Q_d from streaming histograms of `D` values.
+
+    Within-class values are counted per class and bin, between-class values
+    per bin. Values in the same bin count as ties.
+    """
+    if np.ndim(bins) == 0:
+        lo, hi = np.inf, -np.inf
+        for within, between in _label_sorted_blocks(D, inv, order,
+                                                    batch_size):
+            for x in (within, between):
+                if x.size:
+                    lo = min(lo, x.min())
+                    hi = max(hi, x.max())
+        edges = np.linspace(lo, hi, int(bins) + 1)
+    else:
+        edges = np.asarray(bins)
+    n_bins = edges.size - 1
+    n_classes = inv.max() + 1
+    inner_edges = edges[1:-1]
+    h_self = np.zeros(n_classes * n_bins, dtype=np.int64)
+    h_other = np.zeros(n_bins, dtype=np.int64)
+    n_c = np.bincount(inv)
+    row_class = inv[order]
+    n_within = n_c[row_class] - 1 - (np.arange(inv.size)
+                                     - np.repeat(np.cumsum(n_c) - n_c, n_c))
+    start = 0
+    for within, between in _label_sorted_blocks(D, inv, order, batch_size):
+        stop = min(start + batch_size, inv.size)
+        w_class = np.repeat(row_class[start:stop], n_within[start:stop])
+        h_self += np.bincount(
+            w_class * n_bins + np.searchsorted(inner_edges, within, 'right'),
+            minlength=n_classes * n_bins)
+        h_other += np.bincount(np.searchsorted(inner_edges, between, 'right'),
+                               minlength=n_bins)
+        start = stop
+    h_self = h_self.reshape(n_classes, n_bins)
+    other_below = np.concatenate(([0], np.cumsum(h_other)[:-1]))
+    other_above = h_other.sum() - other_below - h_other
+    Q_c = int(np.sum(h_self * other_below))
+    Q_d = int(np.sum(h_self * other_above))
+    return Q_c, Q_d
 
 def goodman_kruskal_index(D:np.ndarray, classes:np.ndarray,
-                          metric:str='distance') -> float:
+                          metric:str='distance', batch_size:int=256,
+                          bins=None, n_jobs:int=1) -> float:
     """Calculate the Goodman-Kruskal clustering index.
         
     Parameters
@@ -30,7 +150,26 @@ def goodman_kruskal_index(D:np.ndarray, classes:np.ndarray,
     
     metric : {'distance', 'similarity'}, optional (default: 'distance')
         Define, whether the matrix `D` is a distance or similarity matrix
-    
+
+    batch_size : int, optional (default: 256)
+        Number of rows of `D` read at a time. `D` may be a memory map.
+        No ``n x n`` temporary arrays are created.
+
+    bins : int or ndarray, optional (default: None)
+        - None: Exact index. Within-class and between-class values are
+          gathered (``n^2 / 2`` values in total).
+        - int: Approximate index from streaming histograms with this number
+          of equal-width bins (requires an additional pass over `D`).
+        - ndarray: Approximate index from streaming histograms with these
+          bin edges (e.g. quantiles of a sample of `D`).
+
+        For histograms, only counts per bin are kept in memory. Values in
+        the same bin are considered equal.
+
+    n_jobs : int, optional (default: 1)
+        Number of threads counting quadruples of different classes in
+        parallel (-1: use all CPUs). Only used for the exact index.
+
     Returns
     -------
     gamma : float
@@ -69,61 +208,30 @@ def goodman_kruskal_index(D:np.ndarray, classes:np.ndarray,
     io.check_valid_metric_parameter(metric)
     
     # Calculations
-    Q_c = 0.0
-    Q_d = 0.0
-    cls = np.unique(classes)
-    
-    # D_kl pairs in different classes
-    other = classes[:, np.newaxis] != classes[np.newaxis, :]
-    D_other = D[np.triu(other, 1)]
-    
-    for c in cls:
-        sel = classes == c
-        if np.sum(sel) > 1:
-            sel = sel[:, np.newaxis].astype(bool)
-            selD = np.logical_and(sel, sel.T)
-            # D_ij pairs within same class
-            D_self = D[np.triu(selD, 1).astype(bool).T].T
-        else:
-            # skip if there is only one item per class
-            continue
-        # D_kl pairs in different classes (D_other) are computed once for all c
-        D_full = np.append(D_self, D_other)
-
-        self_size = np.max(np.shape(D_self))
-        other_size = np.max(np.shape(D_other))
-        # Sort algorithm must be stable!
-        full_idx = np.argsort(D_full, kind='mergesort')[::-1]
-        
-        # Calc number of quadruples with equal distance
-        n_equidistant = 0
-        sdf = np.sort(D_full, axis=None)
-        equi_mask = np.zeros(sdf.size, dtype=bool)
-        # Positions with repeated values
-        equi_mask[1:] = sdf[1:] == sdf[:-1]
-        equi_dist = sdf[equi_mask]
-        # How often does each value occur in self/other:
-        for dist in np.unique(equi_dist):
-            equi_arg = np.where(D_full == dist)[0]
-            self_equi = (equi_arg < self_size).sum()
-            other_equi = len(equi_arg) - self_equi
-            # Number of dc that are actually equal
-            n_equidistant += self_equi * other_equi
-
-        # Calc number of concordant quadruples
-        cc = 0
-        ccsize = other_size
-        for idx in full_idx:
-            if idx < self_size:
-                cc += ccsize
-            else:
-                ccsize -= 1
-
-        # Calc number of discordant quadruples
-        dc = self_size * other_size - cc - n_equidistant
-
-        Q_c += cc
-        Q_d += dc
+    _, inv = np.unique(classes, return_inverse=True)
+    order = np.argsort(inv, kind='stable')
+    n_c = np.bincount(inv)
+    if bins is not None:
+        Q_c, Q_d = _gk_histogram(D, inv, order, batch_size, bins)
+    else:
+        # Gather values: within-class values are contiguous per class
+        n_self = n_c * (n_c - 1) // 2
+        n_other = (inv.size**2 - np.sum(n_c**2)) // 2
+        D_self = np.empty(n_self.sum(), dtype=D.dtype)
+        D_other = np.empty(n_other, dtype=D.dtype)
+        i_self = 0
+        i_other = 0
+        for within, between in _label_sorted_blocks(D, inv, order,
+                                                    batch_size):
+            D_self[i_self:i_self + within.size] = within
+            D_other[i_other:i_other + between.size] = between
+            i_self += within.size
+            i_other += between.size
+        # D_kl pairs in different classes, sorted once for all classes
+        D_other.sort()
+        # Classes with only one item have no within-class values
+        offsets = np.concatenate(([0], np.cumsum(n_self)))
+        Q_c, Q_d = _count_per_class(D_self, offsets, D_other, n_jobs)
     
     # Calc Goodman-Kruskal's gamma
     if Q_c + Q_d == 0:
@@ -138,7 +246,8 @@ def goodman_kruskal_index(D:np.ndarray, classes:np.ndarray,
 
 def sparse_goodman_kruskal_index(S:csr_matrix, classes:np.ndarray, 
                                  metric='similarity', zero_mv:bool=False, 
-                                 heuristic:str=None, verbose:int=0) -> float:
+                                 heuristic:str=None, verbose:int=0,
+                                 n_jobs:int=1) -> float:
     """Calculate the Goodman-Kruskal clustering index.
     
     Parameters
@@ -171,6 +280,10 @@ def sparse_goodman_kruskal_index(S:csr_matrix, classes:np.ndarray,
     verbose : int, optional (default: 0)
         Increasing level of output (progress report).
 
+    n_jobs : int, optional (default: 1)
+        Number of threads counting quadruples of different classes in
+        parallel (-1: use all CPUs).
+
     Returns
     -------
     gamma : float
@@ -213,140 +326,71 @@ def sparse_goodman_kruskal_index(S:csr_matrix, classes:np.ndarray,
         sys.stdout.write("----------------------")
         print(flush=True)
     # Calculations
-    Qc = 0.0
-    Qd = 0.0
-    n = classes.size
-    
-    # S_kl pairs in different classes
-    S_other_list = lil_matrix((n, n))
-    other_nnz = 0
-    # building the complete mask at once would result in dense N x N matrix
+    _, inv = np.unique(classes, return_inverse=True)
+    n_c = np.bincount(inv)
+    # Number of all (incl. zero) pairs within classes and between classes
+    self_size = int(np.sum(n_c * (n_c - 1) // 2))
+    other_size = int((classes.size**2 - np.sum(n_c**2)) // 2)
+
+    # Upper triangle nonzeros, split by labels of row/col in one pass
     if verbose >= 2:
-        print("Finding S_kl pairs with different class labels...", 
+        print("Finding S_ij/S_kl pairs with equal/different class labels...",
               end=' ', flush=True)
-    for i, c in enumerate(classes):
-        cur_other = csr_matrix((c != classes)[i+1:])
-        other_nnz += cur_other.nnz
-        S_other_list[i, :cur_other.shape[1]] = \
-            S[i, i+1:].multiply(cur_other)
-    n_other_zeros = other_nnz - S_other_list.nnz
-    # The following might be achieved faster w/o csr intermediate
-    S_other = S_other_list.tocsr().data
-    del S_other_list, cur_other
+    S_triu = triu(S, k=1, format='csr')
+    S_triu.eliminate_zeros()
+    S_triu = S_triu.tocoo()
+    same = inv[S_triu.row] == inv[S_triu.col]
+    # Within-class values grouped by class
+    self_class = inv[S_triu.row[same]]
+    S_self = S_triu.data[same][np.argsort(self_class, kind='stable')]
+    self_offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(self_class, minlength=n_c.size))))
+    S_other = S_triu.data[~same]
+    del S_triu, same, self_class
+    self_data_size = S_self.size
+    other_data_size = S_other.size
+    n_self_zeros = self_size - self_data_size
+    n_other_zeros = other_size - other_data_size
     if verbose >= 2:
         print("done.", flush=True)
-    
-    cls = np.unique(classes)
-    for c in cls:
-        if verbose == 1:# and c % 10 == 0:
-            # end='\r' does not work with jupyter notebook
-            print("Class: {}/{}".format(c, len(cls)), end='')
-        sel = classes == c
-        if np.sum(sel) > 1:
-            if verbose >= 2:
-                print("Finding S_ij pairs for class {}..."
-                      .format(c), end=' ')
-            n = sel.size
-            # intra-class distances
-            S_self_list = lil_matrix((n, n))
-            self_nnz = 0
-            
-            # Only visit points of self class
-            sel_arg = np.where(sel > 0)[0]
-            for i in sel_arg:
-                cur_self = csr_matrix(sel[i+1:])
-                self_nnz += cur_self.nnz
-                S_self_list[i, :cur_self.shape[1]] = \
-                    S[i, i+1:].multiply(cur_self)
-            
-            n_self_zeros = self_nnz - S_self_list.nnz
-            # Same as with S_other
-            S_self = S_self_list.tocsr().data
-            del S_self_list, cur_self
-            if verbose >= 2:
-                print("done.")
-        else:
-            # skip if there is only one item per class
-            if verbose == 1: # and c % 10 == 0:
-                sys.stdout.write('\r')
-            continue
-        
-        # S_kl pairs in different classes are computed once for all c
-        if verbose >= 2:
-            print("Sorting data...", end=' ')
-        S_full_data = np.append(S_self, S_other)
-        
-        self_data_size = S_self.size
-        self_size = S_self.size + n_self_zeros
-        other_data_size = S_other.size
-        other_size = S_other.size + n_other_zeros
-        full_data_idx = np.argsort(S_full_data, kind='mergesort')[::-1]
-        del S_self
-        if verbose >= 2:
-            print("done.", flush=True)
-        
-        # Calc number of quadruples with equal distance
-        if verbose >= 2:
-            print("Calculating number of quadruples with equal distance...", 
-                  end=' ')
+
+    # S_kl pairs in different classes are sorted once for all classes
+    if verbose >= 2:
+        print("Sorting data...", end=' ', flush=True)
+    S_other.sort()
+    if verbose >= 2:
+        print("done.", flush=True)
+
+    # Number of smaller S_kl (concordant) and equal S_kl for each S_ij
+    if verbose >= 2:
+        print("Calculating number of concordant quadruples...", end=' ')
+    n_greater, n_less = _count_per_class(S_self, self_offsets, S_other,
+                                         n_jobs)
+    cc = n_greater
+    if not zero_mv:
+        # Zero S_kl (not stored) are smaller than any stored S_ij
+        cc += self_data_size * n_other_zeros
+    if heuristic == 'equal_sim':
         n_equidistant = 0
+    else:
+        n_equidistant = self_data_size * other_data_size - n_greater - n_less
+    del S_self, S_other
+    if verbose >= 2:
+        print("done.", flush=True)
+
+    # Calc number of discordant quadruples
+    if verbose >= 2:
+        print("Calculating number of discordant quadruples...", end=' ')
+    if zero_mv:
+        dc = self_data_size * other_data_size - cc - n_equidistant
+    else:
         # Number of equal zero similarities
-        if zero_mv:
-            n_zero = 0
-        else:
-            n_zero = n_self_zeros * n_other_zeros
-        if heuristic == 'equal_sim':
-            if verbose >= 2:
-                print("OMITTED (heuristic).")
-            else:
-                pass
-        else:
-            sdf = np.sort(S_full_data, axis=None)
-            equi_mask = np.zeros(sdf.size, dtype=bool)
-            # Positions with repeated values
-            equi_mask[1:] = sdf[1:] == sdf[:-1]
-            equi_dist = sdf[equi_mask]
-            equi_arg = 0
-            # How often does each value occur in self/other:
-            for dist in np.unique(equi_dist):
-                equi_arg = np.where(S_full_data == dist)[0]
-                self_equi = (equi_arg < self_data_size).sum()
-                other_equi = len(equi_arg) - self_equi
-                # Number of dc that are actually equal
-                n_equidistant += self_equi * other_equi
-            del S_full_data, equi_mask, equi_dist, equi_arg
-            if verbose >= 2:
-                print("done.", flush=True)
-        
-        # Calc number of concordant quadruples
-        if verbose >= 2:
-            print("Calculating number of concordant quadruples...", end=' ')
-        cc = 0
-        if zero_mv:
-            ccsize = other_data_size
-        else:
-            ccsize = other_size
-        for idx in full_data_idx:
-            if idx < self_data_size:
-                cc += ccsize
-            else:
-                ccsize -= 1
-        if verbose >= 2:
-            print("done.", flush=True)
-        
-        # Calc number of discordant quadruples
-        if verbose >= 2:
-            print("Calculating number of discordant quadruples...", end=' ')
-        if zero_mv:
-            dc = self_data_size * other_data_size - cc - n_equidistant
-        else:
-            dc = self_size * other_size - cc - n_equidistant - n_zero
-        Qc += cc
-        Qd += dc
-        if verbose >= 2:
-            print("done.", flush=True)
-        if verbose == 1: # and c % 10 == 0:
-            sys.stdout.write('\r')
+        n_zero = n_self_zeros * n_other_zeros
+        dc = self_size * other_size - cc - n_equidistant - n_zero
+    Qc = cc
+    Qd = dc
+    if verbose >= 2:
+        print("done.", flush=True)
     
     # Calc Goodman-Kruskal's gamma
     if verbose >= 2:
@@ -367,6 +411,177 @@ def sparse_goodman_kruskal_index(S:csr_matrix, classes:np.ndarray,
         print("done.", flush=True)
     return gamma
 
+def _sample_pairs(inv, n_pairs, within, random_state):
+    """ Draw `n_pairs` uniformly random within- or between-class pairs.
+
+    Returns None, if there are no such pairs.
+    """
+    n = inv.size
+    n_c = np.bincount(inv)
+    if within:
+        n_pairs_c = n_c * (n_c - 1) / 2.
+        if n_pairs_c.sum() == 0:
+            return None
+        # Class with probability proportional to its number of pairs,
+        # then two distinct members of this class
+        members = np.argsort(inv, kind='stable')
+        start = np.cumsum(n_c) - n_c
+        c = random_state.choice(n_c.size, size=n_pairs,
+                                p=n_pairs_c / n_pairs_c.sum())
+        a = random_state.randint(0, n_c[c])
+        b = random_state.randint(0, n_c[c] - 1)
+        b[b >= a] += 1
+        return members[start[c] + a], members[start[c] + b]
+    if n_c.max() == n:
+        return None
+    # Rejection sampling of objects from different classes
+    p_accept = 1. - np.sum((n_c / n)**2)
+    rows = []
+    cols = []
+    n_drawn = 0
+    while n_drawn < n_pairs:
+        size = int((n_pairs - n_drawn) / p_accept * 1.1) + 16
+        i = random_state.randint(0, n, size)
+        j = random_state.randint(0, n, size)
+        valid = inv[i] != inv[j]
+        rows.append(i[valid])
+        cols.append(j[valid])
+        n_drawn += valid.sum()
+    return (np.concatenate(rows)[:n_pairs], np.concatenate(cols)[:n_pairs])
+
+def _pair_values(D, rows, cols):
+    """ Values `D[rows[i], cols[i]]` of a dense (memmap) or sparse matrix """
+    if issparse(D):
+        return np.asarray(D.tocsr()[rows, cols]).ravel()
+    return np.asarray(D[rows, cols])
+
+def sampled_goodman_kruskal_index(D, classes:np.ndarray, metric:str='distance',
+                                  n_pairs:int=100000, ci:str='normal',
+                                  n_boot:int=200, alpha:float=0.05,
+                                  random_state=None):
+    """Estimate the Goodman-Kruskal index from randomly sampled pairs.
+
+    Within-class pairs and between-class pairs are drawn uniformly (with
+    replacement) and all quadruples of the two samples are evaluated.
+    Runtime and memory are independent of the number of objects.
+
+    Parameters
+    ----------
+    D : ndarray or csr_matrix
+        The ``n x n`` symmetric distance (similarity) matrix. Dense `D`
+        may be a memory map.
+
+    classes : ndarray
+        The ``1 x n`` vector of class labels for each point.
+
+    metric : {'distance', 'similarity'}, optional (default: 'distance')
+        Define, whether the matrix `D` is a distance or similarity matrix
+
+    n_pairs : int, optional (default: 100000)
+        Pair budget: number of sampled within-class pairs and of sampled
+        between-class pairs (each).
+
+    ci : {'normal', 'bootstrap'}, optional (default: 'normal')
+        Confidence interval from the normal approximation (delta method
+        for the two-sample U-statistics), or from `n_boot` bootstrap
+        resamples of both pair samples (percentile method).
+
+    n_boot : int, optional (default: 200)
+        Number of bootstrap resamples (only used with ``ci='bootstrap'``)
+
+    alpha : float, optional (default: 0.05)
+        Confidence interval at level ``1 - alpha``
+
+    random_state : int, RandomState instance or None, optional (default: None)
+        Seed or random number generator for reproducible estimates.
+
+    Returns
+    -------
+    gamma : float
+        Estimated Goodman-Kruskal index in ``[-1, 1]`` (higher=better)
+
+    interval : tuple of float
+        Lower and upper confidence bound of `gamma`
+
+    See also
+    --------
+    goodman_kruskal_index : exact index
+    """
+    # Checking input
+    io.check_distance_matrix_shape(D)
+    io.check_distance_matrix_shape_fits_labels(D, classes)
+    io.check_valid_metric_parameter(metric)
+    if ci not in ['normal', 'bootstrap']:
+        raise ValueError("Unknown confidence interval method '{}'. "
+                         "Must be 'normal' or 'bootstrap'.".format(ci))
+    random_state = check_random_state(random_state)
+
+    # Sample pairs
+    _, inv = np.unique(classes, return_inverse=True)
+    pairs_self = _sample_pairs(inv, n_pairs, True, random_state)
+    pairs_other = _sample_pairs(inv, n_pairs, False, random_state)
+    if pairs_self is None or pairs_other is None:
+        return 0.0, (0.0, 0.0)
+    D_self = _pair_values(D, *pairs_self)
+    D_other = np.sort(_pair_values(D, *pairs_other))
+
+    # Per sampled D_ij: number of smaller/larger sampled D_kl
+    left = np.searchsorted(D_other, D_self, side='left')
+    right = np.searchsorted(D_other, D_self, side='right')
+    n_less = left
+    n_greater = D_other.size - right
+    # Concordant: D_ij < D_kl for distances, D_ij > D_kl for similarities
+    if metric == 'similarity':
+        n_conc, n_disc = n_less, n_greater
+    else:
+        n_conc, n_disc = n_greater, n_less
+    Q_c = n_conc.sum(dtype=np.float64)
+    Q_d = n_disc.sum(dtype=np.float64)
+    if Q_c + Q_d == 0:
+        return 0.0, (0.0, 0.0)
+    gamma = (Q_c - Q_d) / (Q_c + Q_d)
+
+    if ci == 'bootstrap':
+        # Resampling both samples amounts to multinomial weights:
+        # Q_c* = sum_i w_i * (weight of D_kl smaller/larger than D_ij)
+        boot = np.empty(n_boot)
+        n_s, n_o = D_self.size, D_other.size
+        for b in range(n_boot):
+            w_self = np.bincount(random_state.randint(0, n_s, n_s),
+                                 minlength=n_s)
+            w_other = np.concatenate(([0], np.cumsum(np.bincount(
+                random_state.randint(0, n_o, n_o), minlength=n_o))))
+            below = w_other[left]
+            above = w_other[-1] - w_other[right]
+            if metric == 'similarity':
+                q_c, q_d = w_self @ below, w_self @ above
+            else:
+                q_c, q_d = w_self @ above, w_self @ below
+            boot[b] = (q_c - q_d) / (q_c + q_d) if q_c + q_d else 0.
+        low, high = np.percentile(boot, [100 * alpha / 2,
+                                         100 * (1 - alpha / 2)])
+    else:
+        # Delta method for gamma = P/T, with P (T) the mean sign (non-tie
+        # indicator) kernel, from the influence of each sampled pair
+        n_s, n_o = D_self.size, D_other.size
+        P = (Q_c - Q_d) / (n_s * n_o)
+        T = (Q_c + Q_d) / (n_s * n_o)
+        psi_self = ((n_conc - n_disc) - gamma * (n_conc + n_disc)) / n_o
+        # For each D_kl: number of smaller/larger D_ij
+        D_self_sorted = np.sort(D_self)
+        o_less = np.searchsorted(D_self_sorted, D_other, side='left')
+        o_greater = n_s - np.searchsorted(D_self_sorted, D_other,
+                                          side='right')
+        if metric == 'similarity':
+            o_conc, o_disc = o_greater, o_less
+        else:
+            o_conc, o_disc = o_less, o_greater
+        psi_other = ((o_conc - o_disc) - gamma * (o_conc + o_disc)) / n_s
+        var = (psi_self.var() / n_s + psi_other.var() / n_o) / T**2
+        z = norm.ppf(1 - alpha / 2)
+        low, high = P / T - z * np.sqrt(var), P / T + z * np.sqrt(var)
+    return float(gamma), (float(max(low, -1.)), float(min(high, 1.)))
+
 def _naive_goodman_kruskal(D:np.ndarray, labels:np.ndarray, metric='distance'):
     """Calculate Goodman-Kruskal's gamma (slow naive implementation)
     
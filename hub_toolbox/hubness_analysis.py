@@ -18,7 +18,8 @@ from hub_toolbox.centering import centering, weighted_centering, \
 from hub_toolbox.distances import cosine_distance
 from hub_toolbox.global_scaling import mutual_proximity_empiric, \
     mutual_proximity_gammai, mutual_proximity_gaussi
-from hub_toolbox.goodman_kruskal import goodman_kruskal_index
+from hub_toolbox.goodman_kruskal import goodman_kruskal_index, \
+    sampled_goodman_kruskal_index
 from hub_toolbox.hubness import hubness
 from hub_toolbox.intrinsic_dimension import intrinsic_dimension
 from hub_toolbox.knn_classification import score
@@ -168,6 +169,7 @@ class HubnessAnalysis:
 
     def analyze_hubness(self, experiments="orig,mp,mp_gaussi,nicdm,cent,dsg",
                         hubness_k=(5, 10), knn_k=(1, 5, 20),
+                        gk_pairs: int = None, random_state=None,
                         print_results=True, verbose: int = 0):
         """Analyse hubness in original data and rescaled distances.
 
@@ -196,6 +198,14 @@ class HubnessAnalysis:
         knn_k : tuple, optional (default: (1, 5, 20))
             `k`-NN classification parameter
 
+        gk_pairs : int, optional (default: None)
+            If None, calculate the exact Goodman-Kruskal index. Otherwise,
+            estimate it from this number of sampled within-class and
+            between-class pairs (bounded time for large data sets).
+
+        random_state : int, RandomState instance or None, optional
+            Seed for sampling pairs (only used with `gk_pairs`)
+
         print_results : bool, optional (default: True)
             Define whether to print hubness analysis report to stdout
 
@@ -227,7 +237,8 @@ class HubnessAnalysis:
             if self.classes is not None:
                 for k in knn_k:
                     experiment._calc_knn_accuracy(k=k)
-                experiment._calc_gk_index()
+                experiment._calc_gk_index(n_pairs=gk_pairs,
+                                          random_state=random_state)
             self.experiments.append(experiment)
             if print_results:
                 self.print_analysis_report(experiment, report_nr=i)
@@ -298,9 +309,13 @@ class HubnessAnalysis:
             if experiment.gk_index is None:
                 print('Goodman-Kruskal index (higher=better)    : '
                       'No classes given/Not calculated')
-            else:
+            elif experiment.gk_interval is None:
                 print('Goodman-Kruskal index (higher=better)    : {:.3}'.
                       format(experiment.gk_index))
+            else:
+                print('Goodman-Kruskal index (higher=better)    : {:.3} '
+                      '(95% CI: [{:.3}, {:.3}], sampled)'.
+                      format(experiment.gk_index, *experiment.gk_interval))
             # Embedding dimension
             if self.vectors is None:
                 print('embedding dimensionality                 : '
@@ -351,6 +366,7 @@ class HubnessExperiment:
         self.max_hub_k_occurence = dict()
         self.knn_accuracy = dict()
         self.gk_index = None
+        self.gk_interval = None
 
     def _calc_secondary_distance(self):
         """Calculate secondary distances (e.g. Mutual Proximity)"""
@@ -391,11 +407,21 @@ class HubnessExperiment:
         self.knn_accuracy[k] = acc
         return self
 
-    def _calc_gk_index(self):
-        """Calculate Goodman-Kruskal's gamma."""
-        self.gk_index = goodman_kruskal_index(D=self.secondary_distance,
-                                              classes=self.classes,
-                                              metric=self.metric)
+    def _calc_gk_index(self, n_pairs: int = None, random_state=None):
+        """Calculate Goodman-Kruskal's gamma.
+
+        If `n_pairs` is given, estimate gamma and its 95% confidence interval
+        from sampled pairs.
+        """
+        if n_pairs is None:
+            self.gk_index = goodman_kruskal_index(D=self.secondary_distance,
+                                                  classes=self.classes,
+                                                  metric=self.metric)
+        else:
+            self.gk_index, self.gk_interval = sampled_goodman_kruskal_index(
+                D=self.secondary_distance, classes=self.classes,
+                metric=self.metric, n_pairs=n_pairs,
+                random_state=random_state)
         return self
 
 
@@ -17,21 +17,161 @@ Reference:  E. Levina and P.J. Bickel (2005).
  "Maximum Likelihood Estimation  of Intrinsic Dimension."
  In Advances in NIPS 17, Eds. L. K. Saul, Y. Weiss, L. Bottou.
 """
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from scipy.sparse import issparse
+from sklearn.utils.validation import check_random_state
 
 __all__ = ['intrinsic_dimension']
 
+def _run_blocks(func, n, batch_size, n_jobs):
+    """ Call `func` on slices of ``range(n)``, in `n_jobs` threads """
+    blocks = [slice(i, min(i + batch_size, n))
+              for i in range(0, n, batch_size)]
+    if n_jobs > 1 and len(blocks) > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            pool.map(func, blocks)
+    else:
+        for block in blocks:
+            func(block)
+
+def _knn_block(block, X, X2, k2, query, out):
+    """ Squared distances of `query[block]` to their `k2` nearest neighbors.
+
+    One GEMM per block with precomputed squared norms. Only the ``k2 + 1``
+    smallest values per row are selected (partition) and sorted. The
+    smallest one (self distance) is dropped.
+    """
+    rows = query[block]
+    distance = X2[rows, np.newaxis] + X2 - 2 * np.dot(X[rows], X.T)
+    distance = np.partition(distance, k2, axis=1)[:, :k2+1]
+    distance.sort(axis=1)
+    out[block] = distance[:, 1:]
+
+def _knn_sq_distances(X, k2, batch_size, n_jobs=1, query=None):
+    """ Sorted squared distances to the `k2` nearest neighbors (w/o self).
+
+    Distances of the `query` objects (default: all) to all objects are
+    computed in blocks of `batch_size` rows, so that memory is proportional
+    to ``batch_size * n`` (per job).
+    """
+    if query is None:
+        query = np.arange(X.shape[0])
+    X2 = (X**2).sum(1)
+    out = np.empty((query.size, k2))
+    func = partial(_knn_block, X=X, X2=X2, k2=k2, query=query, out=out)
+    _run_blocks(func, query.size, batch_size, n_jobs)
+    return out
+
+def _knn_precomputed_block(block, D, k2, query, out):
+    """ Distances of `query[block]` to their `k2` nearest neighbors """
+    rows = query[block]
+    distance = np.array(D[rows], dtype=float)
+    distance[np.arange(rows.size), rows] = np.inf
+    distance = np.partition(distance, k2 - 1, axis=1)[:, :k2]
+    distance.sort(axis=1)
+    out[block] = distance
+
+def _knn_precomputed(D, k2, batch_size, n_jobs=1, query=None):
+    """ Sorted distances to the `k2` nearest neighbors (w/o self).
+
+    `D` may be an ``n x n`` dense (possibly memory-mapped) or sparse
+    distance matrix, or an ``n x k`` array of sorted neighbor distances.
+    In sparse matrices, missing entries are no neighbors. Only rows of the
+    `query` objects (default: all) are used.
+    """
+    n = D.shape[0]
+    if query is None:
+        query = np.arange(n)
+    if issparse(D):
+        D = D.tocsr()[query].tocoo()
+        not_self = D.col != query[D.row]
+        row = D.row[not_self]
+        data = D.data[not_self].astype(float)
+        n_neighbors = np.bincount(row, minlength=query.size)
+        if n_neighbors.min() < k2:
+            raise ValueError("Sparse distance matrix must contain at least "
+                             "k2={} neighbors per object.".format(k2))
+        order = np.lexsort((data, row))
+        start = np.cumsum(n_neighbors) - n_neighbors
+        return data[order][start[:, np.newaxis] + np.arange(k2)]
+    elif D.shape[1] != n:
+        if D.shape[1] < k2:
+            raise ValueError("Neighbor distance array must contain at least "
+                             "k2={} neighbors per object.".format(k2))
+        return np.sort(np.asarray(D[query], dtype=float)[:, :k2], axis=1)
+    out = np.empty((query.size, k2))
+    func = partial(_knn_precomputed_block, D=D, k2=k2, query=query, out=out)
+    _run_blocks(func, query.size, batch_size, n_jobs)
+    return out
+
+def _mle(distance, k1, k2, estimator):
+    """ ML estimate from squared distances to the `k2` nearest neighbors """
+    # Matrix of log nearest neighbor distances
+    # Replace invalid values with a small number
+    distance[distance <= 0] = 1e-7
+    knnmatrix = .5 * np.log(distance)
+
+    # Compute the ML estimate
+    S = np.cumsum(knnmatrix, 1)
+    indexk = np.arange(k1, k2+1) # broadcasted afterwards
+    dhat = -(indexk - 2) / (S[:, k1-1:k2] - knnmatrix[:, k1-1:k2] * indexk)
+    if estimator == 'levina':
+        # Average over estimates and over values of k
+        no_dims = dhat.mean()
+    if estimator == 'mackay':
+        # Average over inverses
+        dhat **= -1
+        dhat_k = dhat.mean(0)
+        no_dims = (dhat_k ** -1).mean()
+    return no_dims
+
+def _sampled_mle(seed, X, k1, k2, estimator, metric, n_queries, n_reference,
+                 replace, batch_size, n_jobs):
+    """ ML estimate from randomly drawn query (and reference) objects.
+
+    Queries are drawn from the reference objects, so that each query is
+    its own nearest neighbor (which is excluded).
+    """
+    random_state = np.random.RandomState(seed)
+    n = X.shape[0]
+    if n_reference is not None and n_reference < n:
+        ref = np.sort(random_state.choice(n, n_reference, replace=False))
+        if metric == 'distance':
+            X = X[np.ix_(ref, ref)]
+        else:
+            X = X[ref]
+        n = n_reference
+    if n_queries is None:
+        n_queries = n
+    query = random_state.choice(n, n_queries, replace=replace)
+    if metric == 'vector':
+        distance = _knn_sq_distances(X, k2, batch_size, n_jobs, query)
+    else:
+        distance = _knn_precomputed(X, k2, batch_size, n_jobs, query)**2
+    return _mle(distance, k1, k2, estimator)
+
 def intrinsic_dimension(X:np.ndarray, k1:int=6, k2:int=12,
                         estimator:str='mackay', metric:str='vector',
-                        trafo:str=None, mem_threshold:int=5000):
+                        trafo:str=None, mem_threshold:int=5000,
+                        batch_size:int=1024, n_jobs:int=1,
+                        n_queries:int=None, n_reference:int=None,
+                        n_boot:int=None, random_state=None):
     """Calculate intrinsic dimension based on the MLE by Levina and Bickel [1]_.
 
     Parameters
     ----------
-    X : ndarray
-        - An ``m x n`` vector data matrix with ``n`` objects in an
+    X : ndarray or csr_matrix
+        - An ``n x m`` vector data matrix with ``n`` objects in an
           ``m`` dimensional feature space
-        - An ``n x n`` distance matrix.
+        - An ``n x n`` dense (possibly memory-mapped) or sparse distance
+          matrix. Sparse matrices must contain at least `k2` neighbors per
+          object (e.g. a kNN graph). Self distances are ignored.
+        - An ``n x k`` array of neighbor distances (``k >= k2``), excluding
+          self distances, for example from
+          :func:`hub_toolbox.local_scaling.k_neighbor_distances`.
 
         NOTE: The type must be defined via parameter `metric`!
 
@@ -45,13 +185,15 @@ def intrinsic_dimension(X:np.ndarray, k1:int=6, k2:int=12,
         Determine the summation strategy: see [2]_.
 
     metric : {'vector', 'distance'}, optional (default: 'vector')
-        Determine data type of `X`.
+        Determine data type of `X`. With 'distance', `X` is interpreted as
+        ``n x n`` matrix, if it is square, and as neighbor distances
+        otherwise.
 
         NOTE: the MLE was derived for euclidean distances. Using
         other dissimilarity measures may lead to undefined results.
 
     trafo : {None, 'std', 'var'}, optional (default: None)
-        Transform vector data. 
+        Transform vector data (ignored for distances).
 
         - None: no transformation
         - 'std': standardization
@@ -62,12 +204,44 @@ def intrinsic_dimension(X:np.ndarray, k1:int=6, k2:int=12,
     mem_treshold : int, optional, default: 5000
         Controls speed-memory usage trade-off: If number of points is higher
         than the given value, don't calculate complete distance matrix at
-        once (fast, high memory), but per row (slower, less memory).
+        once (fast, high memory), but in blocks of `batch_size` rows
+        (memory proportional to ``batch_size * n``).
+
+    batch_size : int, optional (default: 1024)
+        Number of rows per block of distances (see `mem_threshold`)
+
+    n_jobs : int, optional (default: 1)
+        Number of threads computing blocks of distances (or bootstrap
+        draws) in parallel (-1: use all CPUs).
+
+    n_queries : int, optional (default: None)
+        Estimate from this number of randomly drawn query objects, whose
+        neighbors are searched among the reference objects. Default: all
+        (reference) objects.
+
+    n_reference : int, optional (default: None)
+        Search neighbors among this number of randomly drawn reference
+        objects (and draw queries among these). Default: all objects.
+        Not available for sparse distance matrices and arrays of neighbor
+        distances.
+
+    n_boot : int, optional (default: None)
+        If given, repeat the estimation for this number of bootstrap draws
+        (queries drawn with replacement) and return mean and variance.
+        Otherwise, queries are drawn without replacement.
+
+    random_state : int, RandomState instance or None, optional (default: None)
+        Seed for drawing query and reference objects.
 
     Returns
     -------
-    d_mle : int
-        Intrinsic dimension estimate (rounded to next integer)
+    d_mle : float
+        Intrinsic dimension estimate. Mean over bootstrap draws, if
+        `n_boot` is given.
+
+    d_var : float
+        Variance of the estimate over bootstrap draws (only returned, if
+        `n_boot` is given)
 
     References
     ----------
@@ -83,9 +257,15 @@ def intrinsic_dimension(X:np.ndarray, k1:int=6, k2:int=12,
         raise ValueError("Invalid neighborhood: Please make sure that "
                          "0 < k1 <= k2 < n. (Got k1={} and k2={}).".
                          format(k1, k2))
-    X = X.copy().astype(float)
+    if not n_jobs:
+        n_jobs = 1
+    elif n_jobs == -1:
+        n_jobs = cpu_count()
+    if n <= mem_threshold: # speed-memory trade-off
+        batch_size = n
 
     if metric == 'vector':
+        X = X.copy().astype(float)
         # New array with unique rows
         X = X[np.lexsort(np.fliplr(X).T)]
         
@@ -100,58 +280,50 @@ def intrinsic_dimension(X:np.ndarray, k1:int=6, k2:int=12,
             X /= X.std(axis=0) + 1e-7 # broadcast
         else:
             raise ValueError("Transformation must be None, 'std', or 'var'.")
-
-        # Compute matrix of log nearest neighbor distances
-        X2 = (X**2).sum(1)
-
-        if n <= mem_threshold: # speed-memory trade-off
-            distance = X2.reshape(-1, 1) + X2 - 2*np.dot(X, X.T) #2x br.cast
-            distance.sort(1)
-            # Replace invalid values with a small number
-            distance[distance<=0] = 1e-7
-            knnmatrix = .5 * np.log(distance[:, 1:k2+1])
-        else:
-            knnmatrix = np.zeros((n, k2))
-            for i in range(n):
-                distance = np.sort(X2[i] + X2 - 2 * np.dot(X, X[i, :]))
-                # Replace invalid values with a small number
-                distance[distance <= 0] = 1e-7
-                knnmatrix[i, :] = .5 * np.log(distance[1:k2+1])
     elif metric == 'distance':
-        raise NotImplementedError("ID currently only supports vector data.")
-        # XXX perhaps map to sufficiently high dim with MDS, then calc ID??
-        #=======================================================================
-        # # TODO calculation WRONG
-        # X.sort(1)
-        # X[X < 0] = 1e-7
-        # knnmatrix = np.log(X[:, 1:k2+1])
-        #=======================================================================
+        if n_reference is not None and issparse(X):
+            raise ValueError("Reference objects cannot be drawn for sparse "
+                             "distance matrices (kNN graphs), since most "
+                             "neighbors would be missing among them.")
+        if n_reference is not None and X.shape[1] != n:
+            raise ValueError("Reference objects cannot be drawn for arrays "
+                             "of neighbor distances.")
     elif metric == 'similarity':
-        raise NotImplementedError("ID currently only supports vector data.")
-        #=======================================================================
-        # # TODO calculation WRONG
-        # print("WARNING: using similarity data may return "
-        #       "undefined results.", file=sys.stderr)
-        # X[X < 0] = 0
-        # distance = 1 - (X / X.max())
-        # knnmatrix = np.log(distance[:, 1:k2+1])
-        #=======================================================================
+        raise NotImplementedError("The MLE of intrinsic dimension requires "
+                                  "vector data or distances.")
     else:
-        raise ValueError("Parameter `metric` must be 'vector'.")
+        raise ValueError("Parameter `metric` must be 'vector' or "
+                         "'distance'.")
 
-    # Compute the ML estimate
-    S = np.cumsum(knnmatrix, 1)
-    indexk = np.arange(k1, k2+1) # broadcasted afterwards
-    dhat = -(indexk - 2) / (S[:, k1-1:k2] - knnmatrix[:, k1-1:k2] * indexk)
-    if estimator == 'levina':
-        # Average over estimates and over values of k
-        no_dims = dhat.mean()
-    if estimator == 'mackay':
-        # Average over inverses
-        dhat **= -1
-        dhat_k = dhat.mean(0)
-        no_dims = (dhat_k ** -1).mean()
-    return no_dims
+    if n_queries is None and n_reference is None and n_boot is None:
+        # Exact estimate from all objects
+        if metric == 'vector':
+            distance = _knn_sq_distances(X, k2, batch_size, n_jobs)
+        else:
+            distance = _knn_precomputed(X, k2, batch_size, n_jobs)**2
+        return _mle(distance, k1, k2, estimator)
+
+    # Estimates from random subsets of objects (one seed per draw)
+    random_state = check_random_state(random_state)
+    if n_reference is not None and k2 >= n_reference:
+        raise ValueError("Invalid neighborhood: Please make sure that "
+                         "k2 < n_reference.")
+    sampled_mle = partial(_sampled_mle, X=X, k1=k1, k2=k2,
+                          estimator=estimator, metric=metric,
+                          n_queries=n_queries, n_reference=n_reference,
+                          batch_size=batch_size)
+    if n_boot is None:
+        seed = random_state.randint(np.iinfo(np.int32).max)
+        return float(sampled_mle(seed, replace=False, n_jobs=n_jobs))
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=n_boot)
+    sampled_mle = partial(sampled_mle, replace=True, n_jobs=1)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            estimates = np.array(pool.map(sampled_mle, seeds))
+    else:
+        estimates = np.array([sampled_mle(seed) for seed in seeds])
+    d_var = estimates.var(ddof=1) if n_boot > 1 else 0.
+    return float(estimates.mean()), float(d_var)
 
 if __name__ == '__main__':
     m_dim = 100
@@ -10,21 +10,137 @@ The HUB TOOLBOX is licensed under the terms of the GNU GPLv3.
 Austrian Research Institute for Artificial Intelligence (OFAI)
 Contact: <roman.feldbauer@ofai.at>
 """
-import ctypes
 from functools import partial
 import multiprocessing as mp
 import numpy as np
 from scipy.sparse.base import issparse
+from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing.label import LabelEncoder
+from sklearn.utils import check_random_state
 from hub_toolbox import io
 from hub_toolbox.htlogging import ConsoleLogging
 
-__all__ = ['score', 'predict', 'r_precision',
+__all__ = ['score', 'score_cv', 'predict', 'r_precision', 'retrieval_metrics',
+           'weighted_vote',
            'f1_score', 'f1_macro', 'f1_micro', 'f1_weighted']
 
+VALID_WEIGHTS = ['uniform', 'distance', 'rank']
+
+def weighted_vote(nn_labels:np.ndarray, nn_dist:np.ndarray=None,
+                  n_classes:int=None, weights:str='uniform',
+                  metric:str='distance', mask:np.ndarray=None,
+                  return_scores:bool=False):
+    """Predict class labels from the labels of (sorted) nearest neighbors.
+
+    Votes of a whole batch of queries are accumulated with a single
+    scatter-add into an ``n_batch x n_classes`` score array, so that
+    weighted voting costs no more than uniform (majority) voting.
+    Ties are broken by the nearest (valid) neighbor.
+
+    Parameters
+    ----------
+    nn_labels : ndarray, shape (n_batch, k), dtype=int
+        Class labels in ``0, 1, ..., n_classes-1`` of the `k` nearest
+        neighbors of each query, sorted by increasing distance
+        (decreasing similarity).
+
+    nn_dist : ndarray, shape (n_batch, k), optional (default: None)
+        Distances (similarities) from each query to its neighbors.
+        Required for ``weights='distance'``.
+
+    n_classes : int, optional (default: None)
+        Number of classes. Inferred from `nn_labels`, if None.
+
+    weights : {'uniform', 'distance', 'rank'} or callable, optional
+        Weight of each neighbor's vote (default: 'uniform'):
+
+        - 'uniform' : All neighbors are weighted equally (majority vote).
+        - 'distance' : Inverse distance, or the similarity itself for
+          ``metric='similarity'``. Neighbors at distance zero
+          outvote all other neighbors.
+        - 'rank' : Inverse rank ``1 / (r + 1)`` with ``r = 0`` for the
+          nearest neighbor.
+        - callable : Function of the `nn_dist` array, returning an array
+          of weights of the same shape (as in scikit-learn).
+
+    metric : {'distance', 'similarity'}, optional (default: 'distance')
+        Define, whether `nn_dist` contains distances or similarities.
+
+    mask : ndarray, shape (n_batch, k), dtype=bool, optional (default: None)
+        Valid neighbors. Invalid ones (e.g. padding, non-finite distances)
+        do not vote.
+
+    return_scores : bool, optional (default: False)
+        If True, also return the accumulated votes.
+
+    Returns
+    -------
+    y_pred : ndarray, shape (n_batch, ), dtype=int
+        Predicted class labels. Queries without any valid neighbor are
+        assigned the label ``-1``.
+
+    scores : ndarray, shape (n_batch, n_classes)
+        Accumulated (weighted) votes, only if `return_scores` is True.
+    """
+    io.check_valid_metric_parameter(metric)
+    if not callable(weights) and weights not in VALID_WEIGHTS:
+        raise ValueError("Parameter 'weights' must be one of {} or a "
+                         "callable. Got: {}".format(VALID_WEIGHTS, weights))
+    nn_labels = np.asarray(nn_labels, dtype=int)
+    if nn_labels.ndim == 1:
+        nn_labels = nn_labels[:, np.newaxis]
+    n_batch, k = nn_labels.shape
+    if mask is None:
+        mask = np.ones((n_batch, k), dtype=bool)
+    else:
+        mask = np.asarray(mask, dtype=bool)
+    if n_classes is None:
+        n_classes = nn_labels[mask].max() + 1 if mask.any() else 1
+
+    if weights == 'uniform':
+        w = mask.astype(float)
+    elif weights == 'rank':
+        w = np.broadcast_to(1. / np.arange(1, k + 1), (n_batch, k)) * mask
+    else:
+        if nn_dist is None:
+            raise ValueError("Distance weighting requires 'nn_dist'.")
+        d = np.asarray(nn_dist, dtype=float).reshape(n_batch, k)
+        if callable(weights):
+            w = np.where(mask, np.asarray(weights(d), dtype=float), 0.)
+        elif metric == 'similarity':
+            w = np.where(mask, d, 0.)
+        else:
+            with np.errstate(divide='ignore'):
+                w = np.where(mask, 1. / d, 0.)
+            # Exact duplicates (zero distance) dominate all other neighbors
+            zero_dist = np.isinf(w)
+            dup_rows = zero_dist.any(axis=1)
+            w[dup_rows] = zero_dist[dup_rows]
+
+    # Single scatter-add of all votes of the batch
+    flat_ind = np.arange(n_batch)[:, np.newaxis] * n_classes \
+        + np.where(mask, nn_labels, 0)
+    scores = np.bincount(flat_ind.ravel(), weights=w.ravel(),
+                         minlength=n_batch * n_classes)
+    scores = scores.reshape(n_batch, n_classes)
+
+    y_pred = scores.argmax(axis=1)
+    # "tie": use nearest neighbor
+    max_scores = scores[np.arange(n_batch), y_pred]
+    tie = (scores == max_scores[:, np.newaxis]).sum(axis=1) > 1
+    any_valid = mask.any(axis=1)
+    first_valid = mask.argmax(axis=1)
+    nearest = nn_labels[np.arange(n_batch), first_valid]
+    y_pred[tie] = nearest[tie]
+    y_pred[~any_valid] = -1
+    if return_scores:
+        return y_pred, scores
+    else:
+        return y_pred
+
 def score(D:np.ndarray, target:np.ndarray, k=5,
           metric:str='distance', test_set_ind:np.ndarray=None, verbose:int=0,
-          sample_idx=None, filter_self=True):
+          sample_idx=None, filter_self=True, weights:str='uniform'):
     """Perform `k`-nearest neighbor classification.
 
     Use the ``n x n`` symmetric distance matrix `D` and target class
@@ -70,7 +186,11 @@ def score(D:np.ndarray, target:np.ndarray, k=5,
         
         NOTE: Quadratic dense matrices are always filtered for self
         distances/similarities, even if `filter_self` is set t0 `False`.
-        
+
+    weights : {'uniform', 'distance', 'rank'}, optional (default: 'uniform')
+        Weighting of the neighbors' votes (see :func:`weighted_vote`).
+        'uniform' performs majority voting.
+
     Returns
     -------
     acc : ndarray (shape=(n_k x 1), dtype=float)
@@ -97,6 +217,9 @@ def score(D:np.ndarray, target:np.ndarray, k=5,
         io.check_sample_shape_fits(D, sample_idx)
     io.check_distance_matrix_shape_fits_labels(D, target)
     io.check_valid_metric_parameter(metric)
+    if weights not in VALID_WEIGHTS:
+        raise ValueError("Parameter 'weights' must be one of {}. Got: {}"
+                         .format(VALID_WEIGHTS, weights))
     if metric == 'distance':
         d_self = np.inf
         sort_order = 1
@@ -163,13 +286,17 @@ def score(D:np.ndarray, target:np.ndarray, k=5,
     cl = range(len(cl))
 
     rnd_classif = np.zeros(k_length)
+    # Labels, distances, and validity of the nearest neighbors per k value,
+    # collected for batch voting after the neighbor search
+    test_set_ind = np.asarray(test_set_ind)
+    nn_labels = [np.zeros((n, k_j), dtype=int) for k_j in k]
+    nn_dist = [np.zeros((n, k_j)) for k_j in k]
+    nn_valid = [np.zeros((n, k_j), dtype=bool) for k_j in k]
     # Classify each point in test set
-    for i in test_set_ind:
+    for p, i in enumerate(test_set_ind):
         if verbose and ((i+1)%1000==0 or i+1==n):
             log.message("Prediction: {} of {}.".format(i+1, n), flush=True)
 
-        seed_class = classes[i]
-
         if D_is_sparse:
             row = D.getrow(i)
         else:
@@ -211,39 +338,34 @@ def score(D:np.ndarray, target:np.ndarray, k=5,
         for j in range(k_length):
             # Make sure no inf/-inf/nan values are used for classification
             if D_is_sparse:
-                #print(row[0, idx[0:k[j]]].toarray())
-                finite_val = np.isfinite(row[0, idx[0:k[j]]].toarray().ravel())
-                #print(finite_val)
+                nn_d = row[0, idx[0:k[j]]].toarray().ravel()
             else:
-                finite_val = np.isfinite(row[idx[0:k[j]]])
+                nn_d = row[idx[0:k[j]]]
+            finite_val = np.isfinite(nn_d)
             # However, if no values are finite, classify randomly
             if finite_val.sum() == 0:
                 idx = np.random.permutation(idx)
                 finite_val = np.ones_like(finite_val)
                 rnd_classif[j] += 1
+            n_nn = finite_val.size
             if sample_idx is None:
-                nn_class = classes[idx[0:k[j]]][finite_val]
-            else:
-                #finite_val = np.isfinite(sample_row[idx[0:k[j]]])
-                nn_class = sample_classes[idx[0:k[j]]][finite_val]
-            cs = np.bincount(nn_class.astype(int))
-            if cs.size > 0:
-                max_cs = np.where(cs == np.max(cs))[0]
+                nn_labels[j][p, :n_nn] = classes[idx[0:k[j]]]
             else:
-                max_cs = np.array([len(cl) - 1]) # misclassification label
-
-            # "tie": use nearest neighbor
-            if len(max_cs) > 1:
-                if seed_class == nn_class[0]:
-                    acc[j] += 1/n 
-                    corr[j, i] = 1
-                cmat[j, seed_class, nn_class[0]] += 1
-            # majority vote
-            else:
-                if cl[max_cs[0]] == seed_class:
-                    acc[j] += 1/n
-                    corr[j, i] = 1
-                cmat[j, seed_class, cl[max_cs[0]]] += 1
+                nn_labels[j][p, :n_nn] = sample_classes[idx[0:k[j]]]
+            nn_dist[j][p, :n_nn] = nn_d
+            nn_valid[j][p, :n_nn] = finite_val
+
+    # Vote for all points in the test set at once
+    seed_class = classes[test_set_ind]
+    for j in range(k_length):
+        y_pred = weighted_vote(nn_labels[j], nn_dist[j], n_classes=len(cl),
+                               weights=weights, metric=metric,
+                               mask=nn_valid[j])
+        y_pred[y_pred == -1] = len(cl) - 1 # misclassification label
+        correct = y_pred == seed_class
+        acc[j] = correct.sum() / n
+        corr[j, test_set_ind] = correct
+        np.add.at(cmat[j], (seed_class, y_pred), 1)
 
     if np.any(rnd_classif):
         for x in rnd_classif:
@@ -448,92 +570,256 @@ def predict(D:np.ndarray, target:np.ndarray, k=5,
     else:
         return y_pred
 
+def score_cv(D:np.ndarray, target:np.ndarray, k=5, cv=5,
+             metric:str='distance', k_max:int=None, weights:str='uniform',
+             random_state=None, verbose:int=0, batch_size:int=256):
+    """Perform `k`-nearest neighbor classification for several test splits.
+
+    The neighbors of each object are sorted only once (up to `k_max`).
+    Each fold is then evaluated by masking out all neighbors that are not
+    part of its training set, so that cross-validation with many folds
+    and many values of `k` takes roughly one pass over `D`.
+
+    Parameters
+    ----------
+    D : ndarray or CSR matrix
+        The ``n x n`` symmetric distance (similarity) matrix. For sparse
+        matrices, only stored values are considered neighbors.
+
+    target : ndarray (of dtype=int)
+        The ``n x 1`` target class labels (ground truth).
+
+    k : int or array_like (of dtype=int), optional (default: 5)
+        Neighborhood size for `k`-NN classification.
+        For each value in `k`, one `k`-NN experiment is performed per fold.
+
+    cv : int, cross-validation generator or iterable, optional (default: 5)
+        Define the test splits. Can be:
+
+        - int : Number of folds for stratified `k`-fold cross-validation
+        - An object with a ``split(X, y)`` method, e.g. from
+          ``sklearn.model_selection``, for k-fold or repeated splits
+        - An iterable yielding (train, test) index arrays
+
+    metric : {'distance', 'similarity'}, optional (default: 'distance')
+        Define, whether matrix `D` is a distance or similarity matrix
+
+    k_max : int, optional (default: None)
+        Number of sorted neighbors per object. Must be large enough to
+        find ``max(k)`` training neighbors in every fold. If None, twice
+        the expected number of required neighbors is used.
+
+    weights : {'uniform', 'distance', 'rank'}, optional (default: 'uniform')
+        Weighting of the neighbors' votes (see :func:`weighted_vote`).
+
+    random_state : int, optional (default: None)
+        Seed for the folds (if `cv` is an int) and for breaking ties.
+
+    verbose : int, optional (default: 0)
+        Increasing level of output (progress report).
+
+    batch_size : int, optional (default: 256)
+        Number of rows of `D` that are sorted at once.
+
+    Returns
+    -------
+    acc : ndarray (shape=(n_folds x n_k), dtype=float)
+        Classification accuracy per fold and value of `k`.
+    """
+    log = ConsoleLogging()
+    io.check_distance_matrix_shape(D)
+    io.check_distance_matrix_shape_fits_labels(D, target)
+    io.check_valid_metric_parameter(metric)
+    if weights not in VALID_WEIGHTS:
+        raise ValueError("Parameter 'weights' must be one of {}. Got: {}"
+                         .format(VALID_WEIGHTS, weights))
+    n = D.shape[0]
+    k = np.atleast_1d(np.asarray(k, dtype=int))
+    if isinstance(cv, int):
+        cv = StratifiedKFold(n_splits=cv, shuffle=True,
+                             random_state=random_state)
+    if hasattr(cv, 'split'):
+        folds = list(cv.split(np.zeros((n, 1)), target))
+    else:
+        folds = list(cv)
+    if k_max is None:
+        max_test_size = max(test.size for _, test in folds)
+        k_max = int(2 * np.ceil(k.max() * n / (n - max_test_size)))
+    k_max = min(k_max, n - 1)
+    classes, y = np.unique(target, return_inverse=True)
+    if issparse(D):
+        D = D.tocsr()
+
+    # Sort the neighbors of all objects once
+    if verbose:
+        log.message("Sorting {} neighbors per object.".format(k_max))
+    rnd = check_random_state(random_state)
+    rp = rnd.permutation(n)
+    nn = np.zeros((n, k_max), dtype=int)
+    valid = np.zeros((n, k_max), dtype=bool)
+    values = np.zeros((n, k_max))
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        if issparse(D):
+            b_nn, b_valid, b_values = _sorted_neighbors_sparse(
+                D, start, stop, k_max, metric, rnd)
+        else:
+            b_nn, b_valid, b_values = _sorted_neighbors_dense(
+                D, start, stop, k_max, metric, rp)
+        nn[start:stop] = b_nn
+        valid[start:stop] = b_valid & np.isfinite(b_values)
+        values[start:stop] = b_values
+
+    # Evaluate each fold by masking neighbors outside its training set
+    acc = np.zeros((len(folds), k.size))
+    n_short = 0
+    for f, (train, test) in enumerate(folds):
+        if verbose:
+            log.message("Fold {} of {}.".format(f+1, len(folds)), flush=True)
+        in_train = np.zeros(n, dtype=bool)
+        in_train[train] = True
+        mask = valid[test] & in_train[nn[test]]
+        n_short += np.count_nonzero(mask.sum(axis=1) < k.max())
+        # Move training neighbors to the front, keeping their order
+        order = np.argsort(~mask, axis=1, kind='mergesort')
+        rows = np.arange(test.size)[:, np.newaxis]
+        f_labels = y[nn[test][rows, order]]
+        f_values = values[test][rows, order]
+        f_mask = mask[rows, order]
+        for j, k_j in enumerate(k):
+            y_pred = weighted_vote(f_labels[:, :k_j], f_values[:, :k_j],
+                                   n_classes=classes.size, weights=weights,
+                                   metric=metric, mask=f_mask[:, :k_j])
+            acc[f, j] = np.mean(y_pred == y[test])
+    if n_short:
+        log.warning(("{} queries had less than {} training neighbors among "
+                     "their {} nearest neighbors. Consider increasing "
+                     "'k_max'.").format(n_short, k.max(), k_max))
+    if verbose:
+        log.message("Finished k-NN cross-validation.")
+    return acc
+
 ##############################################################################
 #
 #  R - PRECISION
 #
-def _load_shared_csr(S_, y_, n_random_pred_, relevant_items_):
+def _load_shared_data(S_, y_, relevant_items_):
     """ Better yet: don't use shared CSR, but just inherit and use globals """
     global S
     S = S_
     global y
     y = y_
-    # Well, I don't understand, why it works for S and y this way,
-    #       but not for the others...
-    global n_random_pred
-    n_random_pred = n_random_pred_
     global relevant_items
     relevant_items = relevant_items_
 
-def _r_prec_worker(i, y_pred, incorrect, **kwargs):
-    true_class = y[i]
+def _r_prec_block_sparse(start, stop, S, y, relevant_items,
+                         y_pred, incorrect):
+    """ R-Precision of rows ``start:stop`` of sparse similarity matrix `S`.
+
+    All rows of the block are sorted at once: Nonzero similarities are
+    sorted by row (segment), then by decreasing similarity. Ties are
+    broken randomly. NaN values are sorted to the end of each segment.
+    """
+    n_rows = stop - start
+    lo, hi = S.indptr[start], S.indptr[stop]
+    data = S.data[lo:hi]
+    cols = S.indices[lo:hi]
+    row = np.repeat(np.arange(start, stop), np.diff(S.indptr[start:stop+1]))
+    order = np.lexsort((np.random.rand(data.size), -data, row))
+    data = data[order]
+    cols = cols[order]
+    row = row[order]
+    # Position of each value within its row (0: self similarity)
+    pos = np.arange(data.size) - (S.indptr[row] - lo)
+    true_class = y[row]
+    sel = (pos >= 1) & (pos <= relevant_items[true_class]) & ~np.isnan(data)
+    correct = sel & (y[cols] == true_class)
+    n_correct = np.bincount(row[correct] - start, minlength=n_rows)
+    n_finite = np.bincount(row[sel & np.isfinite(data)] - start,
+                           minlength=n_rows)
+    r_items = relevant_items[y[start:stop]]
+    r_prec = np.zeros(n_rows, dtype=float)
+    np.divide(n_correct, r_items, out=r_prec, where=r_items > 0)
+    n_random = np.count_nonzero((r_items > 0) & (n_finite == 0))
+    nn_labels = np.zeros((n_rows, y_pred), dtype=int) + incorrect
     if y_pred:
-        nn_labels = np.zeros(y_pred, dtype=int) + incorrect
-    if relevant_items[true_class] == 0:
-        if y_pred:
-            return 0., nn_labels
-        else:
-            return 0. # there can't be correct predictions...
-
-    # Get all nonzero similarities
-    row = S.getrow(i)
-    nnz = row.nnz
-    # Randomize to avoid problems arising from equal similarites
-    rp = np.random.permutation(nnz)
-    d2 = row.data[rp]
-    # Partition for each k value
-    kth = nnz - relevant_items[true_class] - 1
-    # sort the two highest similarities to end
-    kth = np.append(kth, [nnz-2, nnz-1])
-    # Clip negative indices (nnz < k)
-    np.clip(kth, a_min=0, a_max=nnz-1, out=kth)
-    # Remove duplicate k values and sort
-    kth = np.unique(kth)
-    # Get the relevant indices
-    d2idx = np.argpartition(d2, kth=kth)
-    # Filter indices pointing to NaN values and revert order
-    d2idx = d2idx[~np.isnan(d2[d2idx])][::-1]
-    # Indices of cells with highest similarities
-    idx = row.nonzero()[1][rp[d2idx]]
-    # Remove self similarity (i.e. highest sim)
-    idx = idx[1:relevant_items[true_class]+1]
-    # Check whether the values are finite
-    finite_val = np.isfinite(row[0, idx].toarray().ravel())
-
-    # However, if no values are finite, classify randomly
-    if finite_val.sum() == 0:
-        idx = np.random.permutation(idx)
-        finite_val = np.ones_like(finite_val)
-        with n_random_pred.get_lock():
-            n_random_pred.value += 1
-    
-    y_predicted = y[idx]
-    correct_pred = (y_predicted == true_class).sum()
-    if correct_pred == 0:
-        if y_pred:
-            return 0., nn_labels
-        else:
-            return 0.
+        sel &= pos <= y_pred
+        nn_labels[row[sel] - start, pos[sel] - 1] = y[cols[sel]]
+    return r_prec, nn_labels, n_random
+
+def _sorted_neighbors_dense(S, start, stop, k_max, metric, rp):
+    """ `k_max` nearest neighbors of rows ``start:stop`` of dense `S`.
+
+    Columns are visited in the random order `rp` to break ties randomly.
+    Self distances (similarities) and NaN values are marked invalid.
+
+    Returns
+    -------
+    nn, valid, values : ndarrays, shape (stop - start, k_max)
+        Sorted neighbor indices, their validity, and distances.
+    """
+    n_rows = stop - start
+    rows = np.arange(n_rows)[:, np.newaxis]
+    block = np.array(S[start:stop, :][:, rp], dtype=float)
+    # Sort key: ascending for distances, descending for similarities
+    if metric == 'similarity':
+        key = -block
     else:
-        if y_pred:
-            cur_nn_labels = y_predicted[:y_pred]
-            nn_labels[:cur_nn_labels.size] = cur_nn_labels
-            for i, label in enumerate(cur_nn_labels):
-                nn_labels[i] = label
-            return correct_pred / relevant_items[true_class], nn_labels
-        else:
-            return correct_pred / relevant_items[true_class]
+        key = block.copy()
+    valid = ~np.isnan(block)
+    key[~valid] = np.inf
+    self_col = np.argsort(rp)[start:stop]
+    key[rows.ravel(), self_col] = np.inf
+    valid[rows.ravel(), self_col] = False
+    k_max = min(k_max, block.shape[1])
+    nn = np.argpartition(key, kth=k_max-1, axis=1)[:, :k_max]
+    nn = nn[rows, np.argsort(key[rows, nn], axis=1)]
+    return rp[nn], valid[rows, nn], block[rows, nn]
+
+def _r_prec_block_dense(start, stop, S, y, relevant_items,
+                        y_pred, incorrect, metric, rp):
+    """ R-Precision of rows ``start:stop`` of dense matrix `S`. """
+    n_rows = stop - start
+    r_items = relevant_items[y[start:stop]]
+    k_max = r_items.max()
+    r_prec = np.zeros(n_rows, dtype=float)
+    nn_labels = np.zeros((n_rows, y_pred), dtype=int) + incorrect
+    if k_max == 0:
+        return r_prec, nn_labels, 0
+    nn, valid, values = _sorted_neighbors_dense(
+        S, start, stop, k_max, metric, rp)
+    sel = (np.arange(k_max) < r_items[:, np.newaxis]) & valid
+    nn_class = y[nn]
+    correct = sel & (nn_class == y[start:stop, np.newaxis])
+    np.divide(correct.sum(axis=1), r_items, out=r_prec, where=r_items > 0)
+    finite = sel & np.isfinite(values)
+    n_random = np.count_nonzero((r_items > 0) & ~finite.any(axis=1))
+    if y_pred:
+        n_nn = min(y_pred, k_max)
+        nn_labels[:, :n_nn] = np.where(
+            sel[:, :n_nn], nn_class[:, :n_nn], incorrect)
+    return r_prec, nn_labels, n_random
+
+def _r_prec_worker(start, batch_size, **kwargs):
+    stop = min(start + batch_size, S.shape[0])
+    if issparse(S):
+        r = _r_prec_block_sparse(start, stop, S, y, relevant_items, **kwargs)
+    else:
+        r = _r_prec_block_dense(start, stop, S, y, relevant_items, **kwargs)
+    return (start, stop, *r)
 
 
 def r_precision(S:np.ndarray, y:np.ndarray, metric:str='distance',
                 average:str='weighted', return_y_pred:int=0,
-                verbose:int=0, n_jobs:int=1) -> float:
+                verbose:int=0, n_jobs:int=1, batch_size:int=256) -> float:
     """ Calculate R-Precision (recall at R-th position).
 
     Parameters
     ----------
     S : ndarray or CSR matrix
-        Distance (similarity) matrix
+        Distance (similarity) matrix. Sparse matrices must contain
+        similarities, with the self similarity being the highest
+        similarity per row.
 
     y : ndarray
         Target (ground truth) labels
@@ -553,6 +839,9 @@ def r_precision(S:np.ndarray, y:np.ndarray, metric:str='distance',
     n_jobs : int, optional, default: 1
         Number of parallel processes to use.
 
+    batch_size : int, optional, default: 256
+        Number of rows of `S` that are evaluated at once.
+
     Returns
     -------
     r_precision : dictionary with following keys:
@@ -580,8 +869,10 @@ def r_precision(S:np.ndarray, y:np.ndarray, metric:str='distance',
     log = ConsoleLogging()
     n, _ = S.shape
     S_is_sparse = issparse(S)
-    if metric != 'similarity' or not S_is_sparse:
+    if metric != 'similarity' and S_is_sparse:
         raise NotImplementedError("Only sparse similarity matrices so far.")
+    if S_is_sparse:
+        S = S.tocsr()
 
     # Map labels to 0..n(labels)-1
     le = LabelEncoder()
@@ -589,52 +880,56 @@ def r_precision(S:np.ndarray, y:np.ndarray, metric:str='distance',
     incorr_orig = np.array([np.nan]).astype(int)
     le.fit(np.append(y, incorr_orig))
     y = le.transform(y)
-    incorrect = le.transform(incorr_orig)
+    incorrect = le.transform(incorr_orig)[0]
     # Number of relevant items, i.e. number of each label
     relevant_items = np.bincount(y) - 1 # one less for self class
     # R-Precision for each item
-    r_prec = np.zeros(n, dtype=np.float)
-    
-    # Classify each point in test set
-    if verbose:
-        log.message("Creating shared memory data.")
-    n_random_pred = mp.Value(ctypes.c_int)
-    n_random_pred.value = 0
-    if verbose and log:
-        log.message("Spawning processes for prediction.")
-    y_pred = np.zeros((n, return_y_pred), dtype=float)
+    r_prec = np.zeros(n, dtype=float)
+    y_pred = np.zeros((n, return_y_pred), dtype=int)
+    n_random_pred = 0
+
     kwargs = {'y_pred' : return_y_pred,
               'incorrect' : incorrect}
-    with mp.Pool(processes=n_jobs, 
-                 initializer=_load_shared_csr, 
-                 initargs=(S, y, n_random_pred, relevant_items)) as pool:
-        for i, r in enumerate(
-            pool.imap(
-                func=partial(_r_prec_worker, **kwargs),
-                iterable=range(n), 
-                chunksize=int(1e2))):
-            if verbose and ((i+1)%int(1e7 / 10**verbose) == 0 or i == n-1):
-                log.message("Classification: {} of {} on {}.".format(
-                            i+1, n, mp.current_process().name), flush=True)
-            try:
-                r_prec[i] = r[0]
-                y_pred[i, :] = r[1]
-            except:
-                r_prec[i] = r
-            if i == n-1:
-                pass
-    pool.join()
+    if not S_is_sparse:
+        kwargs['metric'] = metric
+        kwargs['rp'] = np.random.permutation(n)
+    starts = range(0, n, batch_size)
+    n_batches = len(starts)
+    if n_jobs == 1 or n_batches == 1:
+        _load_shared_data(S, y, relevant_items)
+        results = map(partial(_r_prec_worker, batch_size=batch_size,
+                              **kwargs), starts)
+        pool = None
+    else:
+        if verbose:
+            log.message("Spawning processes for prediction.")
+        pool = mp.Pool(processes=n_jobs,
+                       initializer=_load_shared_data,
+                       initargs=(S, y, relevant_items))
+        results = pool.imap(
+            func=partial(_r_prec_worker, batch_size=batch_size, **kwargs),
+            iterable=starts)
+    for b, (start, stop, r, nn_labels, n_random) in enumerate(results):
+        if verbose and ((b+1)%int(1e5 / 10**verbose) == 0 or b == n_batches-1):
+            log.message("Classification: {} of {}.".format(stop, n),
+                        flush=True)
+        r_prec[start:stop] = r
+        y_pred[start:stop, :] = nn_labels
+        n_random_pred += n_random
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     if verbose and log:
         log.message("Retrieving nearest neighbors.")
     # Work-around for new scikit-learn requirement of 1D arrays for LabelEncoder
-    y_pred = np.asarray([le.inverse_transform(col) for col in y_pred.T.astype(int)]).T
+    y_pred = np.asarray([le.inverse_transform(col) for col in y_pred.T]).T
     if verbose and log:
         log.message("Finishing.")
-    if n_random_pred.value:
+    if n_random_pred:
         log.warning(("{} queries were classified randomly, because all "
                      "distances were non-finite numbers or there were no other "
-                     "objects in the same class.").format(n_random_pred.value))
+                     "objects in the same class.").format(n_random_pred))
     return_dict = {'macro' : r_prec.mean(),
                    'weighted' : np.average(r_prec, weights=relevant_items[y]),
                    'per_item' : r_prec,
@@ -643,6 +938,207 @@ def r_precision(S:np.ndarray, y:np.ndarray, metric:str='distance',
                    'y_pred' : y_pred}
     return return_dict
 
+##############################################################################
+#
+#  RETRIEVAL METRICS
+#
+def _sorted_neighbors_sparse(S, start, stop, k_max, metric, rnd=np.random):
+    """ `k_max` nearest neighbors of rows ``start:stop`` of CSR matrix `S`.
+
+    Only stored values are neighbor candidates. All rows of the block are
+    sorted at once by row (segment), validity, and distance (similarity).
+    Ties are broken randomly. Self entries and NaN values are invalid.
+    """
+    n_rows = stop - start
+    lo, hi = S.indptr[start], S.indptr[stop]
+    data = S.data[lo:hi].astype(float)
+    cols = S.indices[lo:hi]
+    row = np.repeat(np.arange(start, stop), np.diff(S.indptr[start:stop+1]))
+    invalid = np.isnan(data) | (cols == row)
+    key = -data if metric == 'similarity' else data
+    order = np.lexsort((rnd.rand(data.size), key, invalid, row))
+    row = row[order]
+    pos = np.arange(data.size) - (S.indptr[row] - lo)
+    sel = (pos < k_max) & ~invalid[order]
+    nn = np.zeros((n_rows, k_max), dtype=int)
+    valid = np.zeros((n_rows, k_max), dtype=bool)
+    values = np.full((n_rows, k_max), np.nan)
+    nn[row[sel] - start, pos[sel]] = cols[order][sel]
+    valid[row[sel] - start, pos[sel]] = True
+    values[row[sel] - start, pos[sel]] = data[order][sel]
+    return nn, valid, values
+
+def _sorted_neighbors_graph(S, start, stop, k_max):
+    """ `k_max` nearest neighbors of rows ``start:stop`` of neighbor lists.
+
+    Negative indices and self indices are invalid, and moved to the end.
+    """
+    nn = np.zeros((stop - start, k_max), dtype=int)
+    valid = np.zeros((stop - start, k_max), dtype=bool)
+    block = np.asarray(S[start:stop], dtype=int)
+    block_valid = (block >= 0) \
+        & (block != np.arange(start, stop)[:, np.newaxis])
+    order = np.argsort(~block_valid, axis=1, kind='mergesort')
+    rows = np.arange(stop - start)[:, np.newaxis]
+    k_max = min(k_max, block.shape[1])
+    nn[:, :k_max] = block[rows, order[:, :k_max]]
+    valid[:, :k_max] = block_valid[rows, order[:, :k_max]]
+    return nn, valid, np.where(valid, 0., np.nan)
+
+def _retrieval_block(start, stop, S, y, relevant_items,
+                     k, metric, neighbors, rp):
+    """ Retrieval metrics at all `k` of rows ``start:stop``. """
+    k_max = k.max()
+    if neighbors:
+        nn, valid, _ = _sorted_neighbors_graph(S, start, stop, k_max)
+    elif issparse(S):
+        nn, valid, _ = _sorted_neighbors_sparse(S, start, stop, k_max, metric)
+    else:
+        nn, valid, _ = _sorted_neighbors_dense(
+            S, start, stop, k_max, metric, rp)
+    if nn.shape[1] < k_max:
+        pad = ((0, 0), (0, k_max - nn.shape[1]))
+        nn = np.pad(nn, pad)
+        valid = np.pad(valid, pad)
+    n_rel = relevant_items[y[start:stop]][:, np.newaxis]
+    rel = valid & (y[nn] == y[start:stop, np.newaxis])
+    hits = np.cumsum(rel, axis=1)
+    rank = np.arange(1, k_max + 1)
+    # Average precision: precision at each relevant position
+    prec_at_hit = np.cumsum(rel * hits / rank, axis=1)
+    # Discounted cumulative gain and its ideal value
+    discount = 1. / np.log2(rank + 1)
+    dcg = np.cumsum(rel * discount, axis=1)
+    idcg = np.cumsum(discount)
+    ki = k - 1
+    n_ideal = np.minimum(n_rel, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = hits[:, ki] / k
+        recall = np.where(n_rel > 0, hits[:, ki] / n_rel, 0.)
+        ap = np.where(n_ideal > 0, prec_at_hit[:, ki] / n_ideal, 0.)
+        ndcg = np.where(n_ideal > 0,
+                        dcg[:, ki] / idcg[np.maximum(n_ideal - 1, 0)], 0.)
+    return precision.T, recall.T, ap.T, ndcg.T
+
+def _retrieval_worker(start, batch_size, **kwargs):
+    stop = min(start + batch_size, S.shape[0])
+    r = _retrieval_block(start, stop, S, y, relevant_items, **kwargs)
+    return (start, stop, *r)
+
+def retrieval_metrics(D:np.ndarray, target:np.ndarray, k=10,
+                      metric:str='distance', neighbors:bool=False,
+                      verbose:int=0, n_jobs:int=1, batch_size:int=256):
+    """ Evaluate retrieval quality of nearest neighbors at several `k`.
+
+    Each object queries all other objects, and objects of the same class
+    are considered relevant. Every query's neighbors are sorted only once
+    up to ``max(k)`` (blockwise partial sort), from which precision@k,
+    recall@k, average precision@k, and nDCG@k are derived for all `k`.
+
+    Parameters
+    ----------
+    D : ndarray or CSR matrix
+        The ``n x n`` distance (similarity) matrix. For sparse matrices,
+        only stored values are considered neighbors.
+        If `neighbors` is True, an ``n x m`` array of neighbor indices
+        sorted by increasing distance (e.g. ``D_k`` from
+        :func:`hub_toolbox.hubness.hubness`). Negative indices are ignored.
+
+    target : ndarray (of dtype=int)
+        The ``n x 1`` target class labels (ground truth).
+
+    k : int or array_like (of dtype=int), optional (default: 10)
+        Cutoff ranks of the retrieval lists.
+
+    metric : {'distance', 'similarity'}, optional (default: 'distance')
+        Define, whether matrix `D` is a distance or similarity matrix.
+        Ignored, if `neighbors` is True.
+
+    neighbors : bool, optional (default: False)
+        Define, whether `D` contains neighbor indices (neighbor graph).
+
+    verbose : int, optional (default: 0)
+        Increasing level of output.
+
+    n_jobs : int, optional (default: 1)
+        Number of parallel processes to use.
+
+    batch_size : int, optional (default: 256)
+        Number of queries that are evaluated at once.
+
+    Returns
+    -------
+    retrieval : dictionary with following keys:
+        k : ndarray
+            Cutoff ranks.
+
+        precision, recall, map, ndcg : ndarray (shape=(n_k, ))
+            Mean precision@k, recall@k, average precision@k, and nDCG@k.
+
+        per_item : dictionary
+            The same metrics (keys 'precision', 'recall', 'ap', 'ndcg')
+            for each query, each of shape ``n_k x n``.
+
+        relevant_items : ndarray
+            Relevant items per class.
+    """
+    log = ConsoleLogging()
+    if neighbors:
+        io.check_is_nD_array(D, 2, "Neighbor index")
+    else:
+        io.check_distance_matrix_shape(D)
+        io.check_valid_metric_parameter(metric)
+    n = D.shape[0]
+    if target.size != n:
+        raise TypeError("Number of class labels does not match number of "
+                        "points. Labels: {}, points: {}.".format(target.size, n))
+    k = np.atleast_1d(np.asarray(k, dtype=int))
+    if np.any(k < 1):
+        raise ValueError("Cutoff ranks 'k' must be >= 1, but are {}.".format(k))
+    if issparse(D):
+        D = D.tocsr()
+    _, y = np.unique(target, return_inverse=True)
+    relevant_items = np.bincount(y) - 1 # one less for self class
+
+    kwargs = {'k' : k, 'metric' : metric, 'neighbors' : neighbors,
+              'rp' : None}
+    if not neighbors and not issparse(D):
+        kwargs['rp'] = np.random.permutation(n)
+    per_item = {key : np.zeros((k.size, n))
+                for key in ['precision', 'recall', 'ap', 'ndcg']}
+    starts = range(0, n, batch_size)
+    n_batches = len(starts)
+    if n_jobs == 1 or n_batches == 1:
+        _load_shared_data(D, y, relevant_items)
+        results = map(partial(_retrieval_worker, batch_size=batch_size,
+                              **kwargs), starts)
+        pool = None
+    else:
+        if verbose:
+            log.message("Spawning processes for retrieval.")
+        pool = mp.Pool(processes=n_jobs,
+                       initializer=_load_shared_data,
+                       initargs=(D, y, relevant_items))
+        results = pool.imap(
+            func=partial(_retrieval_worker, batch_size=batch_size, **kwargs),
+            iterable=starts)
+    for b, (start, stop, *r) in enumerate(results):
+        if verbose and ((b+1)%int(1e5 / 10**verbose) == 0 or b == n_batches-1):
+            log.message("Retrieval: {} of {}.".format(stop, n), flush=True)
+        for key, value in zip(['precision', 'recall', 'ap', 'ndcg'], r):
+            per_item[key][:, start:stop] = value
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return {'k' : k,
+            'precision' : per_item['precision'].mean(axis=1),
+            'recall' : per_item['recall'].mean(axis=1),
+            'map' : per_item['ap'].mean(axis=1),
+            'ndcg' : per_item['ndcg'].mean(axis=1),
+            'per_item' : per_item,
+            'relevant_items' : relevant_items}
+
 def f1_score(cmat):
     """ Calculate F measure from confusion matrix.
 
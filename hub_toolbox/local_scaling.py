@@ -10,32 +10,40 @@ The HUB TOOLBOX is licensed under the terms of the GNU GPLv3.
 Austrian Research Institute for Artificial Intelligence (OFAI)
 Contact: <roman.feldbauer@ofai.at>
 """
-import ctypes
 from functools import partial
-from multiprocessing import cpu_count, RawArray, Pool
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy.sparse.base import issparse
-from scipy.sparse.lil import lil_matrix
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.metrics.pairwise import pairwise_distances
+from sklearn.utils import check_array
+from sklearn.utils.extmath import row_norms
+from sklearn.utils.validation import check_is_fitted
 from hub_toolbox import io
 from hub_toolbox.htlogging import ConsoleLogging
 
-__all__ = ['local_scaling', 'local_scaling_sample', 'nicdm', 'nicdm_sample']
+__all__ = ['local_scaling', 'local_scaling_sample', 'nicdm', 'nicdm_sample',
+           'LocalScaling', 'k_neighbor_distances']
 
 def local_scaling_sample(D:np.ndarray, k:int=7, metric:str='distance',
-                         train_ind:np.ndarray=None, test_ind:np.ndarray=None):
+                         train_ind:np.ndarray=None, test_ind:np.ndarray=None,
+                         n_jobs:int=1, copy:bool=True):
     """Transform a distance matrix with Local Scaling.
 
-    --- DRAFT version ---
-
-    Transforms the given distance matrix into new one using local scaling [1]_
-    with the given `k`-th nearest neighbor. There are two types of local
+    Transforms the given ``n x s`` distance matrix into new one using local
+    scaling [1]_ with the given `k`-th nearest neighbor, where only ``s``
+    sample objects are considered as neighbors. There are two types of local
     scaling methods implemented. The original one and NICDM, both reduce
     hubness in distance spaces, similarly to Mutual Proximity.
 
+    Radii are computed for all objects at once, and rows are rescaled in
+    blocks, so that this is the recommended route for very large ``n``.
+
     Parameters
     ----------
-    D : ndarray or csr_matrix
-        The ``n x n`` symmetric distance (similarity) matrix.
+    D : ndarray
+        The ``n x s`` distance (similarity) matrix, where ``s==train_ind.size``
 
     k : int, optional (default: 7)
         Neighborhood radius for local scaling.
@@ -43,21 +51,33 @@ def local_scaling_sample(D:np.ndarray, k:int=7, metric:str='distance',
     metric : {'distance', 'similarity'}, optional (default: 'distance')
         Define, whether matrix `D` is a distance or similarity matrix.
 
-        NOTE: self similarities in sparse `D_ls` are set to ``np.inf``
-
-    train_ind : ndarray, optional
-        If given, use only these data points as neighbors for rescaling.
+    train_ind : ndarray
+        The index array that determines, to which data points the columns in
+        `D` correspond. Only these data points are used as neighbors.
 
     test_ind : ndarray, optional (default: None)
         Define data points to be hold out as part of a test set. Can be:
 
         - None : Rescale all distances
-        - ndarray : Hold out points indexed in this array as test set.
+        - ndarray : Return only rescaled distances of these data points.
+
+    n_jobs : int, optional, default: 1
+        Number of threads for parallel computations.
+
+        - `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    copy : bool, optional, default: True
+        If False, floating point `D` is overwritten with the secondary
+        distances (if `test_ind` is None).
 
     Returns
     -------
     D_ls : ndarray
-        Secondary distance LocalScaling matrix.
+        Secondary distance LocalScaling matrix of shape ``n x s``
+        (or ``test_ind.size x s``). Self distances ``D[train_ind[j], j]``
+        are set to zero (one for similarities). Float32 input yields
+        float32 output.
 
     References
     ----------
@@ -69,73 +89,15 @@ def local_scaling_sample(D:np.ndarray, k:int=7, metric:str='distance',
     # Checking input
     io.check_sample_shape_fits(D, train_ind)
     io.check_valid_metric_parameter(metric)
-    sparse = issparse(D)
-    n = D.shape[0]
     if metric == 'similarity':
-        if train_ind is not None:
-            raise NotImplementedError
-        kth = n - k
-        exclude = -np.inf
         self_value = 1.
         log.warning("Similarity matrix support for LS is experimental.")
     else: # metric == 'distance':
-        kth = k - 1
-        exclude = np.inf
-        self_value = 0
-        if sparse:
-            log.error("Sparse distance matrices are not supported.")
-            raise NotImplementedError(
-                "Sparse distance matrices are not supported.")
-
-    D = np.copy(D)
-    if test_ind is None:
-        train_set_ind = slice(0, n) #take all
-        n_ind = range(n)
-    else:
-        train_set_ind = np.setdiff1d(np.arange(n), test_ind)
-        n_ind = test_ind
-    # Exclude self distances
-    for j, sample in enumerate(train_ind):
-        D[sample, j] = exclude
-    r = np.zeros(n)
-    for i in range(n):
-        if train_ind is None:
-            if sparse:
-                di = D[i, train_set_ind].toarray()
-            else:
-                di = D[i, train_set_ind]
-        else:
-            di = D[i, :] # all columns are training in this case
-        r[i] = np.partition(di, kth=kth)[kth]
-
-    if sparse:
-        D_ls = lil_matrix(D.shape)
-        # Number of nonzero cells per row
-        nnz = D.getnnz(axis=1)
-    else:
-        D_ls = np.zeros_like(D)
-
-    if metric == 'similarity':
-        for i in n_ind:
-            if sparse and nnz[i] <= k: # Don't rescale if there are too few 
-                D_ls[i, :] = D[i, :]   # neighbors in the current row
-            else:
-                D_ls[i, :] = np.exp(-1 * D[i, :]**2 / (r[i] * r[train_ind]))
-    else:
-        for i in n_ind:
-            D_ls[i, :] = 1 - np.exp(-1 * D[i, :]**2 / (r[i] * r[train_ind]))
-
-    if test_ind is None:
-        if sparse:
-            return D_ls.tocsr()
-        else:
-            np.fill_diagonal(D_ls, self_value)
-            return D_ls
-    else:
-        # Ensure correct self distances
-        for j, sample in enumerate(train_ind):
-            D_ls[sample, j] = self_value
-        return D_ls[test_ind]
+        self_value = 0.
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    return _rescale_sample(D, k, metric, train_ind, test_ind, nicdm=False,
+                           self_value=self_value, n_jobs=n_jobs, copy=copy)
 
 #===============================================================================
 # #=============================================================================
@@ -143,36 +105,256 @@ def local_scaling_sample(D:np.ndarray, k:int=7, metric:str='distance',
 # #=============================================================================
 #===============================================================================
 
-def _ls_load_shared_data(D_, train_ind_, r_, r_ctype_,
-                         D_ls_=None, D_ls_ctype_=None):
-    global D, train_ind, r, r_ctype, D_ls, D_ls_ctype
-    D = D_
-    train_ind = train_ind_
-    r = r_
-    r_ctype = r_ctype_
-    D_ls = D_ls_
-    D_ls_ctype = D_ls_ctype_
-    return
+def _self_columns(rows, n_cols, train_ind):
+    """ Column positions of `rows` among the training columns (or -1). """
+    if isinstance(train_ind, slice):
+        return np.where(rows < n_cols, rows, -1)
+    pos = np.searchsorted(train_ind, rows)
+    pos = np.clip(pos, 0, train_ind.size - 1)
+    return np.where(train_ind[pos] == rows, pos, -1)
+
+def _radii_dense(D, k, train_ind, metric, nicdm, batch_size=1024,
+                 exclude_self=True, sample_ind=None):
+    """ Neighborhood radii of all objects from row blocks of dense `D`.
+
+    For local scaling, the radius is the distance to the `k`-th nearest
+    neighbor, for NICDM the mean distance to the `k` nearest neighbors.
+    Only training objects are considered neighbors, and self distances
+    are excluded (if `exclude_self`). For ``n x s`` sample matrices,
+    `sample_ind` maps columns to objects. Only one block of rows is copied
+    at a time.
+    """
+    n = D.shape[0]
+    r = np.empty(n)
+    if sample_ind is not None:
+        sample_col = np.full(n, -1)
+        sample_col[sample_ind] = np.arange(sample_ind.size)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        block = np.array(D[start:stop, train_ind], dtype=np.float64)
+        m = block.shape[1]
+        if sample_ind is not None:
+            self_col = sample_col[start:stop]
+        elif exclude_self:
+            self_col = _self_columns(np.arange(start, stop), m, train_ind)
+        else:
+            self_col = np.full(stop - start, -1)
+        has_self = self_col >= 0
+        if metric == 'similarity':
+            block[np.arange(stop - start)[has_self], self_col[has_self]] = \
+                -np.inf
+            kth = m - k
+            r[start:stop] = np.partition(block, kth=kth, axis=1)[:, kth]
+        else:
+            block[np.arange(stop - start)[has_self], self_col[has_self]] = \
+                np.inf
+            if nicdm:
+                r[start:stop] = np.partition(
+                    block, kth=np.arange(k), axis=1)[:, :k].mean(axis=1)
+            else:
+                r[start:stop] = np.partition(
+                    block, kth=k-1, axis=1)[:, k-1]
+    return r
 
-def _ls_calculate_r(i, kth):
-    di = D[i, train_ind]
-    r[i] = np.partition(di, kth=kth)[kth]
+def _rescale_tile(D, out, tile, r, metric, nicdm, r_geom):
+    """ Rescale one upper triangular tile and mirror it to the lower one.
+
+    Uses outer-product broadcasting of the radii. Only two tile-sized
+    temporary arrays are allocated. Since `D` is symmetric, its lower
+    triangular tile is not read, so that `out` may be `D` itself.
+    """
+    rows, cols = tile
+    t = np.array(D[rows, cols], dtype=out.dtype)
+    rr = np.multiply.outer(r[rows], r[cols])
+    if nicdm:
+        np.sqrt(rr, out=rr)
+        t /= rr
+        t *= r_geom
+    else:
+        np.square(t, out=t)
+        t /= rr
+        np.negative(t, out=t)
+        np.exp(t, out=t)
+        if metric == 'distance':
+            np.subtract(1, t, out=t)
+    out[rows, cols] = t
+    if rows != cols:
+        out[cols, rows] = t.T
     return
 
-def _ls_calculate_sec_dist(i, n, metric, self_tmp_value):
-    # vectorized inner loop: calc only triu part
-    tmp = np.empty(n-i)
-    tmp[0] = self_tmp_value
-    if metric == 'similarity':
-        tmp[1:] = np.exp(-1 * D[i, i+1:]**2 / (r[i] * r[i+1:]))
+def _rescale_rows(D, out, rows, r_row, r_col, metric, nicdm, r_geom):
+    """ Rescale a block of rows of a (not necessarily square) matrix.
+
+    Used for query-to-training distances, where row and column objects
+    have separate radii `r_row` and `r_col`.
+    """
+    t = np.array(D[rows], dtype=out.dtype)
+    rr = np.multiply.outer(r_row[rows], r_col)
+    if nicdm:
+        np.sqrt(rr, out=rr)
+        t /= rr
+        t *= r_geom
     else:
-        tmp[1:] = 1 - np.exp(-1 * D[i, i+1:]**2 / (r[i] * r[i+1:]))
-    D_ls[i, i:] = tmp
-    D_ls[i:, i] = tmp
+        np.square(t, out=t)
+        t /= rr
+        np.negative(t, out=t)
+        np.exp(t, out=t)
+        if metric == 'distance':
+            np.subtract(1, t, out=t)
+    out[rows] = t
     return
 
+def _rescale_rows_blocked(D, out, r_row, r_col, metric, nicdm, r_geom,
+                          n_jobs=1, batch_size=1024):
+    """ Rescale all rows of `D` into `out`, block-wise on `n_jobs` threads. """
+    r_row = r_row.astype(out.dtype)
+    r_col = r_col.astype(out.dtype)
+    blocks = [slice(i, min(i + batch_size, D.shape[0]))
+              for i in range(0, D.shape[0], batch_size)]
+    func = partial(_rescale_rows, D, out, r_row=r_row, r_col=r_col,
+                   metric=metric, nicdm=nicdm, r_geom=r_geom)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            for _ in pool.imap_unordered(func, blocks):
+                pass # results handled within func
+    else:
+        for rows in blocks:
+            func(rows)
+    return out
+
+def _rescale_sample(D, k, metric, train_ind, test_ind, nicdm, self_value,
+                    n_jobs, copy):
+    """ Vectorized LS/NICDM for ``n x s`` sample matrices.
+
+    Radii of all objects are computed from their distances to the sample
+    (excluding ``D[train_ind[j], j]``), and rows of `test_ind` (or all rows)
+    are rescaled block-wise. Self distances ``D[train_ind[j], j]`` are set
+    to `self_value` in all returned rows.
+    """
+    n = D.shape[0]
+    r = _radii_dense(D, k, slice(None), metric, nicdm, sample_ind=train_ind)
+    r_geom = _local_geomean(r) if nicdm else None
+    if test_ind is None:
+        rows = np.arange(n)
+        out = _prepare_out(D, copy, None)
+    else:
+        rows = np.asarray(test_ind)
+        D = D[rows]
+        out = _prepare_out(D, False, None)
+    _rescale_rows_blocked(D, out, r[rows], r[train_ind], metric, nicdm,
+                          r_geom, n_jobs)
+    pos = np.full(n, -1)
+    pos[rows] = np.arange(rows.size)
+    j = np.flatnonzero(pos[train_ind] >= 0)
+    out[pos[train_ind[j]], j] = self_value
+    return out
+
+def _rescale_dense(D, r, metric, nicdm, r_geom=None, self_value=0.,
+                   out=None, n_jobs=1, tile_size=1024):
+    """ Tiled engine for dense local scaling and NICDM.
+
+    Secondary distances are computed tile by tile over the upper triangle
+    of the symmetric matrix `D`, and written to `out` (which may be `D`).
+    Tiles are processed by `n_jobs` threads, which share `D` and `out`.
+    """
+    n = D.shape[0]
+    r = r.astype(out.dtype)
+    tiles = [(slice(i, min(i + tile_size, n)), slice(j, min(j + tile_size, n)))
+             for i in range(0, n, tile_size) for j in range(i, n, tile_size)]
+    func = partial(_rescale_tile, D, out, r=r, metric=metric,
+                   nicdm=nicdm, r_geom=r_geom)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            for _ in pool.imap_unordered(func, tiles):
+                pass # results handled within func
+    else:
+        for tile in tiles:
+            func(tile)
+    np.fill_diagonal(out, self_value)
+    return out
+
+def _prepare_out(D, copy, out):
+    """ Output array of dense LS/NICDM, preserving floating dtypes. """
+    if out is not None:
+        if out.shape != D.shape:
+            raise ValueError("Output array must have shape {}, but has {}."
+                             .format(D.shape, out.shape))
+        return out
+    if not copy and np.issubdtype(D.dtype, np.floating):
+        return D
+    if np.issubdtype(D.dtype, np.floating):
+        return np.empty_like(D)
+    return np.empty(D.shape, dtype=np.float64)
+
+def _radii_sparse(S, k, train_ind, metric, nicdm, exclude_self=True):
+    """ Neighborhood radii of all objects from the stored values of CSR `S`.
+
+    All rows are processed at once: Values are sorted by row (segment),
+    validity, and distance (similarity). Self values (if `exclude_self`),
+    NaN, and columns outside the training set are invalid. Rows with less
+    than `k` valid values use all of them, and are reported in `too_few`.
+    """
+    n = S.shape[0]
+    row = np.repeat(np.arange(n), np.diff(S.indptr))
+    col = S.indices
+    invalid = np.isnan(S.data)
+    if exclude_self:
+        invalid |= row == col
+    if not isinstance(train_ind, slice):
+        is_train = np.zeros(S.shape[1], dtype=bool)
+        is_train[train_ind] = True
+        invalid |= ~is_train[col]
+    key = -S.data if metric == 'similarity' else S.data
+    order = np.lexsort((key, invalid, row))
+    data = S.data[order].astype(np.float64)
+    row = row[order]
+    valid = ~invalid[order]
+    pos = np.arange(data.size) - S.indptr[row]
+    n_valid = np.bincount(row[valid], minlength=n)
+    too_few = n_valid < k
+    last = np.minimum(n_valid, k) - 1
+    if nicdm:
+        sel = valid & (pos <= last[row])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r = np.bincount(row[sel], weights=data[sel], minlength=n) \
+                / (last + 1)
+    else:
+        sel = valid & (pos == last[row])
+        r = np.full(n, np.nan)
+        r[row[sel]] = data[sel]
+    return r, too_few
+
+def _rescale_sparse(S, r, metric, nicdm, too_few, r_geom=None,
+                    self_value=0., copy=True, r_col=None):
+    """ Rescale all stored values of CSR `S` in one vectorized pass.
+
+    Radii of both objects are gathered through the row and column indices
+    (from `r_col` for columns, if given). Rows with too few neighbors keep
+    their values. Self values are set to `self_value`, unless it is None.
+    """
+    if copy:
+        S = S.copy()
+    if r_col is None:
+        r_col = r
+    row = np.repeat(np.arange(S.shape[0]), np.diff(S.indptr))
+    col = S.indices
+    rr = r[row] * r_col[col]
+    d = S.data
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if nicdm:
+            d_sec = r_geom * d / np.sqrt(rr)
+        elif metric == 'similarity':
+            d_sec = np.exp(-1 * d**2 / rr)
+        else:
+            d_sec = 1 - np.exp(-1 * d**2 / rr)
+    S.data = np.where(too_few[row], d, d_sec).astype(S.dtype)
+    if self_value is not None:
+        S.data[row == col] = self_value
+    return S
+
 def local_scaling(D:np.ndarray, k:int=7, metric:str='distance',
-                  test_ind:np.ndarray=None, n_jobs:int=1):
+                  test_ind:np.ndarray=None, n_jobs:int=1,
+                  copy:bool=True, out:np.ndarray=None):
     """Transform a distance matrix with Local Scaling.
 
     Transforms the given distance matrix into new one using local scaling [1]_
@@ -184,6 +366,8 @@ def local_scaling(D:np.ndarray, k:int=7, metric:str='distance',
     ----------
     D : ndarray or csr_matrix
         The ``n x n`` symmetric distance (similarity) matrix.
+        For sparse matrices, only stored values are considered neighbors
+        and rescaled. Rows with less than `k` neighbors are not rescaled.
 
     k : int, optional (default: 7)
         Neighborhood radius for local scaling.
@@ -200,15 +384,23 @@ def local_scaling(D:np.ndarray, k:int=7, metric:str='distance',
         - ndarray : Hold out points indexed in this array as test set.
 
     n_jobs : int, optional, default: 1
-        Number of processes for parallel computations.
+        Number of threads for parallel computations.
 
         - `1`: Don't use multiprocessing.
         - `-1`: Use all CPUs
 
+    copy : bool, optional, default: True
+        If False, floating point `D` (or the data of CSR `D`) is
+        overwritten with the secondary distances to save memory.
+
+    out : ndarray, optional, default: None
+        Array (e.g. a memory map) for the dense secondary distances.
+
     Returns
     -------
     D_ls : ndarray
-        Secondary distance LocalScaling matrix.
+        Secondary distance LocalScaling matrix. Dense float32 input
+        yields float32 output.
 
     References
     ----------
@@ -225,129 +417,84 @@ def local_scaling(D:np.ndarray, k:int=7, metric:str='distance',
     if n_jobs == -1:
         n_jobs = cpu_count()
     if metric == 'similarity':
-        kth = n - k
-        exclude = -np.inf
-        self_tmp_value = np.inf
         self_value = 1.
         log.warning("Similarity matrix support for LS is experimental.")
-        if sparse and n_jobs != 1:
-            log.warning("Parallel processing not implemented for sparse "
-                        "matrices. Using single process instead.")
-            n_jobs = 1
     else: # metric == 'distance':
-        kth = k - 1
-        exclude = np.inf
         self_value = 0
-        self_tmp_value = self_value
-        if sparse:
-            log.error("Sparse distance matrices are not supported.")
-            raise NotImplementedError(
-                "Sparse distance matrices are not supported.")
-    D = np.copy(D)
+    if sparse and n_jobs != 1:
+        log.warning("Parallel processing not implemented for sparse "
+                    "matrices. Using single process instead.")
 
     if test_ind is None:
         train_ind = slice(0, n) #take all        
     else:
         train_ind = np.setdiff1d(np.arange(n), test_ind)
     if sparse:
-        r = np.zeros(n)
-        for i in range(n):
-            di = D[i, train_ind].toarray()
-            di[i] = exclude
-            r[i] = np.partition(di, kth=kth)[kth]
-        D_ls = lil_matrix(D.shape)
-        # Number of nonzero cells per row
-        nnz = D.getnnz(axis=1)
-    else:
-        np.fill_diagonal(D, exclude)
-        if n_jobs > 1:
-            r_ctype = RawArray(ctypes.c_double, n)
-            r = np.frombuffer(r_ctype, dtype=np.float64)
-            with Pool(processes=n_jobs,
-                      initializer=_ls_load_shared_data,
-                      initargs=(D, train_ind, r, r_ctype)) as pool:
-                for _ in pool.imap(func=partial(_ls_calculate_r, kth=kth),
-                                   iterable=range(n)):
-                    pass # results handled within func
-        else:
-            r = np.partition(D[:, train_ind], kth=kth)[:, kth]
-
-    if sparse or n_jobs == 1:
-        D_ls = np.zeros_like(D)
-        for i in range(n):
-            # vectorized inner loop: calc only triu part
-            tmp = np.empty(n-i)
-            tmp[0] = self_tmp_value
-            if metric == 'similarity':
-                if sparse and nnz[i] <= k:  # Don't rescale if there are
-                    tmp[1:] = np.nan        # too few neighbors in row
-                else:
-                    tmp[1:] = np.exp(-1 * D[i, i+1:]**2 / (r[i] * r[i+1:]))
-            else:
-                tmp[1:] = 1 - np.exp(-1 * D[i, i+1:]**2 / (r[i] * r[i+1:]))
-            D_ls[i, i:] = tmp
-        # copy triu to tril -> symmetric matrix (diag=zeros)
-        # NOTE: does not affect self values, since inf+inf=inf and 0+0=0
-        D_ls += D_ls.T
-    else:
-        D_ls_ctype = RawArray(ctypes.c_double, D.size)
-        D_ls = np.frombuffer(D_ls_ctype, dtype=np.float64).reshape(D.shape)
-        with Pool(processes=n_jobs,
-                  initializer=_ls_load_shared_data,
-                  initargs=(D, train_ind, r, r_ctype, D_ls, D_ls_ctype)) as pool:
-            for _ in pool.imap(func=partial(_ls_calculate_sec_dist,
-                                  n=n, metric=metric,
-                                  self_tmp_value=self_tmp_value),
-                               iterable=range(n)):
-                pass # results handled within func
-        # triu is copied to tril within func
-    if sparse:
-        for i, nz in enumerate(nnz):
-            if nz <= k: # too few neighbors
-                D_ls[i, :] = D[i, :]
-        return D_ls.tocsr()
-    else:
-        np.fill_diagonal(D_ls, self_value)
-        return D_ls
+        # Rows with too few neighbors are not rescaled. Self similarities
+        # are set to inf, so that they remain the highest similarities.
+        D = D.tocsr()
+        r, too_few = _radii_sparse(D, k, train_ind, metric, nicdm=False)
+        if metric == 'similarity':
+            self_value = np.inf
+        return _rescale_sparse(D, r, metric, nicdm=False, too_few=too_few,
+                               self_value=self_value, copy=copy)
+    r = _radii_dense(D, k, train_ind, metric, nicdm=False)
+    return _rescale_dense(D, r, metric, nicdm=False,
+                          self_value=self_value,
+                          out=_prepare_out(D, copy, out), n_jobs=n_jobs)
 
 def nicdm_sample(D:np.ndarray, k:int=7, metric:str='distance',
-                 train_ind:np.ndarray=None, test_ind:np.ndarray=None):
+                 train_ind:np.ndarray=None, test_ind:np.ndarray=None,
+                 n_jobs:int=1, copy:bool=True):
     """Transform a distance matrix with local scaling variant NICDM.
-    
-    --- DRAFT version ---
 
-    Transforms the given distance matrix into new one using NICDM [1]_
-    with the given neighborhood radius `k` (average). There are two types of
+    Transforms the given ``n x s`` distance matrix into new one using
+    NICDM [1]_ with the given neighborhood radius `k` (average), where only
+    ``s`` sample objects are considered as neighbors. There are two types of
     local scaling methods implemented. The original one and the non-iterative
     contextual dissimilarity measure, both reduce hubness in distance spaces,
     similarly to Mutual Proximity.
 
+    Radii are computed for all objects at once, and rows are rescaled in
+    blocks, so that this is the recommended route for very large ``n``.
+
     Parameters
     ----------
-    D : ndarray or csr_matrix
-        The ``n x n`` symmetric distance (similarity) matrix.
+    D : ndarray
+        The ``n x s`` distance matrix, where ``s==train_ind.size``
 
     k : int, optional (default: 7)
         Neighborhood radius for local scaling.
 
-    metric : {'distance', 'similarity'}, optional (default: 'distance')
-        Define, whether matrix `D` is a distance or similarity matrix.
-
-        NOTE: self similarities in sparse `D_ls` are set to ``np.inf``
+    metric : {'distance'}, optional (default: 'distance')
+        Currently, only distance matrices are supported.
 
-    train_ind : ndarray, optional
-        If given, use only these data points as neighbors for rescaling.
+    train_ind : ndarray
+        The index array that determines, to which data points the columns in
+        `D` correspond. Only these data points are used as neighbors.
 
     test_ind : ndarray, optional (default: None)
         Define data points to be hold out as part of a test set. Can be:
 
         - None : Rescale all distances
-        - ndarray : Hold out points indexed in this array as test set.
+        - ndarray : Return only rescaled distances of these data points.
+
+    n_jobs : int, optional, default: 1
+        Number of threads for parallel computations.
+
+        - `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    copy : bool, optional, default: True
+        If False, floating point `D` is overwritten with the secondary
+        distances (if `test_ind` is None).
 
     Returns
     -------
     D_nicdm : ndarray
-        Secondary distance NICDM matrix.
+        Secondary distance NICDM matrix of shape ``n x s``
+        (or ``test_ind.size x s``). Self distances ``D[train_ind[j], j]``
+        are set to zero. Float32 input yields float32 output.
 
     References
     ----------
@@ -361,43 +508,10 @@ def nicdm_sample(D:np.ndarray, k:int=7, metric:str='distance',
     if metric == 'similarity':
         raise NotImplementedError("NICDM does not support similarity matrices "
                                   "at the moment.")
-    else: # metric == 'distance':
-        D = np.copy(D)
-        kth = np.arange(k)
-        exclude = np.inf
-        self_value = 0
-        if issparse(D):
-            raise NotImplementedError(
-                "Sparse distance matrices are not supported.")
-
-    n = D.shape[0]
-    if test_ind is None:
-        n_ind = range(n)
-    else:
-        n_ind = test_ind
-    # Exclude self distances
-    for j, sample in enumerate(train_ind):
-        D[sample, j] = exclude
-
-    # Statistics
-    r = np.partition(D, kth=kth, axis=1)[:, :k].mean(axis=1)
-    r_geom = _local_geomean(r) #knn.ravel())
-
-    # Calculate secondary distances
-    D_nicdm = np.zeros_like(D)
-    for i in n_ind:
-        # vectorized inner loop (using broadcasting)
-        D_nicdm[i, :] = (r_geom * D[i, :]) / np.sqrt(r[i] * r[train_ind])
-        #D_nicdm[i, :] = ((r_geom**2) * D[i, :]) / (r[i] * r[train_ind])
-
-    # Ensure correct self distances and return sec. dist. matrix
-    if test_ind is None:
-        np.fill_diagonal(D_nicdm, self_value)
-        return D_nicdm 
-    else:
-        for j, sample in enumerate(train_ind):
-            D_nicdm[sample, j] = self_value
-        return D_nicdm[test_ind]
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    return _rescale_sample(D, k, metric, train_ind, test_ind, nicdm=True,
+                           self_value=0., n_jobs=n_jobs, copy=copy)
 
 
 #==============================================================================
@@ -405,31 +519,9 @@ def nicdm_sample(D:np.ndarray, k:int=7, metric:str='distance',
 # #             Non-iterative Contextual Dissimilarity Measure
 # #============================================================================
 #==============================================================================
-def _nicdm_load_shared_data(D_, train_ind_, r_, r_ctype_,
-                            D_nicdm_=None, D_nicdm_ctype_=None):
-    global D, train_ind, r, r_ctype, D_nicdm, D_nicdm_ctype
-    D = D_
-    train_ind = train_ind_
-    r = r_
-    r_ctype = r_ctype_
-    D_nicdm = D_nicdm_
-    D_nicdm_ctype = D_nicdm_ctype_
-    return
-
-def _nicdm_calculate_r(i, kth, k):
-    di = D[i, train_ind]
-    r[i] = np.partition(di, kth=kth)[:k].mean()
-    return
-
-def _nicdm_calculate_sec_dist(i, r_geom, n, metric):
-    # vectorized inner loop
-    tmp = (r_geom * D[i, i+1:]) / np.sqrt(r[i] * r[i+1:])
-    D_nicdm[i, i+1:] = tmp
-    D_nicdm[i+1:, i] = tmp
-    return
-
 def nicdm(D:np.ndarray, k:int=7, metric:str='distance',
-          test_ind:np.ndarray=None, n_jobs:int=1):
+          test_ind:np.ndarray=None, n_jobs:int=1,
+          copy:bool=True, out:np.ndarray=None):
     """Transform a distance matrix with local scaling variant NICDM.
 
     Transforms the given distance matrix into new one using NICDM [1]_
@@ -440,8 +532,10 @@ def nicdm(D:np.ndarray, k:int=7, metric:str='distance',
 
     Parameters
     ----------
-    D : ndarray
+    D : ndarray or csr_matrix
         The ``n x n`` symmetric distance (similarity) matrix.
+        For sparse matrices, only stored values are considered neighbors
+        and rescaled. Rows with less than `k` neighbors are not rescaled.
 
     k : int, optional (default: 7)
         Neighborhood radius for local scaling.
@@ -456,15 +550,23 @@ def nicdm(D:np.ndarray, k:int=7, metric:str='distance',
         - ndarray : Hold out points indexed in this array as test set.
 
     n_jobs : int, optional, default: 1
-        Number of processes for parallel computations.
+        Number of threads for parallel computations.
 
         - `1`: Don't use multiprocessing.
         - `-1`: Use all CPUs
 
+    copy : bool, optional, default: True
+        If False, floating point `D` (or the data of CSR `D`) is
+        overwritten with the secondary distances to save memory.
+
+    out : ndarray, optional, default: None
+        Array (e.g. a memory map) for the secondary distances.
+
     Returns
     -------
     D_nicdm : ndarray
-        Secondary distance NICDM matrix.
+        Secondary distance NICDM matrix. Float32 input yields
+        float32 output.
 
     References
     ----------
@@ -479,12 +581,8 @@ def nicdm(D:np.ndarray, k:int=7, metric:str='distance',
     if metric == 'similarity':
         raise NotImplementedError("NICDM does not support similarity matrices "
                                   "at the moment.")
-    else:
-        kth = np.arange(k)
-        exclude = np.inf
     if n_jobs == -1:
         n_jobs = cpu_count()
-    D = np.copy(D)
     n = D.shape[0]
 
     if test_ind is None:
@@ -492,40 +590,411 @@ def nicdm(D:np.ndarray, k:int=7, metric:str='distance',
     else:
         train_ind = np.setdiff1d(np.arange(n), test_ind)
 
-    np.fill_diagonal(D, exclude)
-    if n_jobs > 1:
-        r_ctype = RawArray(ctypes.c_double, n)
-        r = np.frombuffer(r_ctype, dtype=np.float64)
-        with Pool(processes=n_jobs,
-                  initializer=_nicdm_load_shared_data,
-                  initargs=(D, train_ind, r, r_ctype)) as pool:
-            for i, knn in enumerate(pool.imap(
-                func=partial(_nicdm_calculate_r, kth=kth, k=k),
-                iterable=range(n))):
-                pass # r is handled within func
-            r_geom = _local_geomean(r)
-        D_nicdm_ctype = RawArray(ctypes.c_double, D.size)
-        D_nicdm = np.frombuffer(D_nicdm_ctype, dtype=np.float64).reshape(D.shape)
-        with Pool(processes=n_jobs,
-                  initializer=_nicdm_load_shared_data,
-                  initargs=(D, train_ind, r, r_ctype, D_nicdm, D_nicdm_ctype)) as pool:
-            for _ in pool.imap(
-                func=partial(_nicdm_calculate_sec_dist, r_geom=r_geom, n=n, metric=metric),
-                iterable=range(n)):
-                pass # results handled within func
-    else: # no multiprocessing
-        knn = np.partition(D[:, train_ind], kth=kth, axis=1)[:, :k]
-        r = knn.mean(axis=1)
-        r_geom = _local_geomean(r)
-
-        D_nicdm = np.zeros_like(D)
-        for i in range(n):
-            # vectorized inner loop for 100x speed-up (using broadcasting)
-            #D_nicdm[i, i+1:] = ((r_geom**2) * D[i, i+1:]) / (r[i] * r[i+1:])
-            D_nicdm[i, i+1:] = (r_geom * D[i, i+1:]) / np.sqrt(r[i] * r[i+1:])
-        D_nicdm += D_nicdm.T
-
-    return D_nicdm
+    if issparse(D):
+        D = D.tocsr()
+        r, too_few = _radii_sparse(D, k, train_ind, metric, nicdm=True)
+        r_geom = _local_geomean(r[~too_few])
+        return _rescale_sparse(D, r, metric, nicdm=True, too_few=too_few,
+                               r_geom=r_geom, self_value=0., copy=copy)
+    r = _radii_dense(D, k, train_ind, metric, nicdm=True)
+    r_geom = _local_geomean(r)
+    return _rescale_dense(D, r, metric, nicdm=True, r_geom=r_geom,
+                          self_value=0., out=_prepare_out(D, copy, out),
+                          n_jobs=n_jobs)
 
 def _local_geomean(x):
     return np.exp(np.sum(np.log(x)) / np.max(np.shape(x)))
+
+class LocalScaling(BaseEstimator, TransformerMixin):
+    """ Local scaling / NICDM with out-of-sample transformation.
+
+    Fits the neighborhood radii of training objects from their precomputed
+    distances, so that distances between new (query) objects and the
+    training objects can be rescaled without recomputing the training
+    radii. Each query requires only its own row of distances to the
+    training set, i.e. O(n_train) time.
+
+    Parameters
+    ----------
+    k : int, optional (default: 7)
+        Neighborhood radius for local scaling.
+
+    method : {'ls', 'nicdm'}, optional (default: 'ls')
+        Local scaling [1]_ or the non-iterative contextual dissimilarity
+        measure (NICDM).
+
+    metric : {'distance', 'similarity'}, optional (default: 'distance')
+        Define, whether the matrices are to be treated as distances or
+        similarities. NICDM supports only distances.
+
+    n_jobs : int, optional, default: 1
+        Number of threads for rescaling dense matrices.
+
+        - `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    Attributes
+    ----------
+    r_train_ : ndarray, shape (n_train, )
+        Neighborhood radii of the training objects (distance to the k-th
+        nearest neighbor for LS, mean distance to the k nearest neighbors
+        for NICDM).
+
+    r_geom_ : float
+        Geometric mean of the training radii (NICDM only).
+
+    too_few_ : ndarray, shape (n_train, )
+        Training objects with less than `k` neighbors (sparse input only,
+        all False for dense input).
+
+    References
+    ----------
+    .. [1] Schnitzer, D., Flexer, A., Schedl, M., & Widmer, G. (2012).
+           Local and global scaling reduce hubs in space. The Journal of Machine
+           Learning Research, 13(1), 2871–2902.
+    """
+    def __init__(self, k:int=7, method:str='ls', metric:str='distance',
+                 n_jobs:int=1):
+        self.k = k
+        self.method = method
+        self.metric = metric
+        self.n_jobs = n_jobs
+
+    def _check_params(self):
+        io.check_valid_metric_parameter(self.metric)
+        if self.method not in ['ls', 'nicdm']:
+            raise ValueError("Unknown method '{}'. Must be one of 'ls', "
+                             "'nicdm'.".format(self.method))
+        if self.method == 'nicdm' and self.metric == 'similarity':
+            raise NotImplementedError("NICDM does not support similarity "
+                                      "matrices at the moment.")
+        return self.method == 'nicdm'
+
+    def fit(self, D, y=None):
+        """ Fit the radii of training objects.
+
+        Parameters
+        ----------
+        D : ndarray or csr_matrix, shape (n_train, n_train)
+            Distances (similarities) between training objects.
+            For sparse matrices, only stored values are considered neighbors.
+
+        y : ignored
+
+        Returns
+        -------
+        self : LocalScaling
+        """
+        nicdm = self._check_params()
+        io.check_distance_matrix_shape(D)
+        n = D.shape[0]
+        if issparse(D):
+            self.r_train_, self.too_few_ = _radii_sparse(
+                D.tocsr(), self.k, slice(0, n), self.metric, nicdm)
+        else:
+            self.r_train_ = _radii_dense(
+                D, self.k, slice(0, n), self.metric, nicdm)
+            self.too_few_ = np.zeros(n, dtype=bool)
+        if nicdm:
+            self.r_geom_ = _local_geomean(self.r_train_[~self.too_few_])
+        else:
+            self.r_geom_ = None
+        return self
+
+    def fit_knn(self, neigh_dist):
+        """ Fit the radii of training objects from their neighbor distances.
+
+        Only the `k` nearest neighbors of each object are required, e.g.
+        from :func:`k_neighbor_distances`, a sparse kNN graph, or an
+        approximate nearest neighbor index. No n x n matrix is built.
+
+        Parameters
+        ----------
+        neigh_dist : ndarray, shape (n_train, n_neighbors)
+            Distances (similarities) of each training object to (at least)
+            its `k` nearest neighbors, excluding the object itself.
+            Rows need not be sorted.
+
+        Returns
+        -------
+        self : LocalScaling
+        """
+        nicdm = self._check_params()
+        neigh_dist = check_array(neigh_dist, dtype=np.float64)
+        n, n_neighbors = neigh_dist.shape
+        if n_neighbors < self.k:
+            raise ValueError("Need distances to at least k={} neighbors, "
+                             "got {}.".format(self.k, n_neighbors))
+        self.r_train_ = _radii_dense(neigh_dist, self.k, slice(0, n_neighbors),
+                                     self.metric, nicdm, exclude_self=False)
+        self.too_few_ = np.zeros(n, dtype=bool)
+        if nicdm:
+            self.r_geom_ = _local_geomean(self.r_train_)
+        else:
+            self.r_geom_ = None
+        return self
+
+    def transform_graph(self, G, X:np.ndarray=None,
+                        vector_metric:str='euclidean', copy:bool=True):
+        """ Rescale distances between training objects on a candidate graph.
+
+        Secondary distances are evaluated only for the pairs stored in
+        `G`, e.g. a kNN graph or candidate pairs from an ANN index.
+
+        Parameters
+        ----------
+        G : csr_matrix, shape (n_train, n_train)
+            Sparse candidate graph. Stored values are the primary distances
+            (similarities) of the requested pairs, unless `X` is given.
+
+        X : ndarray, shape (n_train, n_features), optional (default: None)
+            Training vectors. If given, primary distances of the stored
+            pairs are calculated from `X` with `vector_metric`, and the
+            values of `G` are ignored.
+
+        vector_metric : {'euclidean', 'sqeuclidean', 'cosine'}, optional
+            Metric for distances calculated from `X`.
+
+        copy : bool, optional, default: True
+            If False, the data of CSR `G` is overwritten.
+
+        Returns
+        -------
+        G_sec : csr_matrix, shape (n_train, n_train)
+            Secondary distances (similarities) of the stored pairs.
+            Self distances are zero.
+        """
+        check_is_fitted(self, ['r_train_'])
+        n = self.r_train_.size
+        if not issparse(G) or G.shape != (n, n):
+            raise ValueError("Expected sparse candidate graph of shape "
+                             "({0}, {0}).".format(n))
+        G = G.tocsr()
+        if X is not None:
+            G = G.astype(np.float64) if copy else G
+            copy = False
+            row = np.repeat(np.arange(n), np.diff(G.indptr))
+            G.data = _pair_distances(X, row, G.indices, vector_metric)
+        self_value = np.inf if self.metric == 'similarity' else 0.
+        return _rescale_sparse(G, self.r_train_, self.metric,
+                               self.method == 'nicdm', self.too_few_,
+                               self.r_geom_, self_value=self_value, copy=copy)
+
+    def fit_transform(self, D, y=None, copy:bool=True):
+        """ Fit radii and rescale the training distances `D`.
+
+        Equivalent to :func:`local_scaling` or :func:`nicdm`, respectively.
+        Self distances are set to zero. For LS similarities, self
+        similarities are set to one for dense `D` (as in
+        :func:`local_scaling`), and to infinity for sparse `D`.
+        """
+        self.fit(D)
+        nicdm = self.method == 'nicdm'
+        if self.metric == 'similarity':
+            self_value = np.inf if issparse(D) else 1.
+        else:
+            self_value = 0.
+        if issparse(D):
+            return _rescale_sparse(D.tocsr(), self.r_train_, self.metric,
+                                   nicdm, self.too_few_, self.r_geom_,
+                                   self_value=self_value, copy=copy)
+        n_jobs = cpu_count() if self.n_jobs == -1 else self.n_jobs
+        return _rescale_dense(D, self.r_train_, self.metric, nicdm,
+                              r_geom=self.r_geom_, self_value=self_value,
+                              out=_prepare_out(D, copy, None), n_jobs=n_jobs)
+
+    def transform(self, D, copy:bool=True, out:np.ndarray=None):
+        """ Rescale distances between query and training objects.
+
+        Parameters
+        ----------
+        D : ndarray or csr_matrix, shape (n_query, n_train)
+            Distances (similarities) from query objects to the training
+            objects used in :meth:`fit`. The radius of each query is
+            obtained from its own row. Sparse queries with less than `k`
+            stored values are not rescaled.
+
+        copy : bool, optional, default: True
+            If False, floating point `D` (or the data of CSR `D`) is
+            overwritten with the secondary distances.
+
+        out : ndarray, optional, default: None
+            Array (e.g. a memory map) for the secondary distances.
+
+        Returns
+        -------
+        D_sec : ndarray or csr_matrix, shape (n_query, n_train)
+            Secondary distances (similarities) between query and training
+            objects.
+        """
+        check_is_fitted(self, ['r_train_'])
+        nicdm = self.method == 'nicdm'
+        if D.ndim != 2 or D.shape[1] != self.r_train_.size:
+            raise ValueError("Expected distances to {} training objects, "
+                             "got shape {}.".format(self.r_train_.size,
+                                                    D.shape))
+        if issparse(D):
+            D = D.tocsr()
+            r_query, too_few = _radii_sparse(
+                D, self.k, slice(0, D.shape[1]), self.metric, nicdm,
+                exclude_self=False)
+            return _rescale_sparse(D, r_query, self.metric, nicdm, too_few,
+                                   self.r_geom_, self_value=None, copy=copy,
+                                   r_col=self.r_train_)
+        r_query = _radii_dense(D, self.k, slice(0, D.shape[1]), self.metric,
+                               nicdm, exclude_self=False)
+        n_jobs = cpu_count() if self.n_jobs == -1 else self.n_jobs
+        return _rescale_rows_blocked(D, _prepare_out(D, copy, out), r_query,
+                                     self.r_train_, self.metric, nicdm,
+                                     self.r_geom_, n_jobs)
+
+
+#===============================================================================
+# #=============================================================================
+# #                     NEIGHBOR DISTANCES FROM VECTORS
+# #=============================================================================
+#===============================================================================
+VECTOR_METRICS = ['euclidean', 'sqeuclidean', 'cosine']
+
+def _pair_distances(X, rows, cols, metric, Y=None, batch_size=65536):
+    """ Distances between objects `X[rows[i]]` and `Y[cols[i]]`.
+
+    Processed in blocks of pairs, so that only ``batch_size`` vector pairs
+    are gathered at a time.
+    """
+    if metric not in VECTOR_METRICS:
+        raise ValueError("Unknown metric '{}'. Must be one of {}."
+                         .format(metric, VECTOR_METRICS))
+    X = check_array(X, dtype=[np.float64, np.float32])
+    X_norm = row_norms(X, squared=True)
+    if Y is None:
+        Y, Y_norm = X, X_norm
+    else:
+        Y = check_array(Y, dtype=[np.float64, np.float32])
+        Y_norm = row_norms(Y, squared=True)
+    d = np.empty(rows.size)
+    for start in range(0, rows.size, batch_size):
+        i = rows[start:start + batch_size]
+        j = cols[start:start + batch_size]
+        dot = np.einsum('ij,ij->i', X[i], Y[j])
+        if metric == 'cosine':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                d[start:start + i.size] = \
+                    1. - dot / np.sqrt(X_norm[i] * Y_norm[j])
+        else:
+            d[start:start + i.size] = \
+                np.maximum(X_norm[i] + Y_norm[j] - 2 * dot, 0)
+    if metric == 'euclidean':
+        np.sqrt(d, out=d)
+    return d
+
+def _k_neighbor_block(rows, X, Y, X_norm, Y_norm, k, metric, exclude_self,
+                      neigh_dist, neigh_ind):
+    """ Exact k nearest neighbors of one block of query rows. """
+    d = pairwise_distances(X[rows], Y, metric='euclidean', squared=True,
+                           X_norm_squared=X_norm[rows].reshape(-1, 1),
+                           Y_norm_squared=Y_norm.reshape(1, -1)) \
+        if metric != 'cosine' else pairwise_distances(X[rows], Y, 'cosine')
+    if exclude_self:
+        d[np.arange(d.shape[0]), np.arange(rows.start, rows.stop)] = np.inf
+    nn = np.argpartition(d, kth=k-1, axis=1)[:, :k]
+    dk = np.take_along_axis(d, nn, axis=1)
+    order = np.argsort(dk, axis=1, kind='stable')
+    nn = np.take_along_axis(nn, order, axis=1)
+    dk = np.take_along_axis(dk, order, axis=1)
+    if metric == 'euclidean':
+        np.sqrt(dk, out=dk)
+    neigh_dist[rows] = dk
+    neigh_ind[rows] = nn
+    return
+
+def k_neighbor_distances(X:np.ndarray, k:int=7, Y:np.ndarray=None,
+                         metric:str='euclidean', neigh_ind:np.ndarray=None,
+                         return_indices:bool=False, n_jobs:int=1,
+                         batch_size:int=1024):
+    """ Distances to the k nearest neighbors for local scaling radii.
+
+    Provides the input to :meth:`LocalScaling.fit_knn` without building
+    the full distance matrix.
+
+    Parameters
+    ----------
+    X : ndarray, shape (n, n_features)
+        Query vectors.
+
+    k : int, optional (default: 7)
+        Number of nearest neighbors.
+
+    Y : ndarray, shape (m, n_features), optional (default: None)
+        Indexed vectors. If None, neighbors are searched among `X`,
+        excluding each object itself.
+
+    metric : {'euclidean', 'sqeuclidean', 'cosine'}, optional
+        Vector distance metric.
+
+    neigh_ind : ndarray, shape (n, k), optional (default: None)
+        Precomputed neighbor lists, e.g. `Hubness.k_neighbors_` or the
+        result of an approximate nearest neighbor index. If given, only
+        these ``n x k`` distances are calculated.
+
+    return_indices : bool, optional (default: False)
+        Also return the neighbor indices.
+
+    n_jobs : int, optional, default: 1
+        Number of threads for the blocked exact search.
+
+        - `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    batch_size : int, optional (default: 1024)
+        Number of query rows per block. Memory is proportional to
+        ``batch_size x m``.
+
+    Returns
+    -------
+    neigh_dist : ndarray, shape (n, k)
+        Sorted distances to the nearest neighbors.
+
+    neigh_ind : ndarray, shape (n, k)
+        Indices of the nearest neighbors (if `return_indices`).
+    """
+    if metric not in VECTOR_METRICS:
+        raise ValueError("Unknown metric '{}'. Must be one of {}."
+                         .format(metric, VECTOR_METRICS))
+    X = check_array(X, dtype=[np.float64, np.float32])
+    exclude_self = Y is None
+    Y = X if Y is None else check_array(Y, dtype=[np.float64, np.float32])
+    n = X.shape[0]
+    if neigh_ind is not None:
+        neigh_ind = np.asarray(neigh_ind)
+        rows = np.repeat(np.arange(n), neigh_ind.shape[1])
+        neigh_dist = _pair_distances(X, rows, neigh_ind.ravel(), metric,
+                                     Y=Y).reshape(neigh_ind.shape)
+        order = np.argsort(neigh_dist, axis=1, kind='stable')
+        neigh_dist = np.take_along_axis(neigh_dist, order, axis=1)
+        neigh_ind = np.take_along_axis(neigh_ind, order, axis=1)
+    else:
+        if k > Y.shape[0] - (1 if exclude_self else 0):
+            raise ValueError("Neighborhood size k={} too large for {} "
+                             "indexed objects.".format(k, Y.shape[0]))
+        if n_jobs == -1:
+            n_jobs = cpu_count()
+        neigh_dist = np.empty((n, k))
+        neigh_ind = np.empty((n, k), dtype=np.intp)
+        func = partial(_k_neighbor_block, X=X, Y=Y,
+                       X_norm=row_norms(X, squared=True),
+                       Y_norm=row_norms(Y, squared=True), k=k, metric=metric,
+                       exclude_self=exclude_self, neigh_dist=neigh_dist,
+                       neigh_ind=neigh_ind)
+        blocks = [slice(i, min(i + batch_size, n))
+                  for i in range(0, n, batch_size)]
+        if n_jobs > 1:
+            with ThreadPool(processes=n_jobs) as pool:
+                for _ in pool.imap_unordered(func, blocks):
+                    pass # results handled within func
+        else:
+            for rows in blocks:
+                func(rows)
+    if return_indices:
+        return neigh_dist, neigh_ind
+    return neigh_dist
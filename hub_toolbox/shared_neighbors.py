@@ -13,10 +13,233 @@ Contact: <roman.feldbauer@ofai.at>
 import ctypes
 from functools import partial
 from multiprocessing import cpu_count, Pool, RawArray
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from scipy.sparse import csr_matrix, vstack as sparse_vstack
 from hub_toolbox import io
 
 __all__ = ['snn_sample', 'shared_nearest_neighbors', 'simhub', 'simhubIN']
+VALID_ENGINES = ['sparse', 'packed', 'dense']
+
+#==============================================================================
+# #============================================================================
+# #                         NEIGHBOR SETS AND OVERLAPS
+# #============================================================================
+#==============================================================================
+
+def _knn_indices(D, k, metric, train_ind=None, batch_size=1024):
+    """ Column indices of the `k` nearest neighbors of each row of `D`.
+
+    Rows are processed in blocks with one `np.argpartition` call each, so
+    that only a block of `D` is copied at a time. Self distances are
+    excluded: the diagonal for square `D`, or ``D[train_ind[j], j]`` for
+    sample matrices.
+    """
+    n, m = D.shape
+    if metric == 'similarity':
+        exclude = -np.inf
+        kth = m - k
+        sort_order = -1
+    else:
+        exclude = np.inf
+        kth = k
+        sort_order = 1
+    self_col = np.full(n, -1)
+    if train_ind is None:
+        self_col[:m] = np.arange(min(n, m))
+    else:
+        self_col[train_ind] = np.arange(m)
+    nn = np.empty((n, k), dtype=np.intp)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        block = np.array(D[start:stop])
+        rows = np.flatnonzero(self_col[start:stop] >= 0)
+        block[rows, self_col[start:stop][rows]] = exclude
+        part = np.argpartition(block, kth=kth, axis=1)
+        nn[start:stop] = part[:, ::sort_order][:, :k]
+    return nn
+
+def _knn_indicator(nn, n_cols, dtype=np.int32):
+    """ Sparse kNN indicator matrix with ``n x k`` stored ones. """
+    n, k = nn.shape
+    return csr_matrix((np.ones(n * k, dtype=dtype), nn.ravel(),
+                       np.arange(0, n * k + 1, k)), shape=(n, n_cols))
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                           dtype=np.uint8)
+
+def _popcount(x):
+    """ Number of set bits in each element of uint64 array `x`. """
+    try:
+        return np.bitwise_count(x)
+    except AttributeError: # numpy < 2.0
+        return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(
+            x.shape + (8, )).sum(axis=-1, dtype=np.uint8)
+
+def _pack_knn(nn, n_cols):
+    """ Bit-packed kNN sets: one row of uint64 words per object.
+
+    Bit order corresponds to `np.packbits`, so that the uint8 view of the
+    words can be restored with `np.unpackbits`.
+    """
+    n, k = nn.shape
+    n_words = -(-n_cols // 64)
+    P = np.zeros((n, n_words), dtype=np.uint64)
+    P8 = P.view(np.uint8)
+    rows = np.repeat(np.arange(n), k)
+    cols = nn.ravel()
+    np.bitwise_or.at(P8, (rows, cols >> 3),
+                     (1 << (7 - (cols & 7))).astype(np.uint8))
+    return P
+
+def _unpack_knn(P, n_cols, dtype=np.float64):
+    """ Dense 0/1 indicator rows from bit-packed kNN sets. """
+    return np.unpackbits(P.view(np.uint8), axis=1,
+                         count=n_cols).astype(dtype)
+
+def _packed_block(rows, P, P_train, out, scale, metric, col_batch=4096):
+    """ Popcount intersection of a block of rows with all training rows.
+
+    Loops over the uint64 words (skipping words without any set bit in the
+    block), so that each step is one vectorized ``rows x cols`` operation.
+    """
+    A = np.ascontiguousarray(P[rows].T)
+    a_active = A.any(axis=1)
+    for c0 in range(0, P_train.shape[0], col_batch):
+        cols = slice(c0, min(c0 + col_batch, P_train.shape[0]))
+        B = np.ascontiguousarray(P_train[cols].T)
+        ov = np.zeros((A.shape[1], B.shape[1]), dtype=np.int32)
+        for t in np.flatnonzero(a_active & B.any(axis=1)):
+            ov += _popcount(A[t, :, None] & B[t, None, :])
+        if metric == 'distance':
+            out[rows, cols] = 1. - ov / scale
+        else:
+            out[rows, cols] = ov / scale
+    return
+
+def _weighted_block(rows, P, P_train, out, scale, metric, weights, n_cols,
+                    col_batch=4096):
+    """ Weighted intersection of bit-packed kNN sets via blocked GEMM.
+
+    Rows are unpacked to 0/1 indicators one block at a time, so that only
+    ``rows x n_cols`` and ``col_batch x n_cols`` dense arrays are in memory.
+    """
+    A = _unpack_knn(P[rows], n_cols) * weights
+    for c0 in range(0, P_train.shape[0], col_batch):
+        cols = slice(c0, min(c0 + col_batch, P_train.shape[0]))
+        ov = A @ _unpack_knn(P_train[cols], n_cols).T
+        if metric == 'distance':
+            out[rows, cols] = 1. - ov / scale
+        else:
+            out[rows, cols] = ov / scale
+    return
+
+def _overlap_packed(P, P_train, scale, metric, weights=None, n_cols=None,
+                    n_jobs=1, batch_size=256, dtype=np.float64):
+    """ Dense (normalized) overlaps of bit-packed kNN sets. """
+    n = P.shape[0]
+    out = np.empty((n, P_train.shape[0]), dtype=dtype)
+    if weights is None:
+        func = partial(_packed_block, P=P, P_train=P_train, out=out,
+                       scale=scale, metric=metric)
+    else:
+        func = partial(_weighted_block, P=P, P_train=P_train, out=out,
+                       scale=scale, metric=metric, weights=weights,
+                       n_cols=n_cols)
+    blocks = [slice(i, min(i + batch_size, n))
+              for i in range(0, n, batch_size)]
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            for _ in pool.imap_unordered(func, blocks):
+                pass # results handled within func
+    else:
+        for rows in blocks:
+            func(rows)
+    return out
+
+def _overlap_block(rows, K, K_T, out, scale, metric):
+    """ Shared neighbor counts of a block of rows via sparse products. """
+    ov = (K[rows] @ K_T).toarray()
+    if metric == 'distance':
+        out[rows] = 1. - ov / scale
+    else:
+        out[rows] = ov / scale
+    return
+
+def _csr_top_k(S, top_k):
+    """ Keep the `top_k` largest stored values in each row of CSR `S`. """
+    row = np.repeat(np.arange(S.shape[0]), np.diff(S.indptr))
+    order = np.lexsort((-S.data, row))
+    pos = np.arange(S.nnz) - S.indptr[row]
+    keep = order[pos < top_k]
+    row = row[keep]
+    indptr = np.zeros(S.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=S.shape[0]), out=indptr[1:])
+    S_k = csr_matrix((S.data[keep], S.indices[keep], indptr), shape=S.shape)
+    S_k.sort_indices()
+    return S_k
+
+def _graph_block(rows, K, K_T, scale, self_value, top_k):
+    """ Sparse overlap graph of a block of rows. """
+    S = (K[rows] @ K_T).tocsr().astype(np.float64)
+    S.data /= scale
+    if self_value is not None:
+        start = rows.start
+        S.setdiag(self_value, k=start)
+    S.eliminate_zeros()
+    if top_k is not None:
+        S = _csr_top_k(S, top_k)
+    return S
+
+def _overlap_graph(K, K_train, scale, weights=None, self_value=None,
+                   top_k=None, n_jobs=1, batch_size=1024):
+    """ Sparse graph of (weighted, normalized) overlaps ``K @ K_train.T``.
+
+    Only pairs sharing at least one neighbor, i.e. pairs within two hops
+    of the kNN graph, are enumerated by the sparse product. Rows are
+    processed in blocks, and optionally reduced to their `top_k` largest
+    overlaps, so that memory stays O(n * top_k) for the output.
+    Self values are set on the diagonal, unless `self_value` is None.
+    """
+    n = K.shape[0]
+    if weights is not None:
+        K_train = K_train.multiply(weights[np.newaxis, :])
+    K_T = K_train.T.tocsr()
+    blocks = [slice(i, min(i + batch_size, n))
+              for i in range(0, n, batch_size)]
+    func = partial(_graph_block, K=K, K_T=K_T, scale=scale,
+                   self_value=self_value, top_k=top_k)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            graphs = pool.map(func, blocks)
+    else:
+        graphs = [func(rows) for rows in blocks]
+    return sparse_vstack(graphs, format='csr')
+
+def _overlap_sparse(K, K_train, scale, metric, weights=None, n_jobs=1,
+                    batch_size=1024, dtype=np.float64):
+    """ Dense (normalized) overlaps ``K @ K_train.T`` in blocks of rows.
+
+    With `weights`, the weighted overlaps ``K @ diag(weights) @ K_train.T``
+    are computed instead.
+    """
+    n = K.shape[0]
+    out = np.empty((n, K_train.shape[0]), dtype=dtype)
+    if weights is not None:
+        K_train = K_train.multiply(weights[np.newaxis, :])
+    K_T = K_train.T.tocsr()
+    blocks = [slice(i, min(i + batch_size, n))
+              for i in range(0, n, batch_size)]
+    func = partial(_overlap_block, K=K, K_T=K_T, out=out, scale=scale,
+                   metric=metric)
+    if n_jobs > 1:
+        with ThreadPool(processes=n_jobs) as pool:
+            for _ in pool.imap_unordered(func, blocks):
+                pass # results handled within func
+    else:
+        for rows in blocks:
+            func(rows)
+    return out
 
 #==============================================================================
 # #============================================================================
@@ -51,11 +274,9 @@ def _snns_our_hood(i, k, metric):
 
 def snn_sample(D:np.ndarray, k:int=10, metric='distance',
                train_ind:np.ndarray=None, test_ind:np.ndarray=None,
-               n_jobs:int=1):
+               n_jobs:int=1, engine:str='sparse'):
     """Transform distance matrix using shared nearest neighbors [1]_.
 
-    __DRAFT_VERSION__
-
     SNN similarity is based on computing the overlap between the `k` nearest
     neighbors of two objects. SNN approaches try to symmetrize nearest neighbor
     relations using only rank and not distance information [2]_.
@@ -81,15 +302,26 @@ def snn_sample(D:np.ndarray, k:int=10, metric='distance',
         - ndarray : Hold out points indexed in this array as test set. 
 
     n_jobs : int, optional, default: 1
-        Number of processes for parallel computations.
+        Number of processes (threads for engines 'sparse' and 'packed')
+        for parallel computations.
 
         - `1`: Don't use multiprocessing.
         - `-1`: Use all CPUs
 
+    engine : {'sparse', 'packed', 'dense'}, optional, default: 'sparse'
+        - 'sparse': Find all kNN sets with blocked `np.argpartition`, and
+          count shared neighbors as ``K @ K[train_ind].T`` with a CSR
+          indicator matrix ``K``. Recommended for very large ``n``.
+        - 'packed': Intersect bit-packed kNN sets with a vectorized
+          popcount (8x less memory).
+        - 'dense': Intersect boolean kNN matrices.
+
     Returns
     -------
     D_snn : ndarray
-        Secondary distance SNN matrix
+        Secondary distance SNN matrix of shape ``n x s``
+        (or ``test_ind.size x s``). Self distances ``D[train_ind[j], j]``
+        are set to zero (one for similarities).
 
     References
     ---------- 
@@ -104,6 +336,29 @@ def snn_sample(D:np.ndarray, k:int=10, metric='distance',
     """
     io.check_sample_shape_fits(D, train_ind)
     io.check_valid_metric_parameter(metric)
+    if engine not in VALID_ENGINES:
+        raise ValueError("Unknown engine '{}'. Must be one of {}."
+                         .format(engine, VALID_ENGINES))
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if engine in ['sparse', 'packed']:
+        nn = _knn_indices(D, k, metric, train_ind)
+        rows = np.arange(D.shape[0]) if test_ind is None else test_ind
+        dtype = D.dtype if np.issubdtype(D.dtype, np.floating) else np.float64
+        if engine == 'sparse':
+            K = _knn_indicator(nn, D.shape[1])
+            D_snn = _overlap_sparse(K[rows], K[train_ind], k, metric,
+                                    n_jobs=n_jobs, dtype=dtype)
+        else:
+            P = _pack_knn(nn, D.shape[1])
+            D_snn = _overlap_packed(P[rows], P[train_ind], k, metric,
+                                    n_jobs=n_jobs, dtype=dtype)
+        self_rows = np.full(D.shape[0], -1)
+        self_rows[rows] = np.arange(len(rows))
+        is_self = self_rows[train_ind] >= 0
+        D_snn[self_rows[train_ind][is_self], np.flatnonzero(is_self)] = \
+            0. if metric == 'distance' else 1.
+        return D_snn
     if metric == 'distance':
         self_value = 0.
         sort_order = 1
@@ -159,12 +414,11 @@ def snn_sample(D:np.ndarray, k:int=10, metric='distance',
                 D_snn[i, :] = Dij / k
 
     # Ensure correct self distances and return sec. dist. matrix
+    for j, sample in enumerate(train_ind):
+        D_snn[sample, j] = self_value
     if test_ind is None:
-        np.fill_diagonal(D_snn, self_value)
         return D_snn
     else:
-        for j, sample in enumerate(train_ind):
-            D_snn[sample, j] = self_value
         return D_snn[test_ind]
 
 #==============================================================================
@@ -197,7 +451,8 @@ def _snn_our_hood(i, k, metric):
     return
 
 def shared_nearest_neighbors(D:np.ndarray, k:int=10, metric='distance',
-                             n_jobs:int=1):
+                             n_jobs:int=1, engine:str='sparse',
+                             return_sparse:bool=False, top_k:int=None):
     """Transform distance matrix using shared nearest neighbors [1]_.
 
     SNN similarity is based on computing the overlap between the `k` nearest
@@ -216,14 +471,35 @@ def shared_nearest_neighbors(D:np.ndarray, k:int=10, metric='distance',
         Define, whether the matrix `D` is a distance or similarity matrix
 
     n_jobs : int, optional, default: 1
-        Number of processes for parallel computations.
+        Number of processes (threads for engines 'sparse' and 'packed')
+        for parallel computations.
 
         - `1`: Don't use multiprocessing.
         - `-1`: Use all CPUs
 
+    engine : {'sparse', 'packed', 'dense'}, optional, default: 'sparse'
+        - 'sparse': Store the kNN indicator as CSR matrix ``K`` with
+          ``n x k`` nonzeros, and count shared neighbors as ``K @ K.T``.
+        - 'packed': Store kNN sets as bit-packed uint64 words (8x less
+          memory than boolean arrays), and intersect blocks of rows with
+          a vectorized popcount.
+        - 'dense': Intersect dense boolean ``n x n`` kNN matrices (legacy).
+
+    return_sparse : bool, optional, default: False
+        Return the sparse overlap graph (engine 'sparse' only). It stores
+        SNN *similarities* of all pairs with at least one shared neighbor
+        (irrespective of `metric`), since missing entries denote zero
+        overlap. Self similarities are 1. Only candidate pairs within two
+        hops of the kNN graph are evaluated, i.e. O(n * k^2) instead of
+        O(n^2) pairs.
+
+    top_k : int, optional, default: None
+        With `return_sparse`, keep only the `top_k` largest similarities
+        in each row (including the self similarity).
+
     Returns
     -------
-    D_snn : ndarray
+    D_snn : ndarray or csr_matrix
         Secondary distance SNN matrix
 
     References
@@ -239,7 +515,27 @@ def shared_nearest_neighbors(D:np.ndarray, k:int=10, metric='distance',
     """
     io.check_distance_matrix_shape(D)
     io.check_valid_metric_parameter(metric)
+    if engine not in VALID_ENGINES:
+        raise ValueError("Unknown engine '{}'. Must be one of {}."
+                         .format(engine, VALID_ENGINES))
+    if return_sparse and engine != 'sparse':
+        raise ValueError("Sparse output requires engine 'sparse'.")
     n = D.shape[0]
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if engine == 'sparse':
+        K = _knn_indicator(_knn_indices(D, k, metric), n)
+        if return_sparse:
+            return _overlap_graph(K, K, k, self_value=1., top_k=top_k,
+                                  n_jobs=n_jobs)
+        D_snn = _overlap_sparse(K, K, k, metric, n_jobs=n_jobs)
+        np.fill_diagonal(D_snn, 0. if metric == 'distance' else 1.)
+        return D_snn
+    if engine == 'packed':
+        P = _pack_knn(_knn_indices(D, k, metric), n)
+        D_snn = _overlap_packed(P, P, k, metric, n_jobs=n_jobs)
+        np.fill_diagonal(D_snn, 0. if metric == 'distance' else 1.)
+        return D_snn
     if metric == 'distance':
         self_value = 0.
         sort_order = 1
@@ -327,16 +623,28 @@ def _shi_simhub_vect(i, s):
     D_shi[i, :] = np.sum(x * I_n, axis=1)
     return
 
-def _shi_simhub(i, s, m):
-    # use non-vectorized loops
-    for j in range(m):
-        x = np.logical_and(knn[i, :], knn[j, :])
-        D_shi[i, j] = np.sum(x * I_n)
+def _shi_simhub_matvec(i, s):
+    # memory-light product over the s neighbors of i (no m x m temporary)
+    nn_i = np.flatnonzero(knn[i, :])
+    D_shi[i, :] = knn[:, nn_i][train_ind] @ I_n[nn_i]
     return
 
+def _occurrence_informativeness(nn, m):
+    """ Occurrence informativeness ``I_n = log(m / N_s)`` from kNN indices.
+
+    Reverse neighbor counts ``N_s`` are taken over the first `m` objects,
+    each of which also counts as its own neighbor.
+    """
+    nn_m = nn[:m]
+    N_s = np.bincount(nn_m.ravel(), minlength=m)
+    self_in_knn = (nn_m == np.arange(nn_m.shape[0])[:, np.newaxis]).any(axis=1)
+    N_s[:nn_m.shape[0]] += ~self_in_knn
+    return np.log(m / N_s)
+
 def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
              test_ind:np.ndarray=None, s:int=50, return_distances:bool=True,
-             n_jobs:int=1):
+             n_jobs:int=1, engine:str='sparse', return_sparse:bool=False,
+             top_k:int=None):
     """Calculate dissimilarity based on hubness-aware SNN distances [1]_.
 
     Parameters
@@ -364,14 +672,31 @@ def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
         Otherwise return similarities.
 
     n_jobs : int, optional, default: 1
-        Number of processes for parallel computations.
+        Number of processes (threads for engines 'sparse' and 'packed')
+        for parallel computations.
 
         - `1`: Don't use multiprocessing.
         - `-1`: Use all CPUs
 
+    engine : {'sparse', 'packed', 'dense'}, optional, default: 'sparse'
+        - 'sparse': Store the kNN indicator as CSR matrix ``K`` and compute
+          weighted overlaps as ``K @ diag(I_n) @ K.T`` in blocks of rows.
+        - 'packed': Store kNN sets bit-packed (8x less memory), and
+          compute weighted overlaps block-wise from unpacked indicators.
+        - 'dense': Intersect boolean kNN matrices.
+
+    return_sparse : bool, optional, default: False
+        Return a sparse graph of simhubIN *similarities* (engine 'sparse'
+        only, irrespective of `return_distances`). Only candidate pairs
+        within two hops of the kNN graph are evaluated.
+
+    top_k : int, optional, default: None
+        With `return_sparse`, keep only the `top_k` largest similarities
+        in each row.
+
     Returns
     -------
-    D_shi : ndarray
+    D_shi : ndarray or csr_matrix
         Secondary distance (simhubIN) matrix.
 
     References
@@ -386,6 +711,36 @@ def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
         io.check_distance_matrix_shape(D)
     else:
         io.check_sample_shape_fits(D, train_ind)
+    if engine not in VALID_ENGINES:
+        raise ValueError("Unknown engine '{}'. Must be one of {}."
+                         .format(engine, VALID_ENGINES))
+    if return_sparse and engine != 'sparse':
+        raise ValueError("Sparse output requires engine 'sparse'.")
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if engine in ['sparse', 'packed']:
+        n, m = D.shape
+        nn = _knn_indices(D, s, 'distance', train_ind)
+        I_n = _occurrence_informativeness(nn, m)
+        rows = slice(None) if test_ind is None else test_ind
+        cols = slice(None) if train_ind is None else train_ind
+        metric = 'distance' if return_distances else 'similarity'
+        if engine == 'sparse':
+            K = _knn_indicator(nn, m, dtype=np.float64)
+            if return_sparse:
+                return _overlap_graph(
+                    K[rows], K[cols], s * np.log(m), weights=I_n,
+                    self_value=1. if test_ind is None else None,
+                    top_k=top_k, n_jobs=n_jobs)
+            D_shi = _overlap_sparse(K[rows], K[cols], s * np.log(m), metric,
+                                    weights=I_n, n_jobs=n_jobs)
+        else:
+            P = _pack_knn(nn, m)
+            D_shi = _overlap_packed(P[rows], P[cols], s * np.log(m), metric,
+                                    weights=I_n, n_cols=m, n_jobs=n_jobs)
+        if test_ind is None:
+            np.fill_diagonal(D_shi, 0. if return_distances else 1)
+        return D_shi
     # Assuming distances in D
     self_value = 0.
     sort_order = 1
@@ -448,7 +803,7 @@ def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
                     pass
             else:
                 for _ in pool.imap(
-                    func=partial(_shi_simhub, s=s, m=m),
+                    func=partial(_shi_simhub_matvec, s=s),
                     iterable=n_ind):
                     pass
     else:
@@ -457,11 +812,10 @@ def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
             for i in n_ind:
                 x = np.logical_and(knn[i, :], knn[train_ind, :])
                 D_shi[i, :] = np.sum(x * I_n, axis=1)
-        else: # use non-vectorized loops
+        else: # products over the s neighbors avoid (m x m) temporaries
             for i in n_ind:
-                for j in range(m):
-                    x = np.logical_and(knn[i, :], knn[j, :])
-                    D_shi[i, j] = np.sum(x * I_n)
+                nn_i = np.flatnonzero(knn[i, :])
+                D_shi[i, :] = knn[:, nn_i][train_ind] @ I_n[nn_i]
     del knn
     # Normalization to [0, 1] range
     D_shi /= (s * np.log(m))
@@ -481,9 +835,32 @@ def simhubIN(D:np.ndarray, train_ind:np.ndarray=None,
         # only return test-train-distances (there are no self distances here)
         return D_shi[test_ind]
 
+def _purity_weights(nn, m, y):
+    """ Occurrence informativeness times purity information gain.
+
+    Class-specific reverse neighbor counts of the first `m` objects are
+    obtained with one `np.bincount` over (neighbor, label) pairs.
+    Returns the per-neighbor weights and the maximum entropy.
+    """
+    nn_m = nn[:m]
+    # Account for each point being the 0th nearest neighbor
+    N_s = np.bincount(nn_m.ravel(), minlength=m) + 1
+    if y is None:
+        return np.log(m / N_s), 1.
+    C, y_idx = np.unique(y, return_inverse=True)
+    labels = np.repeat(y_idx[:nn_m.shape[0]], nn_m.shape[1])
+    N_sc = np.bincount(nn_m.ravel() * C.size + labels,
+                       minlength=m * C.size).reshape(m, C.size) + 1
+    N_sc = N_sc / N_s[:, np.newaxis]
+    HR_s = -np.sum(N_sc * np.log(N_sc), axis=1)
+    max_H_s = np.log(C.size)
+    info_gain = max_H_s - HR_s
+    return np.log(m / N_s) * info_gain, max_H_s
+
 def simhub(D:np.ndarray, y:np.ndarray, train_ind:np.ndarray=None, 
            test_ind:np.ndarray=None, s:int=50, return_distances:bool=True,
-           vect_usage:int=0):
+           vect_usage:int=0, n_jobs:int=1, engine:str='sparse',
+           return_sparse:bool=False, top_k:int=None):
     """Calculate dissimilarity based on hubness-aware SNN distances [1]_.
 
     Parameters
@@ -515,15 +892,38 @@ def simhub(D:np.ndarray, y:np.ndarray, train_ind:np.ndarray=None,
         Otherwise return similarities.
 
     vect_usage : int, optional, default: 0
+        Only used with engine 'dense'.
         If > 0, always use vectorization for the inner simhub loop.
         If < 0, always use nested loops.
         If == 0, this is dependent on data set size
         and vectorization is used if ``n >= 2000``.
 
+    n_jobs : int, optional, default: 1
+        Number of threads for engines 'sparse' and 'packed'.
+
+        - `1`: Don't use multiprocessing.
+        - `-1`: Use all CPUs
+
+    engine : {'sparse', 'packed', 'dense'}, optional, default: 'sparse'
+        - 'sparse': Purity weights from one label histogram of reverse
+          neighbors, fused with the sparse weighted overlap
+          ``K @ diag(I_n * info_gain) @ K.T``.
+        - 'packed': Bit-packed kNN sets, weighted overlaps by blocked GEMM.
+        - 'dense': Boolean kNN matrices (see `vect_usage`).
+
+    return_sparse : bool, optional, default: False
+        Return a sparse graph of simhub *similarities* (engine 'sparse'
+        only, irrespective of `return_distances`). Only candidate pairs
+        within two hops of the kNN graph are evaluated.
+
+    top_k : int, optional, default: None
+        With `return_sparse`, keep only the `top_k` largest similarities
+        in each row.
+
     Returns
     -------
-    D_shi : ndarray
-        Secondary distance (simhubIN) matrix.
+    D_shi : ndarray or csr_matrix
+        Secondary distance (simhub) matrix.
 
     References
     ----------
@@ -537,15 +937,46 @@ def simhub(D:np.ndarray, y:np.ndarray, train_ind:np.ndarray=None,
         io.check_distance_matrix_shape(D)
     else:
         io.check_sample_shape_fits(D, train_ind)
+    if engine not in VALID_ENGINES:
+        raise ValueError("Unknown engine '{}'. Must be one of {}."
+                         .format(engine, VALID_ENGINES))
+    n, m = D.shape
+    if not 0 < s < m:
+        raise ValueError("Neighbor hood size s, must be [1, {}-1], but "
+                         "was {}.".format(m, s))
+    if return_sparse and engine != 'sparse':
+        raise ValueError("Sparse output requires engine 'sparse'.")
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if engine in ['sparse', 'packed']:
+        nn = _knn_indices(D, s, 'distance', train_ind)
+        weights, max_H_s = _purity_weights(nn, m, y)
+        rows = slice(None) if test_ind is None else test_ind
+        cols = slice(None) if train_ind is None else train_ind
+        metric = 'distance' if return_distances else 'similarity'
+        scale = s * np.log(m) * max_H_s
+        if engine == 'sparse':
+            K = _knn_indicator(nn, m, dtype=np.float64)
+            if return_sparse:
+                return _overlap_graph(
+                    K[rows], K[cols], scale, weights=weights,
+                    self_value=1. if test_ind is None else None,
+                    top_k=top_k, n_jobs=n_jobs)
+            D_shi = _overlap_sparse(K[rows], K[cols], scale, metric,
+                                    weights=weights, n_jobs=n_jobs)
+        else:
+            P = _pack_knn(nn, m)
+            D_shi = _overlap_packed(P[rows], P[cols], scale, metric,
+                                    weights=weights, n_cols=m, n_jobs=n_jobs)
+        if test_ind is None:
+            np.fill_diagonal(D_shi, 0. if return_distances else 1)
+        return D_shi
+
     # Assuming distances in D
     self_value = 0.
     sort_order = 1
     exclude = np.inf
     distance = D.copy()
-    n, m = distance.shape
-    if not 0 < s < m:
-        raise ValueError("Neighbor hood size s, must be [1, {}-1], but "
-                         "was {}.".format(m, s))
     if test_ind is None:
         n_ind = range(n)
     else:
@@ -578,7 +1009,7 @@ def simhub(D:np.ndarray, y:np.ndarray, train_ind:np.ndarray=None,
         N_sc = np.zeros((C.size, m))
         for c_idx, c_val in enumerate(C):
             N_sc[c_idx, :] = np.sum(knn[:m, :] * (y==c_val).reshape(-1, 1), axis=0)
-        assert np.alltrue(N_sc.sum(axis=0) == N_s), "N_s,c(x) don't sum up to N_s(x)"
+        assert np.all(N_sc.sum(axis=0) == N_s), "N_s,c(x) don't sum up to N_s(x)"
 
         # Account for each point being the 0th nearest neighbor
         N_sc += 1
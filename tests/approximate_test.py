@@ -13,6 +13,7 @@ import unittest
 import numpy as np
 from sklearn.datasets import make_classification
 from sklearn.model_selection import train_test_split
+from sklearn.neighbors import KNeighborsClassifier
 from hub_toolbox import approximate
 from sklearn.metrics.classification import accuracy_score
 
@@ -68,6 +69,38 @@ class ApproximateHRTest(unittest.TestCase):
         total_time = hr.time_fit_ + hr.time_transform_ + hr.time_predict_
         self.accu_time += total_time.total.values
 
+    def test_predict_knn_equals_sklearn(self):
+        rng = np.random.RandomState(1234)
+        n_train, n_test, n_vantage, k = 200, 40, 60, 5
+        y_train = rng.randint(0, 2, n_train).astype(np.int32)
+        sec_dist = rng.rand(n_test, n_vantage)
+        ind_test = np.array([rng.choice(n_train, n_vantage, replace=False)
+                             for _ in range(n_test)])
+        for fixed_vantage_pts in [True, False]:
+            for weights in ['uniform', 'distance', lambda d: 1. / d**2]:
+                hr = approximate.SuQHR(knn__n_neighbors=k,
+                                       knn__weights=weights)
+                hr.fixed_vantage_pts_ = fixed_vantage_pts
+                if fixed_vantage_pts:
+                    hr.y_train_ = y_train[:n_vantage]
+                else:
+                    hr.y_train_ = y_train
+                    hr.ind_test_ = ind_test
+                hr.sec_dist_ = sec_dist
+                y_pred = hr._predict_knn(hr.sec_dist_)
+                knn = KNeighborsClassifier(n_neighbors=k, weights=weights,
+                                           algorithm='brute',
+                                           metric='precomputed')
+                dummy = np.zeros((n_vantage, n_vantage))
+                if fixed_vantage_pts:
+                    knn.fit(dummy, y_train[:n_vantage])
+                    y_sklearn = knn.predict(sec_dist)
+                else:
+                    y_sklearn = np.array([
+                        knn.fit(dummy, y_train[ind_test[i]]).predict(
+                            sec_dist[i:i+1])[0] for i in range(n_test)])
+                np.testing.assert_array_equal(y_pred, y_sklearn)
+
     def test_approximate_hubness_reduction(self):
         for hr_algorithm in self.hr_algorithms:
             for sampling_algorithm in self.sampling_algorithms:
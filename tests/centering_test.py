@@ -11,9 +11,12 @@ Contact: <roman.feldbauer@ofai.at>
 """
 import unittest
 import numpy as np
+from scipy.spatial.distance import cdist
 from sklearn.preprocessing import StandardScaler
 from hub_toolbox.centering import centering, weighted_centering, \
-    localized_centering, dis_sim_global, dis_sim_local
+    localized_centering, dis_sim_global, dis_sim_local, Centering, \
+    WeightedCentering
+from hub_toolbox.distances import cosine_distance
 from hub_toolbox.io import load_dexter
 from hub_toolbox.hubness import hubness
 from hub_toolbox.knn_classification import score
@@ -30,6 +33,22 @@ class TestCentering(unittest.TestCase):
         return np.testing.assert_array_almost_equal(
             vectors_cent, vectors_sklearn_cent, decimal=7)
 
+    def test_kernel_centering_equal_to_centered_vectors(self):
+        X = self.vectors[:, :200]
+        K = X @ X.T
+        X_cent = centering(X, 'vector')
+        K_expected = X_cent @ X_cent.T
+        atol = np.abs(K_expected).max()
+        K_cent = centering(K, 'inner', batch_size=77)
+        np.testing.assert_allclose(K_cent, K_expected, atol=1e-12 * atol)
+        K32 = K.astype(np.float32)
+        K_cent32 = centering(K32, 'inner', copy=False)
+        self.assertIs(K_cent32, K32)
+        np.testing.assert_allclose(K_cent32, K_expected, atol=1e-5 * atol)
+        out = np.empty_like(K)
+        centering(K, 'inner', out=out)
+        return np.testing.assert_allclose(out, K_cent, atol=1e-12 * atol)
+
     def test_weighted_centering_with_gamma_zero_equal_centering(self):
         vectors_wcent = weighted_centering(self.vectors, 'cosine', gamma=0.)
         vectors_cent = centering(self.vectors, 'vector')
@@ -42,6 +61,37 @@ class TestCentering(unittest.TestCase):
         vectors_cent = centering(self.vectors, 'vector')
         return self.assertNotEqual((vectors_cent - vectors_wcent).sum(), 0)
 
+    def test_centering_transformers_out_of_sample(self):
+        test_set_mask = np.arange(0, self.vectors.shape[0], 4)
+        train_ind = np.setdiff1d(np.arange(self.vectors.shape[0]),
+                                 test_set_mask)
+        X_train = self.vectors[train_ind]
+        n_train = X_train.shape[0]
+        X_cent = Centering().fit(X_train).transform(self.vectors)
+        np.testing.assert_allclose(
+            X_cent, centering(self.vectors, test_set_mask=test_set_mask))
+        # Reference weights from the training set only (explicit loops)
+        mean = X_train.mean(axis=0)
+        d_ref = {'cosine': np.array(
+                     [n_train * cosine_distance(np.array([x, mean]))[0, 1]
+                      for x in X_train]),
+                 'euclidean': cdist(X_train, X_train).sum(axis=1)}
+        gamma = 2.
+        for metric in ['cosine', 'euclidean']:
+            w_ref = d_ref[metric] ** gamma / np.sum(d_ref[metric] ** gamma)
+            mean_ref = (w_ref[:, np.newaxis] * X_train).sum(axis=0)
+            wcent = WeightedCentering(metric=metric, gamma=gamma).fit(X_train)
+            np.testing.assert_allclose(wcent.weights_, w_ref, rtol=1e-10)
+            np.testing.assert_allclose(wcent.mean_, mean_ref, rtol=1e-10,
+                                       atol=1e-12)
+            X_wcent = weighted_centering(self.vectors, metric, gamma=gamma,
+                                         test_set_mask=test_set_mask)
+            np.testing.assert_allclose(X_wcent, self.vectors - mean_ref,
+                                       rtol=1e-10, atol=1e-12)
+            X_cent0 = WeightedCentering(metric=metric, gamma=0.).fit(
+                X_train).transform(self.vectors)
+            np.testing.assert_allclose(X_cent0, X_cent, atol=1e-10)
+
     def test_localized_centering(self):
         """Test whether hubness and k-NN accuracy improve for dexter"""
         h_orig = hubness(self.distance)[0]
@@ -10,11 +10,13 @@ Austrian Research Institute for Artificial Intelligence (OFAI)
 Contact: <roman.feldbauer@ofai.at>
 """
 import unittest
+from tempfile import TemporaryFile
 import numpy as np
 from scipy.spatial.distance import squareform, pdist
 from scipy.sparse.csr import csr_matrix
 from hub_toolbox.goodman_kruskal import goodman_kruskal_index,\
-    _naive_goodman_kruskal, sparse_goodman_kruskal_index
+    _naive_goodman_kruskal, sparse_goodman_kruskal_index, \
+    sampled_goodman_kruskal_index
 from hub_toolbox.io import random_sparse_matrix
 from hub_toolbox.shared_neighbors import shared_nearest_neighbors
 
@@ -72,6 +74,50 @@ class TestGoodmanKruskal(unittest.TestCase):
         gamma_naive = _naive_goodman_kruskal(dist_snn, self.labels)
         return self.assertEqual(gamma_efficient, gamma_naive)
     
+    def test_goodmankruskal_many_ties_equal_to_naive(self):
+        dist_rounded = np.round(self.distance, 1)
+        gamma_efficient = goodman_kruskal_index(dist_rounded, self.labels)
+        gamma_naive = _naive_goodman_kruskal(dist_rounded, self.labels)
+        return self.assertEqual(gamma_efficient, gamma_naive)
+
+    def test_goodmankruskal_blocked_memmap_and_histogram(self):
+        gamma_naive = _naive_goodman_kruskal(self.distance, self.labels)
+        with TemporaryFile() as f:
+            D = np.memmap(f, dtype=self.distance.dtype, mode='w+',
+                          shape=self.distance.shape)
+            D[:] = self.distance
+            gamma_mm = goodman_kruskal_index(D, self.labels, batch_size=7)
+            gamma_hist = goodman_kruskal_index(D, self.labels, bins=1024)
+            del D
+        self.assertAlmostEqual(gamma_mm, gamma_naive, places=12)
+        return self.assertAlmostEqual(gamma_hist, gamma_naive, places=2)
+
+    def test_goodmankruskal_parallel_equals_sequential(self):
+        sim_sparse = csr_matrix(np.round(self.similarity, 2))
+        for func, D, metric in [
+                (goodman_kruskal_index, self.distance, 'distance'),
+                (sparse_goodman_kruskal_index, sim_sparse, 'similarity')]:
+            gamma_seq = func(D, self.labels, metric=metric, n_jobs=1)
+            gamma_par = func(D, self.labels, metric=metric, n_jobs=4)
+            self.assertEqual(gamma_seq, gamma_par)
+
+    def test_sampled_goodmankruskal_interval_contains_exact(self):
+        gamma = goodman_kruskal_index(self.distance, self.labels)
+        for ci in ['normal', 'bootstrap']:
+            gamma_est, (low, high) = sampled_goodman_kruskal_index(
+                self.distance, self.labels, n_pairs=5000, ci=ci,
+                random_state=123)
+            self.assertTrue(low <= gamma <= high)
+            self.assertTrue(low <= gamma_est <= high)
+            gamma_sim, _ = sampled_goodman_kruskal_index(
+                self.similarity, self.labels, 'similarity', n_pairs=5000,
+                ci=ci, random_state=123)
+            self.assertEqual(gamma_est, gamma_sim)
+            gamma_sparse, _ = sampled_goodman_kruskal_index(
+                csr_matrix(self.similarity), self.labels, 'similarity',
+                n_pairs=5000, ci=ci, random_state=123)
+            self.assertEqual(gamma_sim, gamma_sparse)
+
     def test_correct_handling_equal_similarities_sparse_gk(self):
         sim_snn = 1. - shared_nearest_neighbors(self.distance)
         gamma_sparse = sparse_goodman_kruskal_index(csr_matrix(sim_snn), self.labels)
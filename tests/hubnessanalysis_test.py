@@ -68,6 +68,15 @@ class TestHubnessAnalysis(unittest.TestCase):
              ana.intrinsic_dim is not None)
         return got_all_results
 
+    def test_hubness_analysis_sampled_gk(self):
+        ana = hubness_analysis.HubnessAnalysis(
+            self.dist, self.label, self.vector, 'distance')
+        ana = ana.analyze_hubness(experiments="orig", gk_pairs=1000,
+                                  random_state=1, print_results=False)
+        exp = ana.experiments[0]
+        low, high = exp.gk_interval
+        return self.assertTrue(low <= exp.gk_index <= high)
+
     def test_hubness_analysis_only_with_distances(self):
         """ Check correct handling when no labels, vectors are given."""
         ana = hubness_analysis.HubnessAnalysis(self.dist)
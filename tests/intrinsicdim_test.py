@@ -11,6 +11,8 @@ Contact: <roman.feldbauer@ofai.at>
 """
 import unittest
 import numpy as np
+from scipy.sparse import csr_matrix
+from hub_toolbox.distances import euclidean_distance
 from hub_toolbox.io import load_dexter
 from hub_toolbox.intrinsic_dimension import intrinsic_dimension
 
@@ -38,6 +40,15 @@ class TestIntrinsicDim(unittest.TestCase):
                                      'vector', None, mem_threshold=0)
         return np.testing.assert_almost_equal(id_mle, ID_MLE_REF, decimal=3)
 
+    def test_intrinsic_dim_blocked_parallel_equals_full(self):
+        vector = np.random.rand(300, 10)
+        for estimator in ['levina', 'mackay']:
+            id_full = intrinsic_dimension(vector, estimator=estimator)
+            id_blocked = intrinsic_dimension(
+                vector, estimator=estimator, mem_threshold=0, batch_size=32,
+                n_jobs=4)
+            self.assertAlmostEqual(id_blocked, id_full, places=10)
+
     def test_incorrect_est_params(self):
         """ Test handling of incorrect estimator. """
         with self.assertRaises(ValueError):
@@ -65,10 +76,49 @@ class TestIntrinsicDim(unittest.TestCase):
         with self.assertRaises(ValueError):
             intrinsic_dimension(self.vector, trafo=0)
 
-    def test_incorrect_metric_dist(self):
-        """ Test handling of unsupported metric parameters."""
-        with self.assertRaises(NotImplementedError):
-            intrinsic_dimension(self.vector, metric='distance')
+    def test_intrinsic_dim_from_precomputed_distances(self):
+        vector = np.random.rand(300, 10)
+        n = vector.shape[0]
+        k2 = 12
+        D = euclidean_distance(vector)
+        # kNN graph (including self) with more than k2 neighbors
+        nn = np.argsort(D, axis=1)[:, :k2 + 3]
+        graph = csr_matrix((D[np.arange(n)[:, np.newaxis], nn].ravel(),
+                            nn.ravel(), np.arange(0, n * (k2 + 3) + 1, k2 + 3)),
+                           shape=(n, n))
+        neigh_dist = np.sort(D, axis=1)[:, 1:k2 + 1]
+        for estimator in ['levina', 'mackay']:
+            id_vector = intrinsic_dimension(vector, k2=k2, estimator=estimator)
+            for X in [D, graph, neigh_dist]:
+                id_dist = intrinsic_dimension(
+                    X, k2=k2, estimator=estimator, metric='distance',
+                    mem_threshold=0, batch_size=64)
+                self.assertAlmostEqual(id_dist, id_vector, places=6)
+
+    def test_intrinsic_dim_subsampled_bootstrap(self):
+        vector = np.random.rand(500, 3)
+        id_full = intrinsic_dimension(vector)
+        id_sub = intrinsic_dimension(vector, n_queries=200, random_state=3)
+        self.assertAlmostEqual(id_sub, id_full, delta=0.5)
+        id_seq, var_seq = intrinsic_dimension(
+            vector, n_queries=100, n_reference=300, n_boot=8, random_state=3)
+        id_par, var_par = intrinsic_dimension(
+            vector, n_queries=100, n_reference=300, n_boot=8, random_state=3,
+            n_jobs=4)
+        self.assertEqual(id_seq, id_par)
+        self.assertEqual(var_seq, var_par)
+        self.assertTrue(var_seq > 0)
+        self.assertAlmostEqual(id_seq, id_full, delta=0.5)
+
+    def test_incorrect_sparse_dist_too_few_neighbors(self):
+        D = csr_matrix(np.eye(self.vector.shape[0]))
+        with self.assertRaises(ValueError):
+            intrinsic_dimension(D, metric='distance')
+
+    def test_incorrect_sparse_dist_with_reference_sample(self):
+        D = csr_matrix(euclidean_distance(self.vector))
+        with self.assertRaises(ValueError):
+            intrinsic_dimension(D, metric='distance', n_reference=30)
 
     def test_incorrect_metric_sim(self):
         """ Test handling of unsupported metric parameters."""
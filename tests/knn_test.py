@@ -16,13 +16,16 @@ try: # for scikit-learn >= 0.18
     from sklearn.model_selection import LeaveOneOut, cross_val_predict
 except ImportError: # lower scikit-learn versions
     from sklearn.cross_validation import LeaveOneOut, cross_val_predict
+from sklearn.model_selection import StratifiedKFold
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import accuracy_score, f1_score as f1_score_sklearn
 from sklearn.preprocessing import LabelEncoder, LabelBinarizer, OneHotEncoder
 from hub_toolbox.distances import sample_distance
 from hub_toolbox.io import load_dexter, random_sparse_matrix
 from hub_toolbox.knn_classification import \
-    score, predict, f1_score, r_precision, f1_macro, f1_micro, f1_weighted
+    score, predict, f1_score, r_precision, f1_macro, f1_micro, f1_weighted, \
+    weighted_vote, retrieval_metrics, score_cv
+from hub_toolbox.hubness import hubness
 
 
 class TestKnnClassification(unittest.TestCase):
@@ -68,6 +71,32 @@ class TestKnnClassification(unittest.TestCase):
         rppiw = np.average(r_peritem, weights=relevant_items[y_return])
         return self.assertListEqual([rpw, rpm, rppiw], [0.25, 1/6, rpw])
 
+    def test_r_precision_dense_equal_sparse(self):
+        sim = 1 - self.distance
+        r_sparse = r_precision(csr_matrix(sim), self.label,
+                               metric='similarity', batch_size=64)
+        r_sim = r_precision(sim, self.label, metric='similarity', n_jobs=2,
+                            batch_size=64)
+        r_dist = r_precision(self.distance, self.label, metric='distance')
+        np.testing.assert_allclose(r_sim['per_item'], r_sparse['per_item'])
+        return np.testing.assert_allclose(r_dist['per_item'],
+                                          r_sparse['per_item'])
+
+    def test_retrieval_metrics_dense_sparse_graph(self):
+        k = [1, 5, 20]
+        r_dense = retrieval_metrics(self.distance, self.label, k=k)
+        r_sparse = retrieval_metrics(csr_matrix(1 - self.distance),
+                                     self.label, k=k, metric='similarity',
+                                     n_jobs=2, batch_size=64)
+        _, D_k, _ = hubness(self.distance, k=20)
+        r_graph = retrieval_metrics(D_k.astype(int), self.label, k=k,
+                                    neighbors=True)
+        acc, _, _ = score(self.distance, self.label, k=1)
+        for key in ['precision', 'recall', 'map', 'ndcg']:
+            np.testing.assert_allclose(r_dense[key], r_sparse[key])
+            np.testing.assert_allclose(r_dense[key], r_graph[key])
+        return self.assertAlmostEqual(r_dense['precision'][0], acc[0, 0])
+
     def test_knn_sparse_does_not_error(self):
         """ Does not test correctness of result! """
         sim = random_sparse_matrix(100, 0.1)
@@ -186,6 +215,57 @@ class TestKnnClassification(unittest.TestCase):
                      equal, but the predictions per data point are not."""
             return self.assertTrue(equal_prediction, msg)
 
+    def test_weighted_vote(self):
+        nn_labels = np.array([[0, 1, 1],
+                              [2, 1, 0],
+                              [1, 0, 0],
+                              [0, 0, 0]])
+        nn_dist = np.array([[.1, .5, .6],
+                            [.2, .3, .4],
+                            [.1, .2, .3],
+                            [.1, .2, .3]])
+        mask = np.array([[1, 1, 1],
+                         [1, 1, 1],
+                         [1, 1, 1],
+                         [0, 0, 0]], dtype=bool)
+        uniform = weighted_vote(nn_labels, nn_dist, n_classes=3, mask=mask)
+        distance = weighted_vote(nn_labels, nn_dist, n_classes=3,
+                                 weights='distance', mask=mask)
+        rank, scores = weighted_vote(nn_labels, n_classes=3, weights='rank',
+                                     mask=mask, return_scores=True)
+        self.assertListEqual(uniform.tolist(), [1, 2, 0, -1])
+        self.assertListEqual(distance.tolist(), [0, 2, 1, -1])
+        self.assertListEqual(rank.tolist(), [0, 2, 1, -1])
+        return np.testing.assert_allclose(scores[2], [5/6, 1, 0])
+
+    def test_knn_score_distance_weighted_equal_sklearn(self):
+        acc, _, _ = score(self.distance, self.label, k=5, weights='distance')
+        knclassifier = KNeighborsClassifier(
+            n_neighbors=5, algorithm='brute', metric='precomputed',
+            weights='distance')
+        predicted_sklearn = cross_val_predict(
+            knclassifier, self.distance, self.label, cv=LeaveOneOut())
+        acc_sklearn = accuracy_score(self.label, predicted_sklearn)
+        return self.assertAlmostEqual(acc[0, 0], acc_sklearn, places=7)
+
+    def test_score_cv_equal_sklearn(self):
+        k = [1, 5] # odd k avoids ties, which sklearn breaks differently
+        cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=123)
+        acc = score_cv(self.distance, self.label, k=k, cv=cv)
+        acc_sparse = score_cv(csr_matrix(1 - self.distance), self.label,
+                              k=k, cv=cv, metric='similarity')
+        acc_sklearn = np.zeros_like(acc)
+        for f, (train, test) in enumerate(
+                cv.split(self.distance, self.label)):
+            for j, k_j in enumerate(k):
+                knn = KNeighborsClassifier(
+                    n_neighbors=k_j, algorithm='brute', metric='precomputed')
+                knn.fit(self.distance[np.ix_(train, train)], self.label[train])
+                y_pred = knn.predict(self.distance[np.ix_(test, train)])
+                acc_sklearn[f, j] = accuracy_score(self.label[test], y_pred)
+        np.testing.assert_allclose(acc, acc_sparse)
+        return np.testing.assert_allclose(acc, acc_sklearn)
+
     def test_sample_knn(self):
         """ Make sure that sample-kNN works correctly. """
         # TODO create a stricter test
@@ -11,9 +11,11 @@ Contact: <roman.feldbauer@ofai.at>
 """
 import unittest
 import numpy as np
+from scipy.sparse import csr_matrix
 from scipy.spatial.distance import squareform
 from hub_toolbox.distances import euclidean_distance
-from hub_toolbox.local_scaling import local_scaling, nicdm
+from hub_toolbox.local_scaling import local_scaling, nicdm, LocalScaling, \
+    k_neighbor_distances, local_scaling_sample, nicdm_sample
 from hub_toolbox.hubness import hubness
 from hub_toolbox.knn_classification import score
 
@@ -107,5 +109,101 @@ class TestLocalScaling(unittest.TestCase):
         ls_dist_seq = nicdm(self.dist, n_jobs=1)
         return np.testing.assert_array_equal(ls_dist_seq, ls_dist_par)
 
+    def test_ls_nicdm_inplace_float32(self):
+        self.setUpMod('rnd')
+        for func in [local_scaling, nicdm]:
+            expected = func(self.dist)
+            D = self.dist.astype(np.float32)
+            D_sec = func(D, copy=False)
+            self.assertIs(D_sec, D)
+            self.assertEqual(D_sec.dtype, np.float32)
+            np.testing.assert_allclose(D_sec, expected, rtol=1e-4, atol=1e-6)
+            out = np.empty_like(self.dist)
+            func(self.dist, out=out)
+            np.testing.assert_array_equal(out, expected)
+
+    def test_ls_nicdm_sparse_equal_dense(self):
+        self.setUpMod('rnd')
+        # Store all values (including the zero diagonal) in CSR
+        D_sparse = csr_matrix(self.dist + 1.)
+        D_sparse.data -= 1.
+        test_ind = np.arange(0, self.dist.shape[0], 5)
+        for func in [local_scaling, nicdm]:
+            for t in [None, test_ind]:
+                D_dense = func(self.dist, test_ind=t)
+                D_sec = func(D_sparse, test_ind=t)
+                np.testing.assert_allclose(D_sec.toarray(), D_dense)
+
+    def test_ls_nicdm_out_of_sample(self):
+        self.setUpMod('rnd')
+        test_ind = np.arange(0, self.dist.shape[0], 5)
+        train_ind = np.setdiff1d(np.arange(self.dist.shape[0]), test_ind)
+        D_train = self.dist[np.ix_(train_ind, train_ind)]
+        D_test = self.dist[np.ix_(test_ind, train_ind)]
+        for method, func in [('ls', local_scaling), ('nicdm', nicdm)]:
+            model = LocalScaling(k=7, method=method)
+            D_sec_train = model.fit_transform(D_train)
+            np.testing.assert_allclose(D_sec_train, func(D_train, k=7))
+            D_sec_test = model.transform(D_test)
+            D_full = func(self.dist, k=7, test_ind=test_ind)
+            expected = D_full[np.ix_(test_ind, train_ind)]
+            if method == 'nicdm':
+                # Full NICDM also uses the test radii in the geometric mean
+                expected = expected * D_sec_train[0, 1] \
+                    / D_full[train_ind[0], train_ind[1]]
+            np.testing.assert_allclose(D_sec_test, expected)
+            D_sec_sparse = model.transform(csr_matrix(D_test))
+            np.testing.assert_allclose(D_sec_sparse.toarray(), D_sec_test)
+
+    def test_ls_nicdm_from_knn_graph(self):
+        self.setUpMod('rnd')
+        n = self.dist.shape[0]
+        k = 10
+        neigh_dist, neigh_ind = k_neighbor_distances(
+            self.vector, k=k, return_indices=True, n_jobs=2, batch_size=64)
+        expected = np.sort(self.dist + np.diag(np.full(n, np.inf)), axis=1)
+        np.testing.assert_allclose(neigh_dist, expected[:, :k])
+        graph = csr_matrix((np.ones(n * k), neigh_ind.ravel(),
+                            np.arange(0, n * k + 1, k)), shape=(n, n))
+        mask = graph.toarray() > 0
+        for method, func in [('ls', local_scaling), ('nicdm', nicdm)]:
+            model = LocalScaling(k=7, method=method).fit_knn(neigh_dist)
+            D_sec = model.transform_graph(graph, X=self.vector)
+            self.assertEqual(D_sec.nnz, n * k)
+            np.testing.assert_allclose(D_sec.toarray()[mask],
+                                       func(self.dist, k=7)[mask])
+
+    def test_k_neighbor_distances_k_bounds(self):
+        self.setUpMod('rnd')
+        X = self.vector[:20]
+        n = X.shape[0]
+        neigh_dist = k_neighbor_distances(X, k=n-1)
+        self.assertTrue(np.all(np.isfinite(neigh_dist)))
+        with self.assertRaises(ValueError):
+            k_neighbor_distances(X, k=n)
+        Y = self.vector[20:30]
+        m = Y.shape[0]
+        neigh_dist = k_neighbor_distances(X, k=m, Y=Y)
+        self.assertEqual(neigh_dist.shape, (n, m))
+        self.assertTrue(np.all(np.isfinite(neigh_dist)))
+
+    def test_ls_nicdm_sample_equals_full(self):
+        self.setUpMod('rnd')
+        n = self.dist.shape[0]
+        train_ind = np.random.permutation(n)
+        test_ind = np.arange(n//2, n)
+        D_sample = self.dist[:, train_ind]
+        for func, func_sample in [(local_scaling, local_scaling_sample),
+                                  (nicdm, nicdm_sample)]:
+            D_full = func(self.dist)[:, train_ind]
+            D_sec = func_sample(D_sample, train_ind=train_ind, n_jobs=2)
+            np.testing.assert_allclose(D_sec, D_full)
+            D_sec = func_sample(D_sample, train_ind=train_ind,
+                                test_ind=test_ind)
+            np.testing.assert_allclose(D_sec, D_full[test_ind])
+            D_sec = func_sample(D_sample.astype(np.float32),
+                                train_ind=train_ind)
+            self.assertEqual(D_sec.dtype, np.float32)
+
 if __name__ == "__main__":
     unittest.main()
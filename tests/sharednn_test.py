@@ -14,7 +14,7 @@ import numpy as np
 from scipy.spatial.distance import squareform
 from hub_toolbox.distances import euclidean_distance
 from hub_toolbox.shared_neighbors import \
-    shared_nearest_neighbors, snn_sample, simhubIN
+    shared_nearest_neighbors, snn_sample, simhub, simhubIN
 
 class TestSharedNN(unittest.TestCase):
 
@@ -64,6 +64,75 @@ class TestSharedNN(unittest.TestCase):
         snn_par = shared_nearest_neighbors(self.dist, n_jobs=4)
         return np.testing.assert_array_almost_equal(snn_seq, snn_par, 14)
 
+    def test_snn_sparse_engine_equals_dense(self):
+        self.setUpMod('rnd')
+        for metric, D in [('distance', self.dist),
+                          ('similarity', 1. - self.dist)]:
+            snn_dense = shared_nearest_neighbors(
+                D, metric=metric, engine='dense')
+            snn_sparse = shared_nearest_neighbors(
+                D, metric=metric, engine='sparse', n_jobs=2)
+            np.testing.assert_array_equal(snn_dense, snn_sparse)
+        S_snn = shared_nearest_neighbors(self.dist, return_sparse=True)
+        np.testing.assert_array_almost_equal(
+            S_snn.toarray(), 1. - shared_nearest_neighbors(self.dist), 14)
+
+    def test_sparse_graph_output(self):
+        self.setUpMod('rnd')
+        S_snn = shared_nearest_neighbors(self.dist, return_sparse=True)
+        S_top = shared_nearest_neighbors(self.dist, return_sparse=True,
+                                         top_k=5)
+        self.assertTrue(np.all(np.diff(S_top.indptr) == 5))
+        np.testing.assert_array_equal(
+            np.sort(S_top.toarray(), axis=1)[:, -5:],
+            np.sort(S_snn.toarray(), axis=1)[:, -5:])
+        test_ind = np.arange(self.label.size//2, self.label.size)
+        for t in [None, test_ind]:
+            shi = simhubIN(self.dist, test_ind=t, s=20,
+                           return_distances=False)
+            S_shi = simhubIN(self.dist, test_ind=t, s=20, return_sparse=True)
+            np.testing.assert_array_almost_equal(shi, S_shi.toarray(), 14)
+            sh = simhub(self.dist, self.label, test_ind=t, s=20,
+                        return_distances=False)
+            S_sh = simhub(self.dist, self.label, test_ind=t, s=20,
+                          return_sparse=True)
+            np.testing.assert_array_almost_equal(sh, S_sh.toarray(), 14)
+
+    def test_packed_engine_equals_dense(self):
+        self.setUpMod('rnd')
+        snn_dense = shared_nearest_neighbors(self.dist, engine='dense')
+        snn_packed = shared_nearest_neighbors(
+            self.dist, engine='packed', n_jobs=2)
+        np.testing.assert_array_equal(snn_dense, snn_packed)
+        train_ind = np.arange(0, self.label.size, 2)
+        test_ind = np.arange(self.label.size//2, self.label.size)
+        D_sample = self.dist[:, train_ind]
+        snn_dense = snn_sample(D_sample, train_ind=train_ind,
+                               test_ind=test_ind, engine='dense')
+        snn_packed = snn_sample(D_sample, train_ind=train_ind,
+                                test_ind=test_ind, engine='packed')
+        np.testing.assert_array_equal(snn_dense, snn_packed)
+        for t in [None, test_ind]:
+            shi_dense = simhubIN(D_sample, train_ind=train_ind, test_ind=t,
+                                 s=20, engine='dense')
+            shi_packed = simhubIN(D_sample, train_ind=train_ind, test_ind=t,
+                                  s=20, engine='packed', n_jobs=2)
+            np.testing.assert_array_almost_equal(shi_dense, shi_packed, 14)
+
+    def test_snn_sample_equals_full(self):
+        self.setUpMod('rnd')
+        n = self.dist.shape[0]
+        train_ind = np.random.permutation(n)
+        test_ind = np.arange(n//2, n)
+        snn_full = shared_nearest_neighbors(self.dist)[:, train_ind]
+        for engine in ['sparse', 'packed', 'dense']:
+            snn = snn_sample(self.dist[:, train_ind], train_ind=train_ind,
+                             engine=engine)
+            np.testing.assert_array_equal(snn, snn_full)
+            snn = snn_sample(self.dist[:, train_ind], train_ind=train_ind,
+                             test_ind=test_ind, engine=engine)
+            np.testing.assert_array_equal(snn, snn_full[test_ind])
+
     def test_snn_sample_parallel(self):
         self.setUpMod('rnd')
         train_ind = np.arange(self.label.size//2)
@@ -78,6 +147,34 @@ class TestSharedNN(unittest.TestCase):
     def test_simhubIN(self):
         return self.skipTest("simhubIn requires test for correctness!")
 
+    def test_simhubIN_sparse_engine_equals_dense(self):
+        self.setUpMod('rnd')
+        train_ind = np.arange(0, self.label.size, 2)
+        test_ind = np.arange(self.label.size//2, self.label.size)
+        D_sample = self.dist[:, train_ind]
+        for t in [None, test_ind]:
+            for return_distances in [True, False]:
+                shi_dense = simhubIN(
+                    D_sample, train_ind=train_ind, test_ind=t, s=20,
+                    return_distances=return_distances, engine='dense')
+                shi_sparse = simhubIN(
+                    D_sample, train_ind=train_ind, test_ind=t, s=20,
+                    return_distances=return_distances, engine='sparse',
+                    n_jobs=2)
+                np.testing.assert_array_almost_equal(
+                    shi_dense, shi_sparse, 14)
+
+    def test_simhub_sparse_engine_equals_dense(self):
+        self.setUpMod('rnd')
+        test_ind = np.arange(self.label.size//2, self.label.size)
+        for y in [self.label, None]:
+            for t in [None, test_ind]:
+                sh_dense = simhub(self.dist, y, test_ind=t, s=20,
+                                  engine='dense')
+                sh_sparse = simhub(self.dist, y, test_ind=t, s=20,
+                                   engine='sparse', n_jobs=2)
+                np.testing.assert_array_almost_equal(sh_dense, sh_sparse, 14)
+
     def test_simhubIN_parallel(self):
         self.setUpMod('rnd')
         train_ind = np.arange(self.label.size//2)